@@ -0,0 +1,174 @@
+"""Admission control in front of every route.
+
+Each caller, by JWT identity or by address when anonymous, gets a token bucket per route. A request that finds the
+bucket empty is refused with 429 straight away. Requests that pass then wait for one of the slots of the region
+database they target. A request still waiting after ADMISSION_QUEUE_SECONDS is shed with 503. Both responses carry
+Retry-After. Overloaded services answer quickly instead of queueing every request until it times out. Requests
+forwarded by another region were rate limited there and only wait for a slot.
+
+Every request also gets a deadline: the seconds the client sends in X-Request-Timeout, up to
+REQUEST_TIMEOUT_MAX_SECONDS, or its route's default. Waiting for a slot, database sessions, statements and lock waits
+(see database/deadlines.py) end with it, and the request is answered with 504.
+"""
+import logging
+import math
+import threading
+from time import monotonic
+
+import utils
+from flask import Blueprint, g, jsonify, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+
+from api.forwarding import REQUEST_TIMEOUT_HEADER, is_forwarded, request_region
+from database import deadlines
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+admission = Blueprint('admission', __name__)
+
+# (tokens per second, burst) of the routes that differ from RATE_LIMIT_PER_SECOND and RATE_LIMIT_BURST
+ROUTE_RATE_LIMITS = {
+    "transaction_routes.add_transaction_with_items": (5, 10),
+    "transaction_routes.add_transactions_bulk": (1, 2),
+}
+# probes must always be answered, the change feed waits on purpose and would hold a slot while it does
+UNLIMITED_ROUTES = {"common_routes.healthcheck", "common_routes.readiness"}
+UNQUEUED_ROUTES = {"common_routes.get_events"}
+# default deadlines of the routes that differ from REQUEST_TIMEOUT_SECONDS, None for none
+ROUTE_TIMEOUTS = {
+    "transaction_routes.add_transactions_bulk": utils.BULK_REQUEST_TIMEOUT_SECONDS,
+    "common_routes.get_events": None,
+    "common_routes.healthcheck": None,
+    "common_routes.readiness": None,
+}
+PRUNE_EVERY = 1000
+
+
+class RateLimiter:
+    """Token buckets by key, buckets that filled up again are forgotten"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def acquire(self, key, rate, burst):
+        """Take a token, returns 0 or the seconds until the next token"""
+        now = monotonic()
+        with self._lock:
+            self._calls += 1
+            if self._calls % PRUNE_EVERY == 0:
+                self._prune(now)
+            tokens, updated_at = self._buckets.get((key, rate, burst), (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens < 1:
+                self._buckets[(key, rate, burst)] = (tokens, now)
+                return (1 - tokens) / rate
+            self._buckets[(key, rate, burst)] = (tokens - 1, now)
+            return 0
+
+    def _prune(self, now):
+        for bucket_key, (tokens, updated_at) in list(self._buckets.items()):
+            _, rate, burst = bucket_key
+            if tokens + (now - updated_at) * rate >= burst:
+                del self._buckets[bucket_key]
+
+
+class ConcurrencyLimiter:
+    """At most `limit` requests in flight per region, a request waits at most `queue_seconds` for a slot"""
+
+    def __init__(self, regions, limit, queue_seconds):
+        self._slots = {region: threading.BoundedSemaphore(limit) for region in regions}
+        self._queue_seconds = queue_seconds
+
+    def acquire(self, region, timeout=None):
+        """Wait for a slot, at most `timeout` seconds when that is shorter than the queue's wait"""
+        wait = self._queue_seconds if timeout is None else max(0, min(self._queue_seconds, timeout))
+        return self._slots[region].acquire(timeout=wait)
+
+    def release(self, region):
+        self._slots[region].release()
+
+
+RATE_LIMITER = RateLimiter()
+CONCURRENCY_LIMITER = ConcurrencyLimiter(utils.REGIONS, utils.ADMISSION_MAX_CONCURRENCY,
+                                         utils.ADMISSION_QUEUE_SECONDS)
+
+
+def _caller():
+    try:
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+    except Exception:
+        # the route itself rejects bad tokens, until then the caller is known by address
+        identity = None
+    return f"user:{identity}" if identity else f"addr:{request.remote_addr}"
+
+
+def _target_region():
+    region = request_region()
+    return region if region in utils.REGIONS else utils.REGION_ID
+
+
+def _timeout(endpoint):
+    """Seconds the request may take, None for no deadline"""
+    default = ROUTE_TIMEOUTS.get(endpoint, utils.REQUEST_TIMEOUT_SECONDS)
+    try:
+        requested = float(request.headers[REQUEST_TIMEOUT_HEADER])
+    except (KeyError, ValueError):
+        return default
+    if not math.isfinite(requested) or requested < 0:
+        return default
+    return min(requested, utils.REQUEST_TIMEOUT_MAX_SECONDS)
+
+
+def _refuse(status, message, retry_after):
+    response = jsonify({"msg": message})
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response, status
+
+
+@admission.before_app_request
+def admit():
+    endpoint = request.endpoint
+    if endpoint is None:
+        return None
+    deadlines.start(_timeout(endpoint))
+    if endpoint in UNLIMITED_ROUTES:
+        return None
+
+    rate, burst = ROUTE_RATE_LIMITS.get(endpoint, (utils.RATE_LIMIT_PER_SECOND, utils.RATE_LIMIT_BURST))
+    if rate > 0 and not is_forwarded():
+        wait = RATE_LIMITER.acquire((_caller(), endpoint), rate, burst)
+        if wait:
+            return _refuse(429, "Too many requests", wait)
+
+    if endpoint in UNQUEUED_ROUTES or utils.ADMISSION_MAX_CONCURRENCY <= 0:
+        return None
+    region = _target_region()
+    if not CONCURRENCY_LIMITER.acquire(region, timeout=deadlines.remaining()):
+        remaining = deadlines.remaining()
+        if remaining is not None and remaining <= 0:
+            return jsonify({"msg": "Request deadline exceeded"}), 504
+        log.warning(f"Shedding {endpoint}, no {region} database slot within {utils.ADMISSION_QUEUE_SECONDS}s.")
+        return _refuse(503, "Service overloaded, try again later", utils.ADMISSION_QUEUE_SECONDS)
+    g.admitted_region = region
+    return None
+
+
+@admission.after_app_request
+def end_deadline(response):
+    # a stream, such as a history export, is written for as long as its client reads it
+    if response.is_streamed:
+        deadlines.clear()
+    return response
+
+
+@admission.teardown_app_request
+def release(error=None):
+    # streamed responses keep their slot until the stream ends, the request context lives as long
+    deadlines.clear()
+    region = g.pop('admitted_region', None)
+    if region is not None:
+        CONCURRENCY_LIMITER.release(region)
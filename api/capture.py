@@ -0,0 +1,198 @@
+"""Capture of the requests a service serves, for replaying them with benchmark/replay.py.
+
+Off unless CAPTURE_DIR is set. Every process then appends a record per request (sampled at CAPTURE_SAMPLE_RATE) to
+its own gzip compressed NDJSON file in that directory, starting a new file every CAPTURE_ROTATE_BYTES. A record
+holds when the request arrived, its route, query string, the headers that shape its response, its JSON or NDJSON
+body and its outcome. Credentials are never written: the Authorization header is replaced by the caller's JWT
+identity and password and token fields are redacted. Requests forwarded by another region were captured there,
+replayed requests already were, health probes are not captured.
+"""
+import atexit
+import gzip
+import json
+import logging
+import os
+import random
+import time
+
+import tracing
+import utils
+from flask import Blueprint, current_app, g, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+
+from api.forwarding import is_forwarded
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+capture = Blueprint('capture', __name__)
+
+ENABLED = bool(utils.CAPTURE_DIR)
+CAPTURED_HEADERS = ("Content-Type", "Accept", "Accept-Encoding", "If-None-Match", "Idempotency-Key",
+                    "Last-Event-ID", "X-Request-Timeout")
+CAPTURED_MIMETYPES = {"application/json", "application/x-ndjson"}
+REDACTED_FIELDS = {"password", "access_token", "refresh_token", "token"}
+REDACTED = "<redacted>"
+UNCAPTURED_ROUTES = {"common_routes.healthcheck", "common_routes.readiness"}
+# sent by benchmark/replay.py with its run id
+REPLAY_HEADER = "X-Replay-Run"
+
+# sampling must not disturb the seeded global generator that benchmarks use for model ids
+_random = random.Random()
+
+
+class CaptureWriter(tracing.FileExporter):
+    """Appends records to a gzip compressed NDJSON file of this process, replaced by a new one when it grows past
+    `rotate_bytes`"""
+    thread_name = "request-capture"
+
+    def __init__(self, directory, service, rotate_bytes, flush_seconds):
+        super().__init__(None, flush_seconds)
+        self._directory = directory
+        self._service = service
+        self._rotate_bytes = rotate_bytes
+        self._written = 0
+
+    def _write(self, data):
+        if self._path is None or self._written >= self._rotate_bytes:
+            os.makedirs(self._directory, exist_ok=True)
+            self._path = os.path.join(self._directory, f"{self._service}-{utils.REGION_ID}-{os.getpid()}-"
+                                                       f"{time.time_ns()}.ndjson.gz")
+            self._written = 0
+        # every batch is a gzip member of its own, readers see the members of a file as one stream
+        compressed = gzip.compress(data, compresslevel=utils.GZIP_COMPRESSION_LEVEL)
+        super()._write(compressed)
+        self._written += len(compressed)
+
+
+class RecordedInput:
+    """wsgi.input that keeps a copy of the first `limit` bytes read from it"""
+
+    def __init__(self, stream, limit):
+        self._stream = stream
+        self._limit = limit
+        self.data = bytearray()
+        self.truncated = False
+
+    def _keep(self, chunk):
+        if not self.truncated:
+            if len(self.data) + len(chunk) > self._limit:
+                self.truncated = True
+                self.data = bytearray()
+            else:
+                self.data += chunk
+        return chunk
+
+    def read(self, *args):
+        return self._keep(self._stream.read(*args))
+
+    def readline(self, *args):
+        return self._keep(self._stream.readline(*args))
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+def _redact(value):
+    """value without credentials and whether any were removed"""
+    if isinstance(value, dict):
+        redacted = False
+        result = {}
+        for key, item in value.items():
+            if key.lower() in REDACTED_FIELDS:
+                result[key] = REDACTED
+                redacted = True
+            else:
+                result[key], item_redacted = _redact(item)
+                redacted = redacted or item_redacted
+        return result, redacted
+    if isinstance(value, list):
+        items = [_redact(item) for item in value]
+        return [item for item, _ in items], any(redacted for _, redacted in items)
+    return value, False
+
+
+def _body(recorded):
+    """(body, state): state is "complete", "redacted" when credentials were removed, or "omitted" when the body
+    could not be kept"""
+    if recorded.truncated:
+        return None, "omitted"
+    if not recorded.data:
+        return None, "complete"
+    if request.mimetype not in CAPTURED_MIMETYPES:
+        return None, "omitted"
+    try:
+        text = bytes(recorded.data).decode()
+        if request.mimetype == "application/json":
+            documents = [json.loads(text)] if text.strip() else []
+        else:
+            documents = [json.loads(line) for line in text.splitlines() if line.strip()]
+    except ValueError:
+        # a body that doesn't parse could hold anything
+        return None, "omitted"
+    redactions = [_redact(document) for document in documents]
+    if not any(redacted for _, redacted in redactions):
+        return text, "complete"
+    if request.mimetype == "application/json":
+        return json.dumps(redactions[0][0]), "redacted"
+    return "".join(json.dumps(document) + "\n" for document, _ in redactions), "redacted"
+
+
+def _identity():
+    try:
+        verify_jwt_in_request(optional=True)
+        return get_jwt_identity()
+    except Exception:
+        return None
+
+
+@capture.record_once
+def create_writer(state):
+    if ENABLED:
+        writer = CaptureWriter(utils.CAPTURE_DIR, state.app.config.get("SERVICE"), utils.CAPTURE_ROTATE_BYTES,
+                               utils.CAPTURE_FLUSH_SECONDS)
+        state.app.extensions["capture"] = writer
+        atexit.register(writer.flush)
+
+
+@capture.before_app_request
+def start_capture():
+    if not ENABLED or request.endpoint in UNCAPTURED_ROUTES or _random.random() >= utils.CAPTURE_SAMPLE_RATE:
+        return None
+    if REPLAY_HEADER in request.headers or is_forwarded():
+        return None
+    # the body is copied as the route reads it, bulk uploads are streamed rather than buffered
+    recorded = RecordedInput(request.environ["wsgi.input"], utils.CAPTURE_MAX_BODY_BYTES)
+    request.environ["wsgi.input"] = recorded
+    g.capture = (time.time(), time.perf_counter(), recorded)
+    return None
+
+
+@capture.after_app_request
+def record_request(response):
+    started = g.pop('capture', None)
+    if started is None:
+        return response
+    started_at, started_counter, recorded = started
+    if not recorded.truncated and (request.content_length or 0) <= utils.CAPTURE_MAX_BODY_BYTES:
+        # the part of the body the route didn't read
+        request.get_data()
+    body, body_state = _body(recorded)
+    current_app.extensions["capture"].export({
+        "time": started_at,
+        "service": current_app.config.get("SERVICE"),
+        "region": utils.REGION_ID,
+        "method": request.method,
+        "path": request.path,
+        "query": request.query_string.decode(),
+        "endpoint": request.endpoint,
+        "identity": _identity(),
+        "headers": {name: request.headers[name] for name in CAPTURED_HEADERS if name in request.headers},
+        "body": body,
+        "body_state": body_state,
+        "status": response.status_code,
+        # until the response's headers, streams take longer
+        "duration_ms": (time.perf_counter() - started_counter) * 1000,
+        "response_bytes": response.content_length,
+    })
+    return response
@@ -1,5 +1,13 @@
+import base64
+import hashlib
+import json
+import math
+import time
+from datetime import date, datetime
 import utils
-from flask import request, jsonify, Blueprint, current_app
+from database import deadlines
+from database.errors import CircuitOpenError, DeadlineExceededError
+from flask import request, jsonify, make_response, stream_with_context, Blueprint, current_app
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
 
 
@@ -7,6 +15,11 @@ user_routes = Blueprint('user_routes', __name__)
 transaction_routes = Blueprint('transaction_routes', __name__)
 common_routes = Blueprint('common_routes', __name__)
 
+HISTORY_DEFAULT_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+EVENTS_DEFAULT_PAGE_SIZE = 100
+EVENTS_MAX_PAGE_SIZE = 1000
+
 
 @common_routes.route('/user/login', methods=['POST'])
 def login():
@@ -61,6 +74,45 @@ def add_transaction_with_items():
     # Extract the current user's identity from the JWT token
     current_user_username = get_jwt_identity()
 
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if not idempotency_key:
+        return _add_transaction_with_items(current_user_username)
+    if len(idempotency_key) > 255:
+        return jsonify({"msg": "Idempotency-Key must be at most 255 characters"}), 400
+
+    # a retried purchase returns the original response instead of charging the group again
+    db_query = current_app.config["db_query"]
+    request_hash = hashlib.sha256(json.dumps(request.get_json(), sort_keys=True).encode()).hexdigest()
+    state, stored = db_query.claim_idempotency_key(current_user_username, idempotency_key, request_hash)
+    if state == "completed":
+        response = current_app.response_class(stored.response_body, status=stored.response_code,
+                                              mimetype="application/json")
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
+    if state == "mismatch":
+        return jsonify({"msg": "Idempotency-Key was already used for a different request"}), 422
+    if state == "in_progress":
+        response = jsonify({"msg": "A request with this Idempotency-Key is still in progress"})
+        response.headers["Retry-After"] = "1"
+        return response, 409
+
+    try:
+        response = make_response(_add_transaction_with_items(current_user_username))
+    except Exception:
+        with deadlines.suspended():
+            db_query.release_idempotency_key(current_user_username, idempotency_key)
+        raise
+    # the key must record the outcome even when the purchase used up the deadline
+    with deadlines.suspended():
+        if response.status_code == 201:
+            db_query.complete_idempotency_key(current_user_username, idempotency_key, request_hash,
+                                              response.status_code, response.get_data(as_text=True))
+        else:
+            db_query.release_idempotency_key(current_user_username, idempotency_key)
+    return response
+
+
+def _add_transaction_with_items(current_user_username):
     region = request.json.get('region', utils.REGION_ID)
     if region not in utils.REGIONS:
         return jsonify({'error': f'Invalid region, allowed values - {utils.REGIONS}'}), 400
@@ -91,6 +143,170 @@ def add_transaction_with_items():
         }), 201
 
 
+def _parse_bulk_transaction(line):
+    record = json.loads(line)
+    items = record.get('items')
+    if not isinstance(items, list) or not items:
+        raise ValueError("'items' must be a non-empty list")
+    parsed = {
+        "group_id": int(record['group_id']),
+        "store": str(record['store']),
+        "points_redeemed": int(record.get('points_redeemed') or 0),
+        "items": [{"item_id": int(item['item_id']), "quantity": int(item['quantity'])} for item in items],
+        # purchases replayed after an outage keep the time they were made at the store
+        "timestamp": datetime.fromisoformat(record['timestamp']) if record.get('timestamp') else None,
+    }
+    if parsed["points_redeemed"] < 0 or any(item["quantity"] <= 0 for item in parsed["items"]):
+        raise ValueError("points and quantities must not be negative")
+    return parsed
+
+
+@transaction_routes.route('/transaction/bulk', methods=['POST'])
+@jwt_required()
+def add_transactions_bulk():
+    """Ingest an NDJSON stream of the current user's purchases, one transaction object per line"""
+    current_user_username = get_jwt_identity()
+
+    region = request.args.get('region', utils.REGION_ID)
+    if region not in utils.REGIONS:
+        return jsonify({'error': f'Invalid region, allowed values - {utils.REGIONS}'}), 400
+
+    user = current_app.config["db_query"].get_user_details_by_username(current_user_username, region)
+    if not user:
+        return jsonify({"msg": "User not found"}), 404
+
+    results = []
+    chunk = []
+
+    def apply_chunk():
+        outcomes = current_app.config["db_query"].add_transactions_bulk(user.user_id, [record for _, record in chunk])
+        for (line_number, _), outcome in zip(chunk, outcomes):
+            if isinstance(outcome, str):
+                results.append({"line": line_number, "ok": False, "msg": outcome})
+            else:
+                results.append({"line": line_number, "ok": True, "transaction": outcome})
+        chunk.clear()
+
+    # the body is read and applied chunk by chunk instead of being buffered whole
+    for line_number, line in enumerate(request.stream, 1):
+        if not line.strip():
+            continue
+        try:
+            chunk.append((line_number, _parse_bulk_transaction(line)))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            results.append({"line": line_number, "ok": False, "msg": f"Invalid record - {e!r}"})
+        if len(chunk) >= utils.BULK_CHUNK_SIZE:
+            apply_chunk()
+    if chunk:
+        apply_chunk()
+
+    results.sort(key=lambda result: result["line"])
+    accepted = sum(result["ok"] for result in results)
+    return jsonify({
+        "msg": f"{accepted} of {len(results)} transactions added",
+        "accepted": accepted,
+        "rejected": len(results) - accepted,
+        "results": results
+    }), 200
+
+
+def _encode_cursor(transaction):
+    key = [transaction["timestamp"].isoformat(), transaction["transaction_id"]]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def _decode_cursor(cursor):
+    timestamp, transaction_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(timestamp), int(transaction_id)
+
+
+def _history_options():
+    """Parse the arguments shared by the transaction history routes, ValueError on bad input"""
+    export = request.args.get('format') == 'ndjson'
+    limit = request.args.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if limit <= 0 or (not export and limit > HISTORY_MAX_PAGE_SIZE):
+            raise ValueError("'limit' is out of range")
+    elif not export:
+        limit = HISTORY_DEFAULT_PAGE_SIZE
+    cursor = request.args.get('cursor')
+    start = request.args.get('from')
+    end = request.args.get('to')
+    return {
+        "after": _decode_cursor(cursor) if cursor else None,
+        "start": datetime.fromisoformat(start) if start else None,
+        "end": datetime.fromisoformat(end) if end else None,
+        "limit": limit,
+        "include_items": request.args.get('include_items', 'false') == 'true',
+    }, export
+
+
+def _history_response(transactions, limit, export):
+    if export:
+        # fail with a proper status if the database is unavailable, before the response has started
+        transactions = iter(transactions)
+        first = next(transactions, None)
+
+        def generate():
+            if first is not None:
+                yield current_app.json.dumps(first) + "\n"
+                for transaction in transactions:
+                    yield current_app.json.dumps(transaction) + "\n"
+
+        response = current_app.response_class(stream_with_context(generate()), mimetype="application/x-ndjson")
+        # let nginx pass the export through instead of buffering it
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
+    # one row past the page tells whether there is a next one
+    page = list(transactions)
+    next_cursor = _encode_cursor(page[limit - 1]) if len(page) > limit else None
+    return jsonify({"transactions": page[:limit], "next_cursor": next_cursor}), 200
+
+
+@transaction_routes.route('/user/transactions', methods=['GET'])
+@jwt_required()
+def get_user_transactions():
+    current_user_username = get_jwt_identity()
+
+    region = request.args.get('region', utils.REGION_ID)
+    if region not in utils.REGIONS:
+        return jsonify({'error': f'Invalid region, allowed values - {utils.REGIONS}'}), 400
+    try:
+        options, export = _history_options()
+    except (ValueError, TypeError) as e:
+        return jsonify({"msg": f"Invalid history query - {e}"}), 400
+
+    user = current_app.config["db_query"].get_user_details_by_username(current_user_username, region)
+    if not user:
+        return jsonify({"msg": "User not found"}), 404
+
+    limit = options["limit"]
+    transactions = current_app.config["db_query"].get_user_transactions(
+        user.user_id, region, **{**options, "limit": limit if export else limit + 1})
+    return _history_response(transactions, limit, export)
+
+
+@transaction_routes.route('/group/<int:group_id>/transactions', methods=['GET'])
+@jwt_required()
+def get_group_transactions(group_id):
+    region = request.args.get('region', utils.REGION_ID)
+    if region not in utils.REGIONS:
+        return jsonify({'error': f'Invalid region, allowed values - {utils.REGIONS}'}), 400
+    try:
+        options, export = _history_options()
+    except (ValueError, TypeError) as e:
+        return jsonify({"msg": f"Invalid history query - {e}"}), 400
+
+    limit = options["limit"]
+    transactions = current_app.config["db_query"].get_group_transactions(
+        group_id, region, **{**options, "limit": limit if export else limit + 1})
+    if transactions is None:
+        return jsonify({"msg": "Group not found"}), 404
+    return _history_response(transactions, limit, export)
+
+
 @transaction_routes.route('/item/add', methods=['POST'])
 @jwt_required()
 def add_item():
@@ -111,7 +327,10 @@ def add_item():
 def get_items():
     items = current_app.config["db_query"].get_items()
     items_data = [{"item_id": item.item_id, "name": item.name, "price": item.price} for item in items]
-    return jsonify(items_data), 200
+    # clients revalidate their cached catalog with If-None-Match and get an empty 304 when it is unchanged
+    response = jsonify(items_data)
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @user_routes.route('/group/add', methods=['POST'])
@@ -194,6 +413,97 @@ def get_group(group_id):
     return jsonify(group_details), 200
 
 
+@common_routes.route('/group/<int:group_id>/summary', methods=['GET'])
+@jwt_required()
+def get_group_summary(group_id):
+    region = request.args.get('region', utils.REGION_ID)
+    if region not in utils.REGIONS:
+        return jsonify({'error': f'Invalid region, allowed values - {utils.REGIONS}'}), 400
+    try:
+        start = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+    except ValueError as e:
+        return jsonify({"msg": f"Invalid date - {e}"}), 400
+
+    summary = current_app.config["db_query"].get_group_summary(group_id, region, start, end)
+    if not summary:
+        return jsonify({"msg": "Group not found"}), 404
+    return jsonify(summary), 200
+
+
+@common_routes.route('/events', methods=['GET'])
+@jwt_required()
+def get_events():
+    """The change feed of the region, or of one of its shards, after the event id in `after` or Last-Event-ID. Long
+    polls for up to `wait` seconds when there are no new events, or streams server-sent events when asked for
+    text/event-stream."""
+    region = request.args.get('region', utils.REGION_ID)
+    if region not in utils.REGIONS:
+        return jsonify({'error': f'Invalid region, allowed values - {utils.REGIONS}'}), 400
+    # every shard of a sharded region has its own feed
+    shard = request.args.get('shard', utils.MAIN_SHARD)
+    shards = [utils.MAIN_SHARD, *utils.REGION_SHARD_URLS[region]]
+    if shard not in shards:
+        return jsonify({'error': f'Invalid shard, allowed values - {shards}'}), 400
+    try:
+        after = int(request.headers.get('Last-Event-ID') or request.args.get('after', 0))
+        limit = int(request.args.get('limit', EVENTS_DEFAULT_PAGE_SIZE))
+        wait = min(float(request.args.get('wait', 0)), utils.CHANGE_FEED_MAX_WAIT_SECONDS)
+        if after < 0 or not 0 < limit <= EVENTS_MAX_PAGE_SIZE or wait < 0:
+            raise ValueError("'after', 'limit' or 'wait' is out of range")
+    except ValueError as e:
+        return jsonify({"msg": f"Invalid event query - {e}"}), 400
+
+    db_query = current_app.config["db_query"]
+    # read once before responding so that an unavailable database fails with a proper status
+    events = db_query.get_change_events(region, after, limit, shard)
+
+    if request.accept_mimetypes.best == "text/event-stream":
+        def generate():
+            cursor, batch = after, events
+            while True:
+                for event in batch:
+                    yield f"id: {event['event_id']}\nevent: {event['kind']}\ndata: {current_app.json.dumps(event)}\n\n"
+                if batch:
+                    cursor = batch[-1]["event_id"]
+                else:
+                    # comments keep idle connections open and notice clients that went away
+                    yield ": keep-alive\n\n"
+                    time.sleep(utils.CHANGE_FEED_POLL_SECONDS)
+                batch = db_query.get_change_events(region, cursor, limit, shard)
+
+        response = current_app.response_class(stream_with_context(generate()), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
+    deadline = time.monotonic() + wait
+    while not events and time.monotonic() < deadline:
+        time.sleep(min(utils.CHANGE_FEED_POLL_SECONDS, max(0.0, deadline - time.monotonic())))
+        events = db_query.get_change_events(region, after, limit, shard)
+    return jsonify({"events": events, "next_cursor": events[-1]["event_id"] if events else after}), 200
+
+
 @common_routes.route('/healthcheck', methods=['GET'])
 def healthcheck():
+    # liveness only, must stay cheap and independent of the databases
     return jsonify({"status": "ok"}), 200
+
+
+@common_routes.route('/readiness', methods=['GET'])
+def readiness():
+    health = current_app.config["db_query"].get_database_health()
+    return jsonify(health), 200 if health["ready"] else 503
+
+
+@common_routes.app_errorhandler(CircuitOpenError)
+def handle_circuit_open(error):
+    response = jsonify({"msg": "Database unavailable, try again later"})
+    response.headers["Retry-After"] = str(max(1, math.ceil(error.retry_after)))
+    return response, 503
+
+
+@common_routes.app_errorhandler(DeadlineExceededError)
+def handle_deadline_exceeded(error):
+    return jsonify({"msg": "Request deadline exceeded"}), 504
+
@@ -0,0 +1,206 @@
+"""Forwarding of requests whose data lives in another region to the same service of that region.
+
+A request naming another region, by the `region` query argument or JSON field, is sent once and as a whole to that
+region's API when {REGION}_{SERVICE}_API_URL is set, e.g. USW_TRANSACTION_API_URL. Its lookups, locks and inserts
+then run next to their database and the request pays one WAN round trip instead of one per statement. Connections
+to the other regions are kept alive in a pool. Regions without a URL are still queried directly.
+
+Forwarded requests carry X-Forwarded-Region and a signature, made with a key derived from JWT_KEY, of the region,
+the method, path, query, body and the time it was made. The receiving region only accepts signatures up to
+FORWARD_SIGNATURE_MAX_AGE_SECONDS old, reads the whole body to check it before the route sees it, then serves the
+request itself: it is never forwarded again, and not rate limited a second time. Bodies that are streamed, e.g.
+bulk uploads, are spooled on both legs to be signed and checked. Forwarded requests also carry what is left of the
+request's deadline in X-Request-Timeout, the other region gives up when the caller does.
+"""
+import hashlib
+import hmac
+import logging
+import math
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+import tracing
+import utils
+from database import deadlines
+from flask import Blueprint, current_app, g, jsonify, request
+from requests.adapters import HTTPAdapter
+from werkzeug.wsgi import get_input_stream
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+forwarding = Blueprint('forwarding', __name__)
+
+FORWARDED_REGION_HEADER = "X-Forwarded-Region"
+FORWARDING_SIGNATURE_HEADER = "X-Forwarding-Signature"
+FORWARDING_TIMESTAMP_HEADER = "X-Forwarding-Timestamp"
+# seconds the caller waits for the response
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout"
+# headers of a single connection, the body is re-framed on each leg
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+                      "transfer-encoding", "upgrade", "host", "content-length"}
+# the response body is relayed byte for byte and keeps its length, the local server sets its own Server and Date
+RELAYED_RESPONSE_EXCLUDED_HEADERS = (HOP_BY_HOP_HEADERS - {"content-length"}) | {"server", "date"}
+CHUNK_SIZE = 64 * 1024
+# spooled bodies larger than this go to a temporary file
+SPOOL_MEMORY_BYTES = 1024 * 1024
+# a leaked forwarding signature can't be used as a JWT key or the other way round
+_SIGNING_KEY = hmac.new(utils.JWT_KEY.encode(), b"region forwarding", hashlib.sha256).digest()
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _session(url):
+    with _sessions_lock:
+        session = _sessions.get(url)
+        if session is None:
+            session = requests.Session()
+            session.mount(url, HTTPAdapter(pool_connections=1, pool_maxsize=utils.FORWARD_POOL_SIZE))
+            _sessions[url] = session
+        return session
+
+
+def _signature(region, timestamp, body_digest):
+    # the parsed query, its encoding may change on the way
+    query = urlencode(sorted(request.args.items(multi=True)))
+    message = "\n".join((region, timestamp, request.method, request.path, query, body_digest)).encode()
+    return hmac.new(_SIGNING_KEY, message, hashlib.sha256).hexdigest()
+
+
+def _spool(stream):
+    """A file with the rest of the stream, and its sha256"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled, digest.hexdigest()
+
+
+def _is_buffered():
+    # JSON bodies are read to find the region, requests without a body read as empty
+    return request.is_json or request.method in ("GET", "HEAD", "DELETE")
+
+
+def _verify_forwarded():
+    region = request.headers.get(FORWARDED_REGION_HEADER)
+    if region is None:
+        return False
+    timestamp = request.headers.get(FORWARDING_TIMESTAMP_HEADER, "")
+    try:
+        age = time.time() - float(timestamp)
+    except ValueError:
+        return False
+    if not math.isfinite(age) or abs(age) > utils.FORWARD_SIGNATURE_MAX_AGE_SECONDS:
+        return False
+    if _is_buffered():
+        body_digest = hashlib.sha256(request.get_data()).hexdigest()
+    else:
+        # read whole before anything trusts it, the route reads the copy
+        spooled, body_digest = _spool(get_input_stream(request.environ))
+        request.environ["wsgi.input"] = spooled
+        request.environ["CONTENT_LENGTH"] = str(spooled.seek(0, 2))
+        spooled.seek(0)
+    signature = request.headers.get(FORWARDING_SIGNATURE_HEADER, "")
+    return hmac.compare_digest(signature, _signature(region, timestamp, body_digest))
+
+
+def is_forwarded():
+    """Whether the request was forwarded by another region's service, checked once per request"""
+    if "forwarded" not in g:
+        g.forwarded = _verify_forwarded()
+    return g.forwarded
+
+
+def request_region():
+    """The region named by the request, None when it names none"""
+    region = request.args.get('region')
+    if region is None and request.is_json:
+        body = request.get_json(silent=True)
+        region = body.get('region') if isinstance(body, dict) else None
+    return region
+
+
+def _forwarded_headers(remaining, body_digest):
+    excluded = HOP_BY_HOP_HEADERS | {REQUEST_TIMEOUT_HEADER.lower()}
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in excluded}
+    if remaining is not None:
+        headers[REQUEST_TIMEOUT_HEADER] = f"{remaining:.3f}"
+    span = tracing.current()
+    if span is not None:
+        # the other region's spans are children of the forwarding span
+        headers = {name: value for name, value in headers.items() if name.lower() != tracing.TRACEPARENT_HEADER}
+        headers[tracing.TRACEPARENT_HEADER] = span.traceparent
+    timestamp = f"{time.time():.3f}"
+    headers[FORWARDED_REGION_HEADER] = utils.REGION_ID
+    headers[FORWARDING_TIMESTAMP_HEADER] = timestamp
+    headers[FORWARDING_SIGNATURE_HEADER] = _signature(utils.REGION_ID, timestamp, body_digest)
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    headers["X-Forwarded-For"] = f"{forwarded_for}, {request.remote_addr}" if forwarded_for else request.remote_addr
+    return headers
+
+
+def _body():
+    """The body to forward and its sha256"""
+    if _is_buffered():
+        data = request.get_data()
+        return data or None, hashlib.sha256(data).hexdigest()
+    # e.g. bulk NDJSON uploads, read whole to be signed
+    return _spool(request.stream)
+
+
+@forwarding.before_app_request
+def forward():
+    if request.endpoint is None:
+        return None
+    if request.headers.get(FORWARDED_REGION_HEADER) is not None:
+        if not is_forwarded():
+            return jsonify({"msg": "Invalid forwarded request"}), 403
+        return None
+
+    region = request_region()
+    url = utils.REGION_API_URLS.get((region, current_app.config.get("SERVICE")))
+    if region == utils.REGION_ID or url is None:
+        return None
+
+    remaining = deadlines.remaining()
+    if remaining is not None and remaining <= 0:
+        return jsonify({"msg": "Request deadline exceeded"}), 504
+    read_timeout = utils.FORWARD_READ_TIMEOUT_SECONDS if remaining is None \
+        else min(utils.FORWARD_READ_TIMEOUT_SECONDS, remaining)
+    body, body_digest = _body()
+    try:
+        # until the response's headers arrived, its body is relayed afterwards
+        with tracing.span(f"forward {region}", region=region, url=url):
+            upstream = _session(url).request(
+                request.method, f"{url}{request.path}", params=list(request.args.items(multi=True)), data=body,
+                headers=_forwarded_headers(remaining, body_digest), stream=True, allow_redirects=False,
+                timeout=(utils.FORWARD_CONNECT_TIMEOUT_SECONDS, read_timeout),
+            )
+    except requests.RequestException as e:
+        if isinstance(e, requests.ReadTimeout) and read_timeout < utils.FORWARD_READ_TIMEOUT_SECONDS:
+            # the request's deadline ran out before the other region answered
+            log.warning(f"Forwarding {request.endpoint} to {region} ran out of time")
+            return jsonify({"msg": "Request deadline exceeded"}), 504
+        log.error(f"Forwarding {request.endpoint} to {region} failed: {e}")
+        return jsonify({"msg": f"Region {region} is unreachable, try again later"}), 502
+    finally:
+        # sent by now
+        if hasattr(body, "close"):
+            body.close()
+
+    def relay():
+        # raw bytes, a compressed body stays compressed and streams like the change feed are passed on as they come
+        try:
+            yield from upstream.raw.stream(CHUNK_SIZE, decode_content=False)
+        finally:
+            upstream.close()
+
+    headers = [(name, value) for name, value in upstream.raw.headers.items()
+               if name.lower() not in RELAYED_RESPONSE_EXCLUDED_HEADERS]
+    return current_app.response_class(relay(), status=upstream.status_code, headers=headers)
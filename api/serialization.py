@@ -0,0 +1,100 @@
+"""JSON encoding and compression of the API's responses.
+
+JSONProvider encodes with orjson when it is installed and JSON_ENCODER is "orjson", and with Flask's json module
+otherwise. The output is the same either way, except that orjson writes non-ASCII characters as UTF-8 instead of
+escaping them: keys are sorted and dates keep Flask's HTTP date format.
+
+Responses of at least COMPRESSION_MIN_BYTES are compressed with brotli (when installed) or gzip, whichever the
+client's Accept-Encoding prefers. Streamed responses, such as history exports and the change feed, are sent as they
+are so that their rows reach the client as soon as they are written.
+"""
+import gzip
+
+import utils
+from flask import Blueprint, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+compression = Blueprint('compression', __name__)
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson", "text/plain", "text/html", "text/csv"}
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, encoding with orjson when it is available"""
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.fast = orjson is not None and utils.JSON_ENCODER == "orjson"
+
+    def _options(self):
+        # dates are handed to `default`, which formats them the way Flask does
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        return options | orjson.OPT_SORT_KEYS if self.sort_keys else options
+
+    def encode(self, obj):
+        """The JSON of obj as UTF-8 bytes"""
+        if not self.fast:
+            return super().dumps(obj, separators=(",", ":")).encode()
+        return orjson.dumps(obj, default=self.default, option=self._options())
+
+    def dumps(self, obj, **kwargs):
+        # arguments such as indent are only understood by the json module
+        if not self.fast or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.encode(obj).decode()
+
+    def loads(self, s, **kwargs):
+        if not self.fast or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if not self.fast or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.encode(obj) + b"\n", mimetype=self.mimetype)
+
+
+def _compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=utils.BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=utils.GZIP_COMPRESSION_LEVEL)
+
+
+def _encoding():
+    """The encoding the client prefers among the ones available, None for identity"""
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(offered)
+
+
+@compression.after_app_request
+def compress(response):
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES or response.is_streamed or response.direct_passthrough
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    if response.content_length is None or response.content_length < utils.COMPRESSION_MIN_BYTES:
+        return response
+    encoding = _encoding()
+    if encoding is None:
+        return response
+
+    response.set_data(_compress(response.get_data(), encoding))
+    response.headers["Content-Encoding"] = encoding
+    # the compressed bytes differ from the ones the tag was computed for, they still mean the same
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
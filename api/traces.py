@@ -0,0 +1,45 @@
+"""Trace spans of the requests a service serves.
+
+Every request gets a span, a child of the caller's span when it sends a traceparent header, that the query
+functions and database statements it runs are recorded under. The response's traceresponse header names the trace.
+"""
+import tracing
+from flask import Blueprint, current_app, g, request
+
+traces = Blueprint('traces', __name__)
+
+TRACERESPONSE_HEADER = "traceresponse"
+
+
+@traces.before_app_request
+def start_span():
+    if not tracing.ENABLED:
+        return None
+    rule = request.url_rule.rule if request.url_rule is not None else request.path
+    span = tracing.start(f"{request.method} {rule}", tracing.parse_traceparent(
+        request.headers.get(tracing.TRACEPARENT_HEADER)), service=current_app.config.get("SERVICE"))
+    g.trace_span = span
+    tracing.activate(span)
+    return None
+
+
+@traces.after_app_request
+def end_span_with_response(response):
+    span = g.pop('trace_span', None)
+    if span is not None:
+        span.set(status=response.status_code)
+        response.headers[TRACERESPONSE_HEADER] = span.traceparent
+        # once the body is sent, streamed responses are still being sent when the request is torn down
+        response.call_on_close(span.end)
+    return response
+
+
+@traces.teardown_app_request
+def end_span(error=None):
+    # requests that failed before they had a response
+    span = g.pop('trace_span', None)
+    if span is not None:
+        span.end(error)
+    if tracing.ENABLED:
+        # the thread serves other requests next
+        tracing.activate(None)
@@ -1,12 +1,30 @@
 import utils
 from flask import Flask
 from flask_jwt_extended import JWTManager
+from werkzeug.middleware.proxy_fix import ProxyFix
+from api.admission import admission
+from api.capture import capture
+from api.forwarding import forwarding
+from api.serialization import JSONProvider, compression
+from api.traces import traces
 from api.core import transaction_routes, common_routes
 
 
 # Initialize Flask app
 app = Flask(__name__)
+app.json = JSONProvider(app)
+# behind a proxy every request comes from its address, anonymous callers are told apart by X-Forwarded-For
+if utils.TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=utils.TRUSTED_PROXY_HOPS, x_proto=0, x_host=0, x_port=0, x_prefix=0)
+app.config["SERVICE"] = "transaction"
 
+# before request hooks run in order, the request's span covers the others; after request hooks run in reverse,
+# compression sees the final response and capture records it
+app.register_blueprint(capture)
+app.register_blueprint(traces)
+app.register_blueprint(compression)
+app.register_blueprint(admission)
+app.register_blueprint(forwarding)
 app.register_blueprint(common_routes)
 app.register_blueprint(transaction_routes)
 
@@ -0,0 +1,356 @@
+"""Deterministic bulk data generator for scale testing.
+
+Loads users, single and multi region groups, memberships (including cross-region group_member_mr rows,
+replicated to every region like the API does) and long, skewed transaction histories into every configured
+region. PostgreSQL targets are loaded with COPY, other databases with batched executemany inserts. The same
+--seed always produces the same data set, so benchmark runs against it are comparable.
+
+    REGIONS=EUW,USW REGION_ID=EUW ... python -m benchmark.datagen --users 1000000 --groups 250000 \\
+        --transactions 5000000 --seed 42
+
+Load into empty databases: generated ids are unique among themselves but are not checked against existing rows.
+"""
+import csv
+import io
+import itertools
+import math
+import random
+import time
+from array import array
+from datetime import timedelta
+
+import click
+from sqlalchemy import insert, select
+
+import utils
+from database.models import Base, User, Group, GroupMemberMR, Transaction, TransactionItem, Item, \
+    group_member_association, add_items, DB_CONNECTION
+from database import partitions, rollup
+
+STORES = ["Dublin Central", "Galway Docks", "Cork Quay", "Limerick Square", "San Francisco Mission",
+          "Seattle Pike", "Portland Pearl", "Los Angeles Arts"]
+
+MAX_GROUP_MEMBERS = 4
+
+# ids follow the application's 8 digit range; a multiplicative permutation keeps them unique without
+# remembering which ones were handed out
+ID_OFFSET = 10000000
+ID_SPACE = 90000000
+ID_MULTIPLIER = 48271
+
+
+class IdSequence:
+    def __init__(self, rng):
+        self._shift = rng.randrange(ID_SPACE)
+        self._next = 0
+
+    def take(self, count):
+        if self._next + count > ID_SPACE:
+            raise click.ClickException(f"Cannot generate more than {ID_SPACE} ids")
+        start = self._next
+        self._next += count
+        return start
+
+    def __call__(self, n):
+        return ID_OFFSET + (n * ID_MULTIPLIER + self._shift) % ID_SPACE
+
+
+class BulkWriter:
+    """Buffers rows for one table and loads them in batches through the fastest path of the database"""
+
+    def __init__(self, engine, table, columns, batch_size, parent=None):
+        self._engine = engine
+        # rows referencing the parent's rows can only be loaded once the parent batch is in
+        self._parent = parent
+        self._table = table
+        self._columns = columns
+        self._batch_size = batch_size
+        self._rows = []
+        self.written = 0
+        self._use_copy = engine.dialect.name == "postgresql" and engine.dialect.driver == "psycopg2"
+        if self._use_copy:
+            preparer = engine.dialect.identifier_preparer
+            self._copy_sql = (f"COPY {preparer.format_table(table)} "
+                              f"({', '.join(preparer.quote(column) for column in columns)}) "
+                              f"FROM STDIN WITH (FORMAT csv)")
+
+    def add(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        if self._parent is not None:
+            self._parent.flush()
+        if self._use_copy:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(self._rows)
+            buffer.seek(0)
+            raw_connection = self._engine.raw_connection()
+            try:
+                cursor = raw_connection.cursor()
+                cursor.copy_expert(self._copy_sql, buffer)
+                raw_connection.commit()
+            finally:
+                raw_connection.close()
+        else:
+            with self._engine.begin() as conn:
+                conn.execute(insert(self._table), [dict(zip(self._columns, row)) for row in self._rows])
+        self.written += len(self._rows)
+        self._rows = []
+
+
+def zipf_cum_weights(count, exponent):
+    total = 0.0
+    cum_weights = array("d")
+    for rank in range(count):
+        total += 1 / (rank + 1) ** exponent
+        cum_weights.append(total)
+    return cum_weights
+
+
+class Generator:
+    def __init__(self, regions, engines, seed, users, groups, transactions, items, multi_region_ratio,
+                 cross_region_ratio, group_skew, user_skew, days, end_date, max_basket, batch_size):
+        self.regions = regions
+        self.engines = engines
+        self.seed = seed
+        self.users_per_region = users
+        self.groups_per_region = groups
+        self.transactions_per_region = transactions
+        self.item_count = items
+        self.multi_region_ratio = multi_region_ratio
+        self.cross_region_ratio = cross_region_ratio
+        self.group_skew = group_skew
+        self.user_skew = user_skew
+        self.days = days
+        self.end_date = end_date
+        self.max_basket = max_basket
+        self.batch_size = batch_size
+        self.ids = IdSequence(self._rng("ids"))
+        self.user_base = self.ids.take(users * len(regions))
+        self.group_base = self.ids.take(groups * len(regions))
+        self.counts = {}
+
+    def _rng(self, *scope):
+        # every table and region draws from its own stream so they stay reproducible independently
+        return random.Random(f"{self.seed}:{':'.join(scope)}")
+
+    def _writer(self, region, table, columns, parent=None):
+        return BulkWriter(self.engines[region], table, columns, self.batch_size, parent)
+
+    def _finish(self, name, writers):
+        for writer in writers.values() if isinstance(writers, dict) else [writers]:
+            writer.flush()
+            self.counts[name] = self.counts.get(name, 0) + writer.written
+
+    def user_number(self, region_index, index):
+        return self.user_base + region_index * self.users_per_region + index
+
+    def region_of_user(self, number):
+        return (number - self.user_base) // self.users_per_region
+
+    def load_items(self):
+        rng = self._rng("items")
+        items = [(item_id, f"Item {item_id}", round(rng.uniform(1, 12) * 2) / 2)
+                 for item_id in range(6, self.item_count + 1)]
+        for region in self.regions:
+            writer = self._writer(region, Item.__table__, ["item_id", "name", "price"])
+            for item in items:
+                writer.add(item)
+            self._finish("item", writer)
+        with self.engines[self.regions[0]].connect() as conn:
+            self.prices = dict(conn.execute(select(Item.item_id, Item.price)).all())
+
+    def load_users(self):
+        # heavy users: a pareto activity weight per user decides who buys within a group
+        self.user_weights = array("d")
+        for region_index, region in enumerate(self.regions):
+            rng = self._rng("users", region)
+            writer = self._writer(region, User.__table__, ["user_id", "user_name", "password"])
+            for index in range(self.users_per_region):
+                number = self.user_number(region_index, index)
+                writer.add((self.ids(number), f"gen_{region.lower()}_{index}", f"pw{rng.randrange(10 ** 8):08d}"))
+                self.user_weights.append(rng.paretovariate(self.user_skew))
+            self._finish("user", writer)
+
+    def build_memberships(self):
+        self.members = {}
+        self.multi_region = {}
+        for region_index, region in enumerate(self.regions):
+            rng = self._rng("memberships", region)
+            members = array("q")
+            multi_region = array("b")
+            for _ in range(self.groups_per_region):
+                is_multi_region = rng.random() < self.multi_region_ratio
+                size = rng.randint(1, MAX_GROUP_MEMBERS)
+                chosen = []
+                for position in range(size):
+                    member_region = region_index
+                    # the owner comes first and always lives in the group's region
+                    if position > 0 and is_multi_region and rng.random() < self.cross_region_ratio:
+                        member_region = rng.randrange(len(self.regions))
+                    number = self.user_number(member_region, rng.randrange(self.users_per_region))
+                    if number not in chosen:
+                        chosen.append(number)
+                members.extend(chosen + [-1] * (MAX_GROUP_MEMBERS - len(chosen)))
+                multi_region.append(is_multi_region)
+            self.members[region] = members
+            self.multi_region[region] = multi_region
+
+    def group_members(self, region, group_index):
+        start = group_index * MAX_GROUP_MEMBERS
+        return [number for number in self.members[region][start:start + MAX_GROUP_MEMBERS] if number != -1]
+
+    def group_id(self, region_index, group_index):
+        return self.ids(self.group_base + region_index * self.groups_per_region + group_index)
+
+    def load_transactions(self):
+        self.points = {region: array("q", [0]) * self.groups_per_region for region in self.regions}
+        transaction_base = self.ids.take(self.transactions_per_region * len(self.regions))
+        transaction_writers = {region: self._writer(region, Transaction.__table__, [
+            "transaction_id", "user_id", "group_id", "timestamp", "store", "total", "points_redeemed",
+            "points_awarded"]) for region in self.regions}
+        item_writers = {region: self._writer(region, TransactionItem.__table__, [
+            "transaction_item_id", "transaction_id", "transaction_timestamp", "item_id", "quantity", "item_total"],
+            parent=transaction_writers[region]) for region in self.regions}
+        # item ids only need to be unique per transaction timestamp, a counter per region is enough
+        item_counters = {region: itertools.count(1) for region in self.regions}
+        item_ids = sorted(self.prices)
+        item_cum_weights = zipf_cum_weights(len(item_ids), 1.0)
+        group_cum_weights = zipf_cum_weights(self.groups_per_region, self.group_skew)
+        history_start = self.end_date - timedelta(days=self.days)
+
+        for region_index, region in enumerate(self.regions):
+            rng = self._rng("transactions", region)
+            # popularity ranks are shuffled so hot groups are not simply the first ones created
+            group_order = list(range(self.groups_per_region))
+            rng.shuffle(group_order)
+            for index in range(self.transactions_per_region):
+                group_index = group_order[rng.choices(range(self.groups_per_region),
+                                                      cum_weights=group_cum_weights)[0]]
+                members = self.group_members(region, group_index)
+                buyer = rng.choices(members, weights=[self.user_weights[number - self.user_base]
+                                                      for number in members])[0]
+                basket_size = min(self.max_basket, 1 + int(rng.expovariate(0.5)))
+                basket = sorted(set(rng.choices(item_ids, cum_weights=item_cum_weights, k=basket_size)))
+
+                transaction_id = self.ids(transaction_base + region_index * self.transactions_per_region + index)
+                # transactions are stored in the buyer's region, like add_transaction_entry does
+                buyer_region = self.regions[self.region_of_user(buyer)]
+                lines = []
+                for item_id in basket:
+                    quantity = rng.randint(1, 3)
+                    lines.append((item_id, quantity, self.prices[item_id] * quantity))
+                total = sum(line[2] for line in lines)
+
+                group_points = self.points[region][group_index]
+                points_redeemed = 0
+                if group_points > 0 and rng.random() < 0.1:
+                    points_redeemed = rng.randint(1, min(group_points, max(1, int(total))))
+                points_awarded = math.ceil(total / 10) if points_redeemed == 0 else 0
+                self.points[region][group_index] = group_points - points_redeemed + points_awarded
+
+                timestamp = history_start + timedelta(seconds=rng.randrange(self.days * 86400))
+                transaction_writers[buyer_region].add((
+                    transaction_id, self.ids(buyer), self.group_id(region_index, group_index), timestamp,
+                    rng.choice(STORES), total - points_redeemed, points_redeemed, points_awarded))
+                for line in lines:
+                    item_writers[buyer_region].add((next(item_counters[buyer_region]), transaction_id, timestamp,
+                                                    *line))
+        self._finish("transaction", transaction_writers)
+        self._finish("transaction_item", item_writers)
+
+    def load_groups(self):
+        mr_writers = {region: self._writer(region, GroupMemberMR.__table__, [
+            "group_id", "user_id", "group_region_id", "user_region_id"]) for region in self.regions}
+        for region_index, region in enumerate(self.regions):
+            group_writer = self._writer(region, Group.__table__,
+                                        ["group_id", "name", "owner_id", "points", "multi_region"])
+            member_writer = self._writer(region, group_member_association, ["user_id", "group_id"],
+                                         parent=group_writer)
+            for group_index in range(self.groups_per_region):
+                group_id = self.group_id(region_index, group_index)
+                members = self.group_members(region, group_index)
+                is_multi_region = bool(self.multi_region[region][group_index])
+                group_writer.add((group_id, f"gen_{region.lower()}_group_{group_index}", self.ids(members[0]),
+                                  self.points[region][group_index], is_multi_region))
+                for number in members:
+                    if is_multi_region:
+                        row = (group_id, self.ids(number), utils.REGIONS_INT[region],
+                               utils.REGIONS_INT[self.regions[self.region_of_user(number)]])
+                        for writer in mr_writers.values():
+                            writer.add(row)
+                    else:
+                        member_writer.add((self.ids(number), group_id))
+            # groups are referenced by group_member, write them first
+            self._finish("group", group_writer)
+            self._finish("group_member", member_writer)
+        self._finish("group_member_mr", mr_writers)
+
+
+def finalize(engine):
+    with engine.begin() as conn:
+        # the rollups are maintained on the write path, which the generator bypasses
+        rollup.rebuild(conn)
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        # explicit item ids bypass the sequence, move it past them
+        conn.exec_driver_sql("SELECT setval(pg_get_serial_sequence('item', 'item_id'), "
+                             "(SELECT max(item_id) FROM item))")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("ANALYZE")
+
+
+@click.command()
+@click.option("--users", default=10000, show_default=True, help="Users per region")
+@click.option("--groups", default=2500, show_default=True, help="Groups per region")
+@click.option("--transactions", default=100000, show_default=True, help="Transactions per region")
+@click.option("--items", default=50, show_default=True, help="Size of the item catalog")
+@click.option("--multi-region-ratio", default=0.3, show_default=True)
+@click.option("--cross-region-ratio", default=0.4, show_default=True,
+              help="Chance that a multi region group member lives in another region")
+@click.option("--group-skew", default=1.1, show_default=True, help="Zipf exponent of group popularity")
+@click.option("--user-skew", default=1.5, show_default=True, help="Pareto shape of user activity")
+@click.option("--days", default=730, show_default=True, help="Length of the transaction history")
+@click.option("--end-date", type=click.DateTime(["%Y-%m-%d"]), default="2026-01-01", show_default=True,
+              help="Date the transaction history ends at, fixed so that a seed always yields the same data")
+@click.option("--max-basket", default=12, show_default=True)
+@click.option("--batch-size", default=50000, show_default=True)
+@click.option("--seed", default=1, show_default=True)
+def main(users, groups, transactions, items, multi_region_ratio, cross_region_ratio, group_skew, user_skew, days,
+         end_date, max_basket, batch_size, seed):
+    """Bulk load a deterministic data set into every configured region"""
+    regions = list(DB_CONNECTION)
+    engines = {region: DB_CONNECTION[region].engine for region in regions}
+    for region in regions:
+        Base.metadata.create_all(engines[region])
+        with engines[region].begin() as conn:
+            # every month of the history gets its partition instead of filling the default partition
+            partitions.ensure_partitions(conn, utils.PARTITION_MONTHS_AHEAD, start=end_date - timedelta(days=days))
+        with DB_CONNECTION[region].get_session() as session:
+            add_items(session)
+
+    generator = Generator(regions, engines, seed, users, groups, transactions, items, multi_region_ratio,
+                          cross_region_ratio, group_skew, user_skew, days, end_date, max_basket, batch_size)
+    started_at = time.perf_counter()
+    for step in (generator.load_items, generator.load_users, generator.build_memberships,
+                 generator.load_transactions, generator.load_groups):
+        step_started_at = time.perf_counter()
+        step()
+        click.echo(f"{step.__name__:<20} {time.perf_counter() - step_started_at:8.1f}s")
+    for engine in engines.values():
+        finalize(engine)
+
+    elapsed = time.perf_counter() - started_at
+    total = sum(generator.counts.values())
+    for name, count in generator.counts.items():
+        click.echo(f"{name:<20} {count:>12,} rows")
+    click.echo(f"{total:,} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""End-to-end load generator for the user and transaction services.
+
+Replays realistic flows (signup, login, group creation, cross-region member additions, item browsing and
+transactions against hot groups) at a target request rate and reports per endpoint throughput, latency
+percentiles and error rates. Run it from the repository root:
+
+    python -m benchmark.load_test run \\
+        --region EUW=http://127.0.0.1:5001,http://127.0.0.1:5002 \\
+        --region USW=http://127.0.0.1:5003,http://127.0.0.1:5004 \\
+        --rate 50 --duration 60 --output after.json
+    python -m benchmark.load_test compare before.json after.json
+
+Each --region takes the user service URL followed by the transaction service URL of that region.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+import click
+import requests
+from requests.adapters import HTTPAdapter
+
+from benchmark.stats import LatencyStats, print_summary, compare_summaries, print_comparison, load_summary
+
+STORES = ["Dublin Central", "Galway Docks", "Cork Quay", "San Francisco Mission", "Seattle Pike", "Portland Pearl"]
+
+# relative weight of each steady state operation
+OPERATION_MIX = {
+    "browse_items": 30,
+    "view_memberships": 15,
+    "view_group": 20,
+    "purchase": 30,
+    "new_user": 5,
+}
+
+MAX_GROUP_MEMBERS = 4
+
+
+@dataclass
+class RegionEndpoints:
+    user_url: str
+    transaction_url: str
+
+
+@dataclass
+class VirtualUser:
+    username: str
+    password: str
+    region: str
+    token: str = None
+    user_id: int = None
+
+
+@dataclass
+class LoadGroup:
+    name: str
+    region: str
+    multi_region: bool
+    owner: VirtualUser
+    group_id: int = None
+    members: list = field(default_factory=list)
+
+
+class LoadClient:
+    """Issues requests through one keep-alive session per worker thread and records every outcome"""
+
+    def __init__(self, stats, timeout):
+        self.stats = stats
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=8))
+            self._local.session = session
+        return session
+
+    def call(self, endpoint, method, url, user=None, scheduled_at=None, **kwargs):
+        headers = kwargs.pop("headers", {})
+        if user is not None and user.token:
+            headers["Authorization"] = f"Bearer {user.token}"
+        # measure from the intended start time so a backed up generator doesn't hide server queueing
+        started_at = scheduled_at if scheduled_at is not None else time.perf_counter()
+        try:
+            response = self._session().request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+            status = response.status_code
+        except requests.RequestException as e:
+            response = None
+            status = type(e).__name__
+        self.stats.record(endpoint, (time.perf_counter() - started_at) * 1000, status)
+        return response
+
+
+class Workload:
+    def __init__(self, regions, client, rng, run_id, skew, max_basket, cross_region_ratio, redeem_ratio):
+        self.regions = regions
+        self.client = client
+        self.rng = rng
+        self.run_id = run_id
+        self.skew = skew
+        self.max_basket = max_basket
+        self.cross_region_ratio = cross_region_ratio
+        self.redeem_ratio = redeem_ratio
+        self.users = []
+        self.groups = []
+        self.item_ids = []
+        self._group_weights = []
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _next_name(self, prefix):
+        with self._lock:
+            self._counter += 1
+            return f"lt{self.run_id}_{prefix}{self._counter}"
+
+    def _endpoints(self, region):
+        return self.regions[region]
+
+    # flows
+
+    def signup_and_login(self, region, scheduled_at=None):
+        user = VirtualUser(self._next_name("user"), uuid.uuid4().hex[:12], region)
+        response = self.client.call("POST /user/signup", "POST", f"{self._endpoints(region).user_url}/user/signup",
+                                    json={"username": user.username, "password": user.password},
+                                    scheduled_at=scheduled_at)
+        if response is None or response.status_code != 201:
+            return None
+        user.user_id = response.json().get("user_id")
+        return user if self.login(user) else None
+
+    def login(self, user):
+        response = self.client.call("POST /user/login", "POST", f"{self._endpoints(user.region).user_url}/user/login",
+                                    json={"username": user.username, "password": user.password,
+                                          "region": user.region})
+        if response is None or response.status_code != 200:
+            return False
+        user.token = response.json().get("access_token")
+        return True
+
+    def _authenticated_call(self, endpoint, method, url, user, scheduled_at=None, **kwargs):
+        response = self.client.call(endpoint, method, url, user=user, scheduled_at=scheduled_at, **kwargs)
+        # tokens expire during long runs, log in again once and retry
+        if response is not None and response.status_code == 401 and self.login(user):
+            response = self.client.call(endpoint, method, url, user=user, **kwargs)
+        return response
+
+    def create_group(self, owner, multi_region):
+        group = LoadGroup(self._next_name("group"), owner.region, multi_region, owner)
+        response = self._authenticated_call(
+            "POST /group/add", "POST", f"{self._endpoints(owner.region).user_url}/group/add", owner,
+            json={"name": group.name, "region": group.region, "multi_region": "true" if multi_region else "false"})
+        if response is None or response.status_code != 201:
+            return None
+        group.group_id = response.json().get("group_id")
+        group.members.append(owner)
+        return group
+
+    def add_member(self, group, member):
+        response = self._authenticated_call(
+            "POST /group/add-member", "POST", f"{self._endpoints(group.region).user_url}/group/add-member",
+            group.owner,
+            json={"group_name": group.name, "member_user_name": member.username, "region": group.region,
+                  "member_region": member.region})
+        if response is not None and response.status_code == 201:
+            group.members.append(member)
+            return True
+        return False
+
+    def browse_items(self, rng, scheduled_at=None):
+        region = rng.choice(list(self.regions))
+        response = self.client.call("GET /item/all", "GET", f"{self._endpoints(region).transaction_url}/item/all",
+                                    scheduled_at=scheduled_at)
+        if response is not None and response.status_code == 200 and not self.item_ids:
+            self.item_ids = [item["item_id"] for item in response.json()]
+
+    def view_memberships(self, rng, scheduled_at=None):
+        user = rng.choice(self.users)
+        self._authenticated_call("GET /user/memberships", "GET",
+                                 f"{self._endpoints(user.region).user_url}/user/memberships", user,
+                                 scheduled_at=scheduled_at, params={"region": user.region})
+
+    def view_group(self, rng, scheduled_at=None):
+        group = self._hot_group(rng)
+        member = rng.choice(group.members)
+        self._authenticated_call("GET /group/<id>", "GET",
+                                 f"{self._endpoints(member.region).user_url}/group/{group.group_id}", member,
+                                 scheduled_at=scheduled_at, params={"region": group.region})
+
+    def purchase(self, rng, scheduled_at=None):
+        group = self._hot_group(rng)
+        member = rng.choice(group.members)
+        basket_size = min(self.max_basket, 1 + int(rng.expovariate(0.6)))
+        items = [{"item_id": item_id, "quantity": rng.randint(1, 3)}
+                 for item_id in rng.sample(self.item_ids, min(basket_size, len(self.item_ids)))]
+        points_redeemed = 1 if rng.random() < self.redeem_ratio else 0
+        self._authenticated_call("POST /transaction/add", "POST",
+                                 f"{self._endpoints(member.region).transaction_url}/transaction/add", member,
+                                 scheduled_at=scheduled_at,
+                                 json={"group_id": group.group_id, "store": rng.choice(STORES),
+                                       "points_redeemed": points_redeemed, "items": items,
+                                       "region": member.region})
+
+    def new_user(self, rng, scheduled_at=None):
+        user = self.signup_and_login(rng.choice(list(self.regions)), scheduled_at=scheduled_at)
+        if user is not None:
+            with self._lock:
+                self.users.append(user)
+
+    def _hot_group(self, rng):
+        # zipf like popularity, a handful of groups receive most of the traffic
+        return rng.choices(self.groups, weights=self._group_weights)[0]
+
+    # phases
+
+    def setup(self, user_count, group_count, multi_region_ratio, executor):
+        region_names = list(self.regions)
+        futures = [executor.submit(self.signup_and_login, region_names[i % len(region_names)])
+                   for i in range(user_count)]
+        self.users = [user for user in (f.result() for f in futures) if user is not None]
+        if len(self.users) < group_count:
+            raise click.ClickException(f"Only {len(self.users)} users could sign up and log in")
+
+        owners = self.users[:group_count]
+        futures = [executor.submit(self.create_group, owner, self.rng.random() < multi_region_ratio)
+                   for owner in owners]
+        self.groups = [group for group in (f.result() for f in futures) if group is not None]
+        if not self.groups:
+            raise click.ClickException("No group could be created")
+
+        # members are added one group at a time to respect the group size limit
+        candidates = self.users[group_count:] or self.users
+        memberships = []
+        for group in self.groups:
+            wanted = self.rng.randint(0, MAX_GROUP_MEMBERS - 1)
+            for _ in range(wanted):
+                cross_region = group.multi_region and self.rng.random() < self.cross_region_ratio
+                pool = [user for user in candidates if (user.region != group.region) == cross_region]
+                if pool:
+                    memberships.append((group, self.rng.choice(pool)))
+        wait([executor.submit(self.add_member, group, member) for group, member in memberships])
+
+        self._group_weights = [1 / (rank + 1) ** self.skew for rank in range(len(self.groups))]
+        self.browse_items(self.rng)
+        if not self.item_ids:
+            raise click.ClickException("Could not load the item catalog")
+
+    def run(self, rate, duration, executor):
+        operations = list(OPERATION_MIX)
+        weights = list(OPERATION_MIX.values())
+        futures = []
+        started_at = time.perf_counter()
+        next_at = started_at
+        while next_at - started_at < duration:
+            now = time.perf_counter()
+            if next_at > now:
+                time.sleep(next_at - now)
+            operation = getattr(self, self.rng.choices(operations, weights=weights)[0])
+            # every operation draws from its own generator so runs stay reproducible under concurrency
+            futures.append(executor.submit(operation, random.Random(self.rng.random()), scheduled_at=next_at))
+            # poisson arrivals at the target rate (open loop)
+            next_at += self.rng.expovariate(rate)
+        wait(futures)
+        return time.perf_counter() - started_at
+
+
+def parse_regions(values):
+    regions = {}
+    for value in values:
+        try:
+            name, urls = value.split("=", 1)
+            user_url, transaction_url = urls.split(",")
+        except ValueError:
+            raise click.BadParameter(f"expected REGION=USER_URL,TRANSACTION_URL, got '{value}'")
+        regions[name] = RegionEndpoints(user_url.rstrip("/"), transaction_url.rstrip("/"))
+    return regions
+
+
+@click.group()
+def cli():
+    """Load testing harness for the cafe services"""
+    pass
+
+
+@cli.command()
+@click.option("--region", "region_values", multiple=True, required=True,
+              help="REGION=USER_URL,TRANSACTION_URL, repeat for every region")
+@click.option("--rate", default=20.0, show_default=True, help="Target requests per second")
+@click.option("--duration", default=30.0, show_default=True, help="Steady state duration in seconds")
+@click.option("--users", "user_count", default=60, show_default=True)
+@click.option("--groups", "group_count", default=15, show_default=True)
+@click.option("--multi-region-ratio", default=0.5, show_default=True)
+@click.option("--cross-region-ratio", default=0.5, show_default=True,
+              help="Share of multi region group members that live in another region")
+@click.option("--skew", default=1.1, show_default=True, help="Zipf exponent of group popularity")
+@click.option("--max-basket", default=8, show_default=True)
+@click.option("--redeem-ratio", default=0.05, show_default=True)
+@click.option("--concurrency", default=64, show_default=True, help="Maximum in-flight requests")
+@click.option("--timeout", default=10.0, show_default=True, help="Per request timeout in seconds")
+@click.option("--seed", default=1, show_default=True)
+@click.option("--output", type=click.Path(dir_okay=False), help="Write the results as JSON")
+def run(region_values, rate, duration, user_count, group_count, multi_region_ratio, cross_region_ratio, skew,
+        max_basket, redeem_ratio, concurrency, timeout, seed, output):
+    """Set up users and groups, then replay the operation mix at the target rate"""
+    regions = parse_regions(region_values)
+    rng = random.Random(seed)
+    run_id = uuid.uuid4().hex[:6]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        setup_stats = LatencyStats()
+        workload = Workload(regions, LoadClient(setup_stats, timeout), rng, run_id, skew, max_basket,
+                            cross_region_ratio, redeem_ratio)
+        click.echo(f"Setting up {user_count} users and {group_count} groups (run {run_id})...")
+        setup_started_at = time.perf_counter()
+        workload.setup(user_count, group_count, multi_region_ratio, executor)
+        setup_summary = setup_stats.summary(time.perf_counter() - setup_started_at)
+        print_summary(setup_summary)
+
+        click.echo(f"\nRunning at {rate} rps for {duration}s...")
+        steady_stats = LatencyStats()
+        workload.client = LoadClient(steady_stats, timeout)
+        elapsed = workload.run(rate, duration, executor)
+        steady_summary = steady_stats.summary(elapsed)
+        print_summary(steady_summary)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({
+                "run_id": run_id,
+                "config": {"rate": rate, "duration": duration, "users": user_count, "groups": group_count,
+                           "multi_region_ratio": multi_region_ratio, "cross_region_ratio": cross_region_ratio,
+                           "skew": skew, "max_basket": max_basket, "redeem_ratio": redeem_ratio,
+                           "concurrency": concurrency, "seed": seed},
+                "setup": setup_summary,
+                **steady_summary,
+            }, f, indent=2)
+
+
+@cli.command()
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False))
+@click.argument("candidate", type=click.Path(exists=True, dir_okay=False))
+def compare(baseline, candidate):
+    """Show latency and error deltas between two result files"""
+    print_comparison(compare_summaries(load_summary(baseline), load_summary(candidate)))
+
+
+if __name__ == "__main__":
+    cli()
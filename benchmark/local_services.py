@@ -0,0 +1,110 @@
+"""Start the user and transaction services of every region on one machine.
+
+Each region needs a local PostgreSQL database (one instance per region, or one instance with a database per
+region):
+
+    python -m benchmark.local_services --db EUW=127.0.0.1:5430 --db USW=127.0.0.1:5440
+
+The services listen on consecutive ports starting at --base-port and the matching load_test --region
+arguments are printed once everything answers its health check. Requests for another region are forwarded to
+that region's services, --no-forwarding queries the other regions' databases directly instead.
+"""
+import os
+import subprocess
+import sys
+import time
+
+import click
+import requests
+
+SERVICES = (("user", "user_service.py"), ("transaction", "transaction_service.py"))
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def region_environment(databases, user, password, database):
+    env = {"REGIONS": ",".join(databases)}
+    for region, address in databases.items():
+        host, port = address.rsplit(":", 1)
+        env.update({
+            f"{region}_DB_HOSTS": host,
+            f"{region}_DB_PORTS": port,
+            f"{region}_DB_USER": user,
+            f"{region}_DB_PASSWORD": password,
+            f"{region}_DB_DATABASE": database,
+        })
+    return env
+
+
+def api_environment(regions, base_port):
+    """{REGION}_{SERVICE}_API_URL of every service, in the order main starts them"""
+    env = {}
+    port = base_port
+    for region in regions:
+        for service, _ in SERVICES:
+            env[f"{region}_{service.upper()}_API_URL"] = f"http://127.0.0.1:{port}"
+            port += 1
+    return env
+
+
+def wait_until_healthy(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/healthcheck", timeout=1).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+@click.command()
+@click.option("--db", "db_values", multiple=True, required=True, help="REGION=HOST:PORT, repeat for every region")
+@click.option("--db-user", default="postgres", show_default=True)
+@click.option("--db-password", default="password", show_default=True)
+@click.option("--db-name", default="cafe_mojo", show_default=True)
+@click.option("--base-port", default=5001, show_default=True)
+@click.option("--startup-timeout", default=60.0, show_default=True)
+@click.option("--forwarding/--no-forwarding", default=True, show_default=True,
+              help="Forward requests for another region to its services")
+def main(db_values, db_user, db_password, db_name, base_port, startup_timeout, forwarding):
+    """Run every region's services locally until interrupted"""
+    databases = dict(value.split("=", 1) for value in db_values)
+    base_env = {**os.environ, **region_environment(databases, db_user, db_password, db_name)}
+    if forwarding:
+        base_env.update(api_environment(databases, base_port))
+
+    processes = []
+    region_args = []
+    port = base_port
+    try:
+        for region in databases:
+            urls = []
+            for service, script in SERVICES:
+                env = {**base_env, "REGION_ID": region, "API_PORT": str(port)}
+                processes.append(subprocess.Popen([sys.executable, script], cwd=ROOT_DIR, env=env))
+                url = f"http://127.0.0.1:{port}"
+                # services create tables and seed items on startup, start them one at a time
+                if not wait_until_healthy(url, startup_timeout):
+                    raise click.ClickException(f"{url} did not become healthy")
+                urls.append(url)
+                port += 1
+            region_args.append(f"--region {region}={','.join(urls)}")
+
+        click.echo("All services are up, load test with:")
+        click.echo(f"  python -m benchmark.load_test run {' '.join(region_args)}")
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+        raise click.ClickException("A service exited unexpectedly")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
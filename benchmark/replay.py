@@ -0,0 +1,241 @@
+"""Replay traffic captured by the services and compare the latency and errors of two builds.
+
+With CAPTURE_DIR set the services record the requests they serve (see api/capture.py). run re-issues them against
+the services of every region at their original pace, or --speed times faster, keeping their arrival times and so how
+many are in flight at once, and reports per route throughput, latency percentiles and error rates like load_test:
+
+    python -m benchmark.replay run /captures --region EUW=http://127.0.0.1:5001,http://127.0.0.1:5002 \\
+        --region USW=http://127.0.0.1:5003,http://127.0.0.1:5004 --speed 2 --output after.json
+    python -m benchmark.replay compare before.json after.json --max-regression 10
+
+Requests of signed in callers are sent with a token minted with JWT_KEY for the captured identity, the deployment
+needs the same JWT_KEY and the users of the capture, e.g. a restored copy of its databases. Requests whose
+credentials were redacted (logins, signups) or whose body was not kept are skipped, as are server-sent event
+streams, which only end when their client leaves. Idempotency keys are replaced per run so that a second replay
+against the same database is not answered with the first one's stored responses. Replayed requests carry
+X-Replay-Run and are not captured again.
+"""
+import glob
+import gzip
+import json
+import os
+import time
+import uuid
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import click
+from flask import Flask
+from flask_jwt_extended import JWTManager, create_access_token
+
+from benchmark.load_test import LoadClient, parse_regions
+from benchmark.stats import LatencyStats, compare_summaries, load_summary, print_comparison, print_summary
+
+
+def capture_files(paths):
+    files = []
+    for path in paths:
+        files.extend(sorted(glob.glob(os.path.join(path, "*.ndjson.gz"))) if os.path.isdir(path) else [path])
+    return files
+
+
+def read_records(paths):
+    """Captured requests of every file, by arrival time"""
+    records = []
+    for path in capture_files(paths):
+        try:
+            with gzip.open(path, "rt") as f:
+                for line in f:
+                    records.append(json.loads(line))
+        except (EOFError, zlib.error, json.JSONDecodeError) as e:
+            # the last batch of a process that was killed while writing it
+            click.echo(f"{path} ends early ({e}), replaying the requests before", err=True)
+    records.sort(key=lambda record: record["time"])
+    return records
+
+
+def skip_reason(record, regions):
+    if record["region"] not in regions:
+        return f"region {record['region']} has no --region"
+    if record["body_state"] == "redacted":
+        return "credentials redacted"
+    if record["body_state"] != "complete":
+        return "body not captured"
+    if record["headers"].get("Accept") == "text/event-stream":
+        return "event stream"
+    return None
+
+
+def route(record):
+    return record["endpoint"] or f"{record['method']} {record['path']}"
+
+
+class Tokens:
+    """Access tokens for captured identities, signed the way the services sign them"""
+
+    def __init__(self, key):
+        self._app = Flask(__name__)
+        self._app.config["JWT_SECRET_KEY"] = key
+        JWTManager(self._app)
+        self._tokens = {}
+
+    def __call__(self, identity):
+        if identity not in self._tokens:
+            with self._app.app_context():
+                # a replay can outlast the services' default expiry
+                self._tokens[identity] = create_access_token(identity=identity, expires_delta=False)
+        return self._tokens[identity]
+
+
+class Replay:
+    def __init__(self, regions, client, tokens, run_id, replay_header):
+        self.regions = regions
+        self.client = client
+        self.tokens = tokens
+        self.run_id = run_id
+        self.replay_header = replay_header
+
+    def request(self, record, scheduled_at):
+        endpoints = self.regions[record["region"]]
+        base_url = endpoints.user_url if record["service"] == "user" else endpoints.transaction_url
+        url = f"{base_url}{record['path']}?{record['query']}" if record["query"] else f"{base_url}{record['path']}"
+        headers = {**record["headers"], self.replay_header: self.run_id}
+        if record["identity"] is not None:
+            headers["Authorization"] = f"Bearer {self.tokens(record['identity'])}"
+        if "Idempotency-Key" in headers:
+            # retries within the capture still share a key
+            key = f"{self.run_id}:{headers['Idempotency-Key']}"
+            headers["Idempotency-Key"] = str(uuid.uuid5(uuid.NAMESPACE_URL, key))
+        body = record["body"].encode() if record["body"] is not None else None
+        self.client.call(route(record), record["method"], url, scheduled_at=scheduled_at, headers=headers, data=body)
+
+    def run(self, records, speed, executor):
+        """Send every record at its capture time divided by speed, returns the elapsed seconds and the largest
+        delay in sending a request"""
+        futures = []
+        max_lag = 0
+        started_at = time.perf_counter()
+        first = records[0]["time"]
+        for record in records:
+            scheduled_at = started_at + (record["time"] - first) / speed
+            now = time.perf_counter()
+            if scheduled_at > now:
+                time.sleep(scheduled_at - now)
+            else:
+                max_lag = max(max_lag, now - scheduled_at)
+            # latency counts from the scheduled time, a replay that can't keep up shows as slower responses
+            futures.append(executor.submit(self.request, record, scheduled_at))
+        wait(futures)
+        return time.perf_counter() - started_at, max_lag
+
+
+def captured_summary(records):
+    """Latency and errors the services answered the replayed requests with when they were captured"""
+    stats = LatencyStats()
+    for record in records:
+        stats.record(route(record), record["duration_ms"], record["status"])
+    # a capture of a single request has no duration
+    return stats.summary(max(records[-1]["time"] - records[0]["time"], 0.001))
+
+
+@click.group()
+def cli():
+    """Replay captured traffic"""
+    pass
+
+
+@cli.command()
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("--region", "region_values", multiple=True, required=True,
+              help="REGION=USER_URL,TRANSACTION_URL, repeat for every region")
+@click.option("--speed", default=1.0, show_default=True, help="Replay this many times faster than captured")
+@click.option("--duration", type=float, help="Only replay the first seconds of the capture")
+@click.option("--concurrency", default=256, show_default=True, help="Maximum in-flight requests")
+@click.option("--timeout", default=30.0, show_default=True, help="Per request timeout in seconds")
+@click.option("--output", type=click.Path(dir_okay=False), help="Write the results as JSON")
+def run(paths, region_values, speed, duration, concurrency, timeout, output):
+    """Re-issue the captured requests of PATHS (files or capture directories)"""
+    if speed <= 0:
+        raise click.BadParameter("must be positive", param_hint="--speed")
+    # the settings module needs a region, nothing connects to it
+    if "REGIONS" not in os.environ:
+        os.environ.update({"REGIONS": "EUW", "EUW_DB_URLS": "sqlite://"})
+    import utils
+    from api.capture import REPLAY_HEADER
+
+    regions = parse_regions(region_values)
+    records = read_records(paths)
+    if duration is not None and records:
+        records = [record for record in records if record["time"] - records[0]["time"] <= duration]
+    skipped = Counter()
+    replayed = []
+    for record in records:
+        reason = skip_reason(record, regions)
+        if reason is None:
+            replayed.append(record)
+        else:
+            skipped[reason] += 1
+    for reason, count in skipped.most_common():
+        click.echo(f"Skipping {count} requests: {reason}")
+    if not replayed:
+        raise click.ClickException("No requests to replay")
+
+    captured = captured_summary(replayed)
+    click.echo(f"Captured ({len(replayed)} requests over {captured['elapsed_seconds']:.1f}s):")
+    print_summary(captured)
+
+    run_id = uuid.uuid4().hex[:6]
+    tokens = Tokens(utils.JWT_KEY)
+    # signed before the clock starts
+    for identity in {record["identity"] for record in replayed if record["identity"] is not None}:
+        tokens(identity)
+    stats = LatencyStats()
+    click.echo(f"\nReplaying at {speed}x (run {run_id})...")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        replay = Replay(regions, LoadClient(stats, timeout), tokens, run_id, REPLAY_HEADER)
+        elapsed, max_lag = replay.run(replayed, speed, executor)
+    summary = stats.summary(elapsed)
+    print_summary(summary)
+    if max_lag > 0.1:
+        click.echo(f"Requests were sent up to {max_lag * 1000:.0f}ms late, raise --concurrency or lower --speed")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({
+                "run_id": run_id,
+                "config": {"paths": list(paths), "speed": speed, "duration": duration, "concurrency": concurrency,
+                           "timeout": timeout},
+                "skipped": dict(skipped),
+                "max_send_lag_ms": max_lag * 1000,
+                "captured": captured,
+                **summary,
+            }, f, indent=2)
+
+
+@cli.command()
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False))
+@click.argument("candidate", type=click.Path(exists=True, dir_okay=False))
+@click.option("--max-regression", type=float, help="Allowed p50 slowdown of a route in percent before failing")
+@click.option("--max-error-increase", type=float, help="Allowed error rate increase of a route in percentage points")
+def compare(baseline, candidate, max_regression, max_error_increase):
+    """Show latency and error deltas between two replays, optionally failing when a route regressed"""
+    before, after = load_summary(baseline), load_summary(candidate)
+    deltas = compare_summaries(before, after)
+    print_comparison(deltas)
+
+    regressions = []
+    for endpoint, delta in deltas.items():
+        if "only_in" in delta:
+            continue
+        p50 = before["endpoints"][endpoint]["latency_ms"]["p50"]
+        if max_regression is not None and p50 and delta["p50"] / p50 * 100 > max_regression:
+            regressions.append(f"{endpoint} p50 {delta['p50'] / p50 * 100:+.1f}%")
+        if max_error_increase is not None and delta["error_rate"] * 100 > max_error_increase:
+            regressions.append(f"{endpoint} errors {delta['error_rate'] * 100:+.2f}pp")
+    if regressions:
+        raise click.ClickException(f"Regressed: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,109 @@
+"""CPU time and bytes on the wire of the API's JSON responses.
+
+Representative payloads (the menu, a user's memberships, group details, a page of transaction history with its
+items and a page of the change feed) are encoded with Flask's json module and with orjson, then compressed with
+gzip and, when it is installed, brotli, at the levels the services use:
+
+    python -m benchmark.serialization_bench --rows 100 --output serialization.json
+
+Set GZIP_COMPRESSION_LEVEL or BROTLI_QUALITY to try other levels.
+"""
+import gzip
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+import click
+
+ITEMS = ["Coffee Latte", "Coffee Espresso", "Cake", "Cookies", "Bagel", "Tea", "Hot Chocolate", "Muffin"]
+
+
+def payloads(rows, rng):
+    """Payloads shaped like the responses of the busiest routes"""
+    now = datetime.now()
+    transactions = []
+    for i in range(rows):
+        lines = [{"transaction_id": 10000000 + i, "item_id": rng.randint(1, len(ITEMS)),
+                  "quantity": rng.randint(1, 3), "item_total": rng.choice([1.5, 3.0, 8.0]) * rng.randint(1, 3)}
+                 for _ in range(rng.randint(1, 5))]
+        total = sum(line["item_total"] for line in lines)
+        transactions.append({
+            "transaction_id": 10000000 + i, "user_id": rng.randrange(10000000, 99999999),
+            "group_id": rng.randrange(10000000, 99999999), "timestamp": now - timedelta(minutes=i),
+            "store": f"store_{rng.randint(1, 50)}", "total": total, "points_redeemed": 0,
+            "points_awarded": int(total // 10), "items": lines,
+        })
+    events = [{"event_id": 1000 + i, "created_at": now - timedelta(seconds=i), "kind": "transaction.created",
+               "group_id": transaction["group_id"], "user_id": transaction["user_id"],
+               "payload": {key: value for key, value in transaction.items() if key not in ("timestamp", "items")}}
+              for i, transaction in enumerate(transactions)]
+    return {
+        "items": [{"item_id": i, "name": name, "price": rng.choice([1.5, 3.0, 8.0])}
+                  for i, name in enumerate(ITEMS, 1)],
+        "memberships": {"multi_region": [rng.randrange(10000000, 99999999) for _ in range(3)],
+                        "single_region": [{"group_id": rng.randrange(10000000, 99999999), "name": f"group_{i}",
+                                           "owner_id": rng.randrange(10000000, 99999999)} for i in range(5)]},
+        "group_details": {"group_id": 44205491, "name": "group_1", "owner_id": 31195177, "points": 230,
+                          "members": [31195177, 67131657, 50816059]},
+        "transaction_history": {"transactions": transactions, "next_cursor": "WyIyMDI2LTEwLTE5VDEyOjAwOjAwIiwgMV0="},
+        "change_events": {"events": events, "next_cursor": events[-1]["event_id"] if events else 0},
+    }
+
+
+def cpu_per_call(function, argument, iterations):
+    started = time.process_time()
+    for _ in range(iterations):
+        result = function(argument)
+    return (time.process_time() - started) * 1000 / iterations, result
+
+
+@click.command()
+@click.option("--rows", default=100, show_default=True, help="Transactions and events per history and feed page")
+@click.option("--iterations", default=2000, show_default=True)
+@click.option("--seed", default=1, show_default=True)
+@click.option("--output", type=click.Path(dir_okay=False), help="Write the results as JSON")
+def main(rows, iterations, seed, output):
+    """Measure encoding and compression of representative responses"""
+    # the settings module needs a region, nothing connects to it
+    if "REGIONS" not in os.environ:
+        os.environ.update({"REGIONS": "EUW", "EUW_DB_URLS": "sqlite://"})
+    import utils
+    from api.serialization import JSONProvider, brotli, orjson
+    from flask import Flask
+
+    app = Flask(__name__)
+    encoders = {"json": JSONProvider(app)}
+    encoders["json"].fast = False
+    if orjson is not None:
+        encoders["orjson"] = JSONProvider(app)
+        encoders["orjson"].fast = True
+    compressors = {"gzip": lambda data: gzip.compress(data, compresslevel=utils.GZIP_COMPRESSION_LEVEL)}
+    if brotli is not None:
+        compressors["br"] = lambda data: brotli.compress(data, quality=utils.BROTLI_QUALITY)
+
+    results = {}
+    for name, payload in payloads(rows, random.Random(seed)).items():
+        result = results[name] = {"encode_ms": {}, "compress_ms": {}, "bytes": {}}
+        for encoder, provider in encoders.items():
+            result["encode_ms"][encoder], body = cpu_per_call(provider.encode, payload, iterations)
+        result["bytes"]["identity"] = len(body)
+        for compressor, compress in compressors.items():
+            result["compress_ms"][compressor], compressed = cpu_per_call(compress, body, max(1, iterations // 10))
+            result["bytes"][compressor] = len(compressed)
+
+        encode = ", ".join(f"{encoder} {ms:.4f}ms" for encoder, ms in result["encode_ms"].items())
+        sizes = ", ".join(f"{encoding} {size}B" for encoding, size in result["bytes"].items())
+        compress_cpu = ", ".join(f"{compressor} {ms:.4f}ms" for compressor, ms in result["compress_ms"].items())
+        click.echo(f"{name:<20} encode: {encode}\n{'':<20} size: {sizes}\n{'':<20} compress: {compress_cpu}")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"config": {"rows": rows, "iterations": iterations, "seed": seed,
+                                  "gzip_level": utils.GZIP_COMPRESSION_LEVEL, "brotli_quality": utils.BROTLI_QUALITY},
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
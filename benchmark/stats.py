@@ -0,0 +1,101 @@
+import json
+import math
+import threading
+from collections import defaultdict
+
+import click
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    # nearest-rank percentile
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class LatencyStats:
+    """Thread safe per endpoint latency and error recorder"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(list)
+        self._statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, latency_ms, status):
+        with self._lock:
+            self._latencies[endpoint].append(latency_ms)
+            self._statuses[endpoint][str(status)] += 1
+
+    def summary(self, elapsed_seconds):
+        with self._lock:
+            endpoints = {}
+            for endpoint, latencies in sorted(self._latencies.items()):
+                latencies = sorted(latencies)
+                statuses = dict(self._statuses[endpoint])
+                # redirects and 304s of conditional requests are answers too
+                errors = sum(count for status, count in statuses.items() if status[0] not in "23")
+                endpoints[endpoint] = {
+                    "requests": len(latencies),
+                    "throughput_rps": len(latencies) / elapsed_seconds if elapsed_seconds else None,
+                    "error_rate": errors / len(latencies),
+                    "statuses": statuses,
+                    "latency_ms": {
+                        **{f"p{pct}": percentile(latencies, pct) for pct in PERCENTILES},
+                        "mean": sum(latencies) / len(latencies),
+                        "max": latencies[-1],
+                    },
+                }
+        total = sum(endpoint["requests"] for endpoint in endpoints.values())
+        return {
+            "elapsed_seconds": elapsed_seconds,
+            "requests": total,
+            "throughput_rps": total / elapsed_seconds if elapsed_seconds else None,
+            "endpoints": endpoints,
+        }
+
+
+def print_summary(summary):
+    click.echo(f"{'endpoint':<32}{'reqs':>8}{'rps':>9}{'err%':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for endpoint, stats in summary["endpoints"].items():
+        latency = stats["latency_ms"]
+        click.echo(f"{endpoint:<32}{stats['requests']:>8}{stats['throughput_rps']:>9.1f}"
+                   f"{stats['error_rate'] * 100:>8.2f}{latency['p50']:>9.1f}{latency['p90']:>9.1f}"
+                   f"{latency['p99']:>9.1f}{latency['max']:>9.1f}")
+    click.echo(f"total: {summary['requests']} requests in {summary['elapsed_seconds']:.1f}s "
+               f"({summary['throughput_rps']:.1f} rps)")
+
+
+def compare_summaries(baseline, candidate):
+    """Latency and error deltas per endpoint, candidate minus baseline"""
+    deltas = {}
+    for endpoint in sorted(set(baseline["endpoints"]) | set(candidate["endpoints"])):
+        before = baseline["endpoints"].get(endpoint)
+        after = candidate["endpoints"].get(endpoint)
+        if before is None or after is None:
+            deltas[endpoint] = {"only_in": "candidate" if before is None else "baseline"}
+            continue
+        deltas[endpoint] = {
+            "error_rate": after["error_rate"] - before["error_rate"],
+            "throughput_rps": after["throughput_rps"] - before["throughput_rps"],
+            **{key: after["latency_ms"][key] - before["latency_ms"][key]
+               for key in [f"p{pct}" for pct in PERCENTILES] + ["mean"]},
+        }
+    return deltas
+
+
+def print_comparison(deltas):
+    click.echo(f"{'endpoint':<32}{'d err%':>9}{'d p50':>10}{'d p90':>10}{'d p99':>10}{'d mean':>10}")
+    for endpoint, delta in deltas.items():
+        if "only_in" in delta:
+            click.echo(f"{endpoint:<32} only in {delta['only_in']}")
+            continue
+        click.echo(f"{endpoint:<32}{delta['error_rate'] * 100:>+9.2f}{delta['p50']:>+10.1f}"
+                   f"{delta['p90']:>+10.1f}{delta['p99']:>+10.1f}{delta['mean']:>+10.1f}")
+
+
+def load_summary(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,73 @@
+"""Read the trace spans the services export to TRACE_EXPORT_PATH.
+
+summary shows where the time goes per span name and region, database statements are counted in the region of their
+database. show prints one trace as a tree, e.g. a purchase forwarded to another region with its statements:
+
+    python -m benchmark.traces summary /traces/spans.ndjson
+    python -m benchmark.traces show /traces/spans.ndjson 4bf92f3577b34da6a3ce929d0e0e4736
+"""
+import json
+from collections import defaultdict
+
+import click
+
+from benchmark.stats import percentile
+
+
+def read_spans(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@click.group()
+def cli():
+    """Read exported trace spans"""
+    pass
+
+
+@cli.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--top", default=30, show_default=True, help="Span names to show, by total time")
+def summary(path, top):
+    """Time spent per span name and region"""
+    durations = defaultdict(list)
+    for record in read_spans(path):
+        region = record["attributes"].get("db.region") or record["region"]
+        durations[(record["name"], region)].append(record["duration_ms"])
+
+    click.echo(f"{'span':<60}{'region':>8}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'total ms':>12}")
+    for (name, region), values in sorted(durations.items(), key=lambda entry: -sum(entry[1]))[:top]:
+        values.sort()
+        click.echo(f"{name[:59]:<60}{region:>8}{len(values):>8}{percentile(values, 50):>10.2f}"
+                   f"{percentile(values, 99):>10.2f}{sum(values):>12.1f}")
+
+
+@cli.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.argument("trace_id")
+def show(path, trace_id):
+    """One trace as a tree, with each span's offset from the start of the trace"""
+    spans = [record for record in read_spans(path) if record["trace_id"] == trace_id]
+    if not spans:
+        raise click.ClickException(f"No spans of trace {trace_id} in {path}")
+    children = defaultdict(list)
+    ids = {record["span_id"] for record in spans}
+    for record in spans:
+        # spans whose parent is not in the file, e.g. the client's, are shown as roots
+        children[record["parent_id"] if record["parent_id"] in ids else None].append(record)
+    started = min(record["start"] for record in spans)
+
+    def print_tree(parent_id, depth):
+        for record in sorted(children[parent_id], key=lambda r: r["start"]):
+            attributes = " ".join(f"{key}={value}" for key, value in record["attributes"].items()
+                                  if key != "db.statement")
+            error = f" ERROR {record['error']}" if record["error"] else ""
+            click.echo(f"{(record['start'] - started) * 1000:9.2f}ms {record['duration_ms']:9.2f}ms "
+                       f"{'  ' * depth}{record['name']} [{record['region']}] {attributes}{error}")
+            print_tree(record["span_id"], depth + 1)
+
+    print_tree(None, 0)
+
+
+if __name__ == "__main__":
+    cli()
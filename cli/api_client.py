@@ -1,24 +1,87 @@
+import copy
+import json
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# a purchase is only retried with an Idempotency-Key, 409 means the first attempt is still being processed and 429
+# that it was refused before being processed
+IDEMPOTENT_RETRY_STATUSES = (409, 429, 502, 503, 504)
 
 
 class APIClient:
-    def __init__(self, transaction_service_url="http://127.0.0.1:5000", user_info_service_url="http://127.0.0.1:5000"):
+    def __init__(self, transaction_service_url="http://127.0.0.1:5000", user_info_service_url="http://127.0.0.1:5000",
+                 connect_timeout=3.05, read_timeout=10, retries=3, backoff_factor=0.3, pool_size=4,
+                 trace_sample_rate=None):
         self.transaction_service_url = transaction_service_url
         self.user_info_service_url = user_info_service_url
+        self.timeout = (connect_timeout, read_timeout)
+        self._retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 502, 503, 504),
+                            allowed_methods=frozenset({"GET", "HEAD"}), respect_retry_after_header=True,
+                            raise_on_status=False)
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+        self._pool_size = pool_size
+        # None leaves starting and sampling traces to the services
+        self._trace_sample_rate = trace_sample_rate
+        # one keep-alive session per service, both services may share a URL
+        self._sessions = {}
+        for url in {transaction_service_url, user_info_service_url}:
+            self._sessions[url] = self._create_session()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+        self._items_response = None
 
     access_token = None
 
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size, max_retries=self._retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _traced(self, headers):
+        """Headers starting a new trace (W3C traceparent), which the services record when it is sampled"""
+        if self._trace_sample_rate is None:
+            return headers
+        flags = "01" if random.random() < self._trace_sample_rate else "00"
+        return {**(headers or {}), "traceparent": f"00-{uuid.uuid4().hex}-{uuid.uuid4().hex[:16]}-{flags}"}
+
+    def _get(self, service_url, path, headers=None, **kwargs):
+        return self._sessions[service_url].get(f"{service_url}{path}", timeout=self.timeout,
+                                               headers=self._traced(headers), **kwargs)
+
+    def _post(self, service_url, path, headers=None, **kwargs):
+        return self._sessions[service_url].post(f"{service_url}{path}", timeout=self.timeout,
+                                                headers=self._traced(headers), **kwargs)
+
     def set_access_token(self, token):
         self.access_token = token
 
+    def with_token(self, token):
+        """A client acting as another user that shares this client's connection pools"""
+        client = copy.copy(self)
+        client.access_token = token
+        return client
+
+    @staticmethod
+    def _with_optional(data, **optional):
+        data.update({key: value for key, value in optional.items() if value is not None})
+        return data
+
     def signup(self, username, password):
-        response = requests.post(f"{self.user_info_service_url}/user/signup",
-                                 json={"username": username, "password": password})
+        response = self._post(self.user_info_service_url, "/user/signup",
+                              json={"username": username, "password": password})
         return response
 
     def login(self, username, password):
-        response = requests.post(f"{self.user_info_service_url}/user/login",
-                                 json={"username": username, "password": password})
+        response = self._post(self.user_info_service_url, "/user/login",
+                              json={"username": username, "password": password})
         if response.status_code == 200:
             self.access_token = response.json().get('access_token')
         return response
@@ -29,35 +92,48 @@ class APIClient:
     def get_user_memberships(self):
         """Get the community information of the currently logged-in user"""
         headers = self.get_authenticated_header()
-        response = requests.get(f"{self.user_info_service_url}/user/memberships", headers=headers)
+        response = self._get(self.user_info_service_url, "/user/memberships", headers=headers)
         return response
 
-    def create_group(self, group_name):
+    def create_group(self, group_name, multi_region=None, region=None):
         """Create a new group"""
         headers = self.get_authenticated_header()
-        data = {"name": group_name}
-        response = requests.post(f"{self.user_info_service_url}/group/add", headers=headers, json=data)
+        data = self._with_optional({"name": group_name}, multi_region=multi_region, region=region)
+        response = self._post(self.user_info_service_url, "/group/add", headers=headers, json=data)
         return response
 
-    def add_member_to_group(self, group_id, user_name):
+    def add_member_to_group(self, group_name, user_name, region=None, member_region=None):
         """Add user to group"""
         headers = self.get_authenticated_header()
-        data = {"group_id": group_id, "user_name": user_name}
-        response = requests.post(f"{self.user_info_service_url}/group/add-member", headers=headers, json=data)
+        data = self._with_optional({"group_name": group_name, "member_user_name": user_name},
+                                   region=region, member_region=member_region)
+        response = self._post(self.user_info_service_url, "/group/add-member", headers=headers, json=data)
         return response
 
     def get_group_details(self, group_id):
         """Get the details of the specified group."""
         headers = self.get_authenticated_header()
-        response = requests.get(f"{self.user_info_service_url}/group/{group_id}", headers=headers)
+        response = self._get(self.user_info_service_url, f"/group/{group_id}", headers=headers)
         return response
 
     def get_items(self):
-        """Get a list of all items"""
+        """Get a list of all items, revalidating the cached catalog instead of downloading it again"""
         headers = self.get_authenticated_header()
-        response = requests.get(f"{self.transaction_service_url}/item/all", headers=headers)
+        if self._items_response is not None and self._items_response.headers.get("ETag"):
+            headers["If-None-Match"] = self._items_response.headers["ETag"]
+        response = self._get(self.transaction_service_url, "/item/all", headers=headers)
+        if response.status_code == 304 and self._items_response is not None:
+            return self._items_response
+        if response.status_code == 200:
+            self._items_response = response
         return response
 
+    def get_items_and_group_details(self, group_id):
+        """Fetch the item catalog and the group's details concurrently"""
+        items = self._executor.submit(self.get_items)
+        group_details = self._executor.submit(self.get_group_details, group_id)
+        return items.result(), group_details.result()
+
     def add_item(self, name, price):
         """Adds a new item to the inventory"""
         headers = self.get_authenticated_header()
@@ -65,24 +141,60 @@ class APIClient:
             "name": name,
             "price": price
         }
-        response = requests.post(f"{self.transaction_service_url}/item/add", headers=headers, json=data)
+        response = self._post(self.transaction_service_url, "/item/add", headers=headers, json=data)
+        if response.status_code == 201:
+            self._items_response = None
         return response
 
-    def create_transaction(self, group_id, store, points_redeemed, items):
-        headers = self.get_authenticated_header()
-        data = {
+    def create_transaction(self, group_id, store, points_redeemed, items, region=None, idempotency_key=None):
+        """Create a transaction, every retry reuses one Idempotency-Key so the group is never charged twice"""
+        headers = {**self.get_authenticated_header(), "Idempotency-Key": idempotency_key or str(uuid.uuid4())}
+        data = self._with_optional({
             "group_id": group_id,
             "store": store,
             "points_redeemed": points_redeemed,
             "items": items
-        }
-        response = requests.post(f"{self.transaction_service_url}/transaction/add", headers=headers, json=data)
+        }, region=region)
+        for attempt in range(self._retries + 1):
+            retries_left = attempt < self._retries
+            try:
+                response = self._post(self.transaction_service_url, "/transaction/add", headers=headers, json=data)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if not retries_left:
+                    raise
+                delay = self._backoff_factor * 2 ** attempt
+            else:
+                if response.status_code not in IDEMPOTENT_RETRY_STATUSES or not retries_left:
+                    return response
+                delay = float(response.headers.get("Retry-After", self._backoff_factor * 2 ** attempt))
+            time.sleep(delay)
+
+    def create_transactions_bulk(self, transactions, region=None):
+        """Stream transaction dicts to the bulk endpoint as NDJSON"""
+        headers = {**self.get_authenticated_header(), "Content-Type": "application/x-ndjson"}
+        body = (json.dumps(transaction, default=str).encode() + b"\n" for transaction in transactions)
+        params = {"region": region} if region else None
+        response = self._post(self.transaction_service_url, "/transaction/bulk", headers=headers, params=params,
+                              data=body)
+        return response
+
+    def get_events(self, after=0, limit=None, wait=None, region=None, shard=None):
+        """Read the change feed of a region or one of its shards after an event id, long polling up to `wait` seconds
+        for new events"""
+        headers = self.get_authenticated_header()
+        params = self._with_optional({"after": after}, limit=limit, wait=wait, region=region, shard=shard)
+        timeout = (self.timeout[0], self.timeout[1] + (wait or 0))
+        response = self._sessions[self.transaction_service_url].get(f"{self.transaction_service_url}/events",
+                                                                     headers=self._traced(headers), params=params,
+                                                                     timeout=timeout)
         return response
 
     def are_services_healthy(self):
         try:
-            response_transaction_service = requests.get(f"{self.transaction_service_url}/healthcheck")
-            response_user_info_service = requests.get(f"{self.user_info_service_url}/healthcheck")
-        except requests.exceptions.ConnectionError:
+            response_transaction_service, response_user_info_service = self._executor.map(
+                lambda url: self._get(url, "/healthcheck"),
+                [self.transaction_service_url, self.user_info_service_url]
+            )
+        except requests.exceptions.RequestException:
             return False
         return response_transaction_service.status_code == 200 and response_user_info_service.status_code == 200
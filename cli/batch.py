@@ -0,0 +1,134 @@
+"""Run bulk operations read from CSV or NDJSON files through the APIClient"""
+import csv
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+import requests
+
+
+class BatchRowError(Exception):
+    pass
+
+
+def read_rows(path):
+    """Read a file of rows, NDJSON for .ndjson/.jsonl files and CSV with a header line otherwise"""
+    with open(path, newline="") as f:
+        if path.endswith((".ndjson", ".jsonl")):
+            return [json.loads(line) for line in f if line.strip()]
+        return list(csv.DictReader(f))
+
+
+def parse_items(value):
+    """Accept a list of {item_id, quantity} objects or a CSV cell like '1:2;4:1'"""
+    if isinstance(value, list):
+        return [{"item_id": int(item["item_id"]), "quantity": int(item["quantity"])} for item in value]
+    items = []
+    for entry in str(value).split(";"):
+        if entry.strip():
+            item_id, quantity = entry.split(":")
+            items.append({"item_id": int(item_id), "quantity": int(quantity)})
+    return items
+
+
+def optional(row, column):
+    """Missing columns and empty CSV cells fall back to the server's default"""
+    value = row.get(column)
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+class ActorTokens:
+    """Log every acting user in once and hand out clients carrying their token"""
+
+    def __init__(self, client, default_username, default_password):
+        self._client = client
+        self._default_username = default_username
+        self._default_password = default_password
+        self._tokens = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def anonymous(self):
+        return self._client.with_token(None)
+
+    def client_for(self, row):
+        username = row.get("username") or self._default_username
+        password = row.get("password") or self._default_password
+        if not username or not password:
+            raise BatchRowError("Row has no username/password and none were given on the command line")
+
+        with self._lock:
+            user_lock = self._locks.setdefault(username, threading.Lock())
+        with user_lock:
+            if username not in self._tokens:
+                response = self.anonymous().login(username, password)
+                self._tokens[username] = response.json().get("access_token") if response.status_code == 200 else None
+        if self._tokens[username] is None:
+            raise BatchRowError(f"Login failed for '{username}'")
+        return self._client.with_token(self._tokens[username])
+
+
+def signup_user(actors, row):
+    return actors.anonymous().signup(row["username"], row["password"])
+
+
+def create_group(actors, row):
+    return actors.client_for(row).create_group(
+        row["name"], multi_region=optional(row, "multi_region"), region=optional(row, "region")
+    )
+
+
+def add_membership(actors, row):
+    return actors.client_for(row).add_member_to_group(
+        row["group_name"], row["member"], region=optional(row, "region"), member_region=optional(row, "member_region")
+    )
+
+
+def add_item(actors, row):
+    return actors.client_for(row).add_item(row["name"], float(row["price"]))
+
+
+def create_transaction(actors, row):
+    return actors.client_for(row).create_transaction(
+        int(row["group_id"]), row["store"], int(row.get("points_redeemed") or 0), parse_items(row["items"]),
+        region=optional(row, "region"), idempotency_key=optional(row, "idempotency_key")
+    )
+
+
+def run_row(operation, actors, row):
+    try:
+        response = operation(actors, row)
+    except (BatchRowError, KeyError, ValueError) as e:
+        return {"ok": False, "status": None, "error": f"{type(e).__name__}: {e}"}
+    except requests.exceptions.RequestException as e:
+        return {"ok": False, "status": None, "error": str(e)}
+    try:
+        body = response.json()
+    except ValueError:
+        body = response.text
+    return {"ok": 200 <= response.status_code < 300, "status": response.status_code, "response": body}
+
+
+def run_batch(client, operation, input_path, results_path, concurrency, username, password):
+    """Execute one row per request with at most `concurrency` in flight, write a result line per row"""
+    rows = read_rows(input_path)
+    actors = ActorTokens(client, username, password)
+    results_path = results_path or f"{input_path}.results.ndjson"
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, open(results_path, "w") as results, \
+            click.progressbar(length=len(rows), label=f"Processing {len(rows)} rows") as progress:
+        futures = {executor.submit(run_row, operation, actors, row): number for number, row in enumerate(rows, 1)}
+        for future in as_completed(futures):
+            result = {"row": futures[future], **future.result()}
+            failed += not result["ok"]
+            results.write(json.dumps(result) + "\n")
+            progress.update(1)
+
+    click.echo(f"{len(rows) - failed} succeeded, {failed} failed, results written to {results_path}")
+    return failed
@@ -1,6 +1,7 @@
 import os
 import sys
 import click
+import batch
 from api_client import APIClient
 
 user_logged_in = False
@@ -9,21 +10,41 @@ user_info_service_url = None
 apiClient = None
 
 
-@click.group()
-def cli():
-    """Cafe CLI Tool"""
-    pass
+@click.group(invoke_without_command=True)
+@click.option("--transaction-url", envvar="CAFE_TRANSACTION_SERVICE_URL", help="Transaction service URL")
+@click.option("--user-url", envvar="CAFE_USER_SERVICE_URL", help="User info service URL")
+@click.option("--connect-timeout", default=3.05, show_default=True, help="Seconds to wait for a connection")
+@click.option("--read-timeout", default=10.0, show_default=True, help="Seconds to wait for a response")
+@click.option("--trace-sample-rate", envvar="CAFE_TRACE_SAMPLE_RATE", type=click.FloatRange(0, 1),
+              help="Start a trace for this share of the requests, the services' TRACE_SAMPLE_RATE applies without")
+@click.pass_context
+def cli(ctx, transaction_url, user_url, connect_timeout, read_timeout, trace_sample_rate):
+    """Cafe CLI Tool, interactive unless a batch command is given"""
+    ctx.obj = {
+        "transaction_url": transaction_url,
+        "user_url": user_url,
+        "client_options": {"connect_timeout": connect_timeout, "read_timeout": read_timeout,
+                           "trace_sample_rate": trace_sample_rate},
+    }
+    if ctx.invoked_subcommand is None:
+        connection_config(transaction_url, user_url, **ctx.obj["client_options"])
+        main_menu()
 
 
 def clear_screen():
     os.system('cls' if os.name == 'nt' else 'clear')
 
 
-def connection_config():
+def connection_config(transaction_url=None, user_url=None, **client_options):
     """Configure URLs for backends"""
     global transaction_service_url, user_info_service_url, apiClient
 
     service_connection_tested = False
+    if transaction_url and user_url:
+        transaction_service_url, user_info_service_url = transaction_url, user_url
+        apiClient = APIClient(transaction_service_url, user_info_service_url, **client_options)
+        service_connection_tested = apiClient.are_services_healthy()
+
     first_try = True
     while not service_connection_tested:
         clear_screen()
@@ -36,11 +57,10 @@ def connection_config():
         transaction_service_url = click.prompt("Please enter your transaction service URL", type=str)
         user_info_service_url = click.prompt("Please enter your user info service URL", type=str)
 
-        apiClient = APIClient(transaction_service_url, user_info_service_url)
+        apiClient = APIClient(transaction_service_url, user_info_service_url, **client_options)
         service_connection_tested = apiClient.are_services_healthy()
 
 
-@click.command()
 def main_menu():
     """Display the main meun."""
     global user_logged_in
@@ -162,7 +182,6 @@ def view_points_and_memberships():
 
     click.echo("\nPress any key to return to the user menu...")
     input()
-    user_menu()
 
 
 def create_group():
@@ -185,17 +204,16 @@ def create_group():
                 break
     click.echo("\nPress any key to return to the user menu...")
     input()
-    user_menu()
 
 
 def add_user_to_group():
     """Allow the current user to add another user to the group"""
     clear_screen()
     click.echo("Add user to existing group:")
-    group_id = click.prompt("Enter the group ID", type=int)
+    group_name = click.prompt("Enter the group name")
     user_name = click.prompt("Enter the username of the user you want to add to the group")
 
-    response = apiClient.add_member_to_group(group_id=group_id, user_name=user_name)
+    response = apiClient.add_member_to_group(group_name=group_name, user_name=user_name)
 
     if response.status_code == 201:
         click.echo("User successfully added to the group.")
@@ -209,7 +227,6 @@ def add_user_to_group():
 
     click.echo("\nPress any key to return to the user menu...")
     input()
-    user_menu()
 
 
 def view_group_info():
@@ -232,7 +249,6 @@ def view_group_info():
 
     click.echo("\nPress any key to return to the user menu...")
     input()
-    user_menu()
 
 
 def create_transaction():
@@ -243,8 +259,14 @@ def create_transaction():
     store = click.prompt("Enter the store name")
     # points_redeemed = click.prompt("Enter points to redeem (enter 0 if not using points)", type=int)
 
+    # the catalog and the group's points do not depend on each other, fetch them together
+    items_response, group_response = apiClient.get_items_and_group_details(group_id)
+    if group_response.status_code != 200:
+        click.echo("Failed to fetch group details. Please try again later.")
+        return
+
     click.echo("Available items:")
-    available_items = fetch_and_display_items()
+    available_items = fetch_and_display_items(items_response)
     if not available_items:
         click.echo("No available items to purchase.")
         return
@@ -267,14 +289,8 @@ def create_transaction():
     total_price = sum(item['price'] * item['quantity'] for item in selected_items)
     click.echo(f"Total price before points redemption: {total_price}")
 
-    response = apiClient.get_group_details(group_id)
-    if response.status_code == 200:
-        group_details = response.json()
-        group_points = group_details['points']
-        click.echo(f"Your group has {group_points} points available.")
-    else:
-        click.echo("Failed to fetch group details. Please try again later.")
-        return
+    group_points = group_response.json()['points']
+    click.echo(f"Your group has {group_points} points available.")
 
     while True:
         points_redeemed = click.prompt("Enter points to redeem (enter 0 if not using points)", type=int, default=0)
@@ -301,11 +317,11 @@ def create_transaction():
 
     click.echo("\nPress any key to return to the user menu...")
     input()
-    user_menu()
 
 
-def fetch_and_display_items():
-    response = apiClient.get_items()
+def fetch_and_display_items(response=None):
+    if response is None:
+        response = apiClient.get_items()
 
     if response.status_code == 200:
         items = response.json()
@@ -328,7 +344,6 @@ def view_item_list():
 
     click.echo("\nPress any key to return to the user menu...")
     input()
-    user_menu()
 
 
 def add_item():
@@ -372,6 +387,38 @@ def logout():
     click.echo("You have been logged out.")
 
 
+def batch_client(options, concurrency):
+    if not options["transaction_url"] or not options["user_url"]:
+        raise click.UsageError("Batch commands need --transaction-url and --user-url")
+    return APIClient(options["transaction_url"], options["user_url"], pool_size=concurrency,
+                     **options["client_options"])
+
+
+def batch_command(name, operation, description, columns):
+    @cli.command(name, help=f"{description} from a CSV or NDJSON file.\n\nColumns: {columns}")
+    @click.argument("input_file", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--concurrency", default=8, show_default=True, help="Requests in flight at once")
+    @click.option("--username", envvar="CAFE_USERNAME", help="Acting user for rows without a username column")
+    @click.option("--password", envvar="CAFE_PASSWORD", help="Password of the acting user")
+    @click.option("--results", type=click.Path(dir_okay=False),
+                  help="Per-row NDJSON result file, INPUT_FILE.results.ndjson by default")
+    @click.pass_context
+    def command(ctx, input_file, concurrency, username, password, results):
+        client = batch_client(ctx.obj, concurrency)
+        failed = batch.run_batch(client, operation, input_file, results, concurrency, username, password)
+        ctx.exit(1 if failed else 0)
+    return command
+
+
+batch_command("users", batch.signup_user, "Sign up users", "username, password")
+batch_command("groups", batch.create_group, "Create groups", "name[, multi_region, region, username, password]")
+batch_command("memberships", batch.add_membership, "Add members to groups",
+              "group_name, member[, region, member_region, username, password]")
+batch_command("items", batch.add_item, "Add items", "name, price[, username, password]")
+batch_command("transactions", batch.create_transaction, "Create transactions",
+              "group_id, store, items ('item_id:quantity;...' or a JSON list)[, points_redeemed, region, "
+              "idempotency_key, username, password]")
+
+
 if __name__ == '__main__':
-    connection_config()
-    main_menu()
+    cli()
@@ -0,0 +1,230 @@
+"""Vectorized reports over the transaction history of every region.
+
+Rows are streamed from each region with a server-side cursor in chunks of --chunk-size and aggregated as NumPy
+arrays, so memory depends on the chunk size and the size of the result, not on the number of transactions:
+
+    python -m database.analytics basket-sizes --output basket_sizes.csv
+    python -m database.analytics top-items --top 5 --from 2025-01-01 --to 2026-01-01
+    python -m database.analytics points-liability --region EUW
+    python -m database.analytics group-churn --output churn.csv
+"""
+import csv
+import logging
+
+import click
+import numpy as np
+from sqlalchemy import select
+
+import utils
+from database.models import Transaction, TransactionItem, Group, Item, DB_CONNECTION, HOME_DB_CONNECTION
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+DEFAULT_CHUNK_SIZE = 100000
+# baskets with more units are counted in the last bucket
+MAX_BASKET_SIZE = 50
+# (month, group) keys are deduplicated whenever this many have been collected
+CHURN_COMPACT_SIZE = 4000000
+LOW_32_BITS = 0xFFFFFFFF
+
+
+def stream_columns(region, statement, dtypes, chunk_size, shard=None):
+    """Yield the statement's rows as a dict of NumPy arrays per chunk, `dtypes` names the selected columns in order.
+    Runs on every shard of the region one after the other unless `shard` names one."""
+    connections = DB_CONNECTION[region].shard_connections() if shard is None else [DB_CONNECTION[region].shard(shard)]
+    for connection in connections:
+        with connection.get_session() as db_session:
+            result = db_session.execute(statement.execution_options(stream_results=True, yield_per=chunk_size))
+            for partition in result.partitions():
+                columns = zip(*partition)
+                yield {name: np.array(values, dtype=dtype) for (name, dtype), values in zip(dtypes.items(), columns)}
+
+
+def _in_period(statement, start, end, column=Transaction.timestamp):
+    if start:
+        statement = statement.where(column >= start)
+    if end:
+        statement = statement.where(column < end)
+    return statement
+
+
+def _with_items(statement, start, end):
+    """Join the item lines of the transactions, bounded on both tables so both prune their partitions"""
+    statement = statement.join(Transaction, (Transaction.transaction_id == TransactionItem.transaction_id)
+                               & (Transaction.timestamp == TransactionItem.transaction_timestamp))
+    return _in_period(_in_period(statement, start, end), start, end, TransactionItem.transaction_timestamp)
+
+
+def basket_sizes(regions, start=None, end=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Distribution of the number of units bought per transaction"""
+    counts = np.zeros(MAX_BASKET_SIZE + 1, dtype=np.int64)
+    statement = _with_items(select(TransactionItem.transaction_id, TransactionItem.quantity), start, end) \
+        .order_by(TransactionItem.transaction_id)
+
+    for region in regions:
+        # lines arrive ordered by transaction, a transaction can continue in the next chunk
+        carry_id, carry_size = None, 0
+        for chunk in stream_columns(region, statement, {"transaction_id": np.int64, "quantity": np.int64},
+                                    chunk_size):
+            ids = chunk["transaction_id"]
+            starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+            sizes = np.add.reduceat(chunk["quantity"], starts)
+            if carry_id is not None:
+                if ids[0] == carry_id:
+                    sizes[0] += carry_size
+                else:
+                    counts[min(carry_size, MAX_BASKET_SIZE)] += 1
+            carry_id, carry_size = ids[-1], int(sizes[-1])
+            counts += np.bincount(np.minimum(sizes[:-1], MAX_BASKET_SIZE), minlength=MAX_BASKET_SIZE + 1)
+        if carry_id is not None:
+            counts[min(carry_size, MAX_BASKET_SIZE)] += 1
+
+    total = counts.sum()
+    shares = counts / total if total else counts.astype(float)
+    cumulative = np.cumsum(shares)
+    return [
+        {"basket_size": f"{size}+" if size == MAX_BASKET_SIZE else size, "transactions": int(counts[size]),
+         "share": round(float(shares[size]), 6), "cumulative_share": round(float(cumulative[size]), 6)}
+        for size in np.flatnonzero(counts)
+    ]
+
+
+def top_items(regions, top=10, start=None, end=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Best selling items of every store by units sold"""
+    totals = {}
+    statement = _with_items(
+        select(Transaction.store, TransactionItem.item_id, TransactionItem.quantity, TransactionItem.item_total),
+        start, end
+    )
+    dtypes = {"store": object, "item_id": np.int64, "quantity": np.int64, "item_total": np.float64}
+
+    for region in regions:
+        for chunk in stream_columns(region, statement, dtypes, chunk_size):
+            stores, store_codes = np.unique(chunk["store"].astype(str), return_inverse=True)
+            keys = store_codes.astype(np.int64) << 32 | chunk["item_id"]
+            unique_keys, inverse = np.unique(keys, return_inverse=True)
+            quantities = np.bincount(inverse, weights=chunk["quantity"])
+            revenues = np.bincount(inverse, weights=chunk["item_total"])
+            # a chunk collapses to at most stores x items entries
+            for key, quantity, revenue in zip(unique_keys.tolist(), quantities.tolist(), revenues.tolist()):
+                entry = totals.setdefault((stores[key >> 32], key & LOW_32_BITS), [0, 0.0])
+                entry[0] += quantity
+                entry[1] += revenue
+
+    with HOME_DB_CONNECTION.get_session() as db_session:
+        names = dict(db_session.query(Item.item_id, Item.name))
+    by_store = {}
+    for (store, item_id), (quantity, revenue) in totals.items():
+        by_store.setdefault(store, []).append((quantity, revenue, item_id))
+    rows = []
+    for store in sorted(by_store):
+        ranked = sorted(by_store[store], key=lambda entry: (-entry[0], entry[2]))[:top]
+        rows.extend({"store": store, "rank": rank, "item_id": item_id, "item_name": names.get(item_id),
+                     "units": int(quantity), "revenue": round(revenue, 2)}
+                    for rank, (quantity, revenue, item_id) in enumerate(ranked, 1))
+    return rows
+
+
+def points_liability(regions, start=None, end=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Points owed to the groups of every region, with the points awarded and redeemed in the period"""
+    rows = []
+    for region in regions:
+        groups = groups_with_points = outstanding = max_balance = 0
+        for chunk in stream_columns(region, select(Group.points), {"points": np.int64}, chunk_size):
+            points = chunk["points"]
+            groups += len(points)
+            groups_with_points += int(np.count_nonzero(points > 0))
+            outstanding += int(points.sum())
+            max_balance = max(max_balance, int(points.max()))
+
+        awarded = redeemed = 0
+        statement = _in_period(select(Transaction.points_awarded, Transaction.points_redeemed), start, end)
+        for chunk in stream_columns(region, statement, {"awarded": np.int64, "redeemed": np.int64}, chunk_size):
+            awarded += int(chunk["awarded"].sum())
+            redeemed += int(chunk["redeemed"].sum())
+
+        rows.append({
+            "region": region, "groups": groups, "groups_with_points": groups_with_points,
+            "outstanding_points": outstanding, "mean_balance": round(outstanding / groups, 2) if groups else 0,
+            "max_balance": max_balance, "points_awarded": awarded, "points_redeemed": redeemed,
+        })
+    return rows
+
+
+def group_churn(regions, start=None, end=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Groups buying something per month, and how many of the previous month's groups stopped"""
+    collected, collected_size = [], 0
+    statement = _in_period(select(Transaction.group_id, Transaction.timestamp), start, end)
+    dtypes = {"group_id": np.int64, "timestamp": "datetime64[us]"}
+
+    # purchases of multi region groups are spread over regions, activity is combined across them
+    for region in regions:
+        for chunk in stream_columns(region, statement, dtypes, chunk_size):
+            months = chunk["timestamp"].astype("datetime64[M]").astype(np.int64)
+            collected.append(np.unique(months << 32 | chunk["group_id"]))
+            collected_size += len(collected[-1])
+            if collected_size > CHURN_COMPACT_SIZE:
+                collected = [np.unique(np.concatenate(collected))]
+                collected_size = len(collected[0])
+    if not collected:
+        return []
+
+    # keys sort by month first, each month's groups are a contiguous, sorted slice
+    keys = np.unique(np.concatenate(collected))
+    months = keys >> 32
+    groups = keys & LOW_32_BITS
+    rows = []
+    previous = np.empty(0, dtype=np.int64)
+    for month in range(int(months[0]), int(months[-1]) + 1):
+        active = groups[np.searchsorted(months, month):np.searchsorted(months, month, side="right")]
+        retained = len(np.intersect1d(active, previous, assume_unique=True))
+        churned = len(previous) - retained
+        rows.append({
+            "month": str(np.datetime64(month, "M")), "active_groups": len(active),
+            "new_groups": len(active) - retained, "retained_groups": retained, "churned_groups": churned,
+            "churn_rate": round(churned / len(previous), 4) if len(previous) else None,
+        })
+        previous = active
+    return rows
+
+
+def write_csv(rows, output):
+    if not rows:
+        log.warning("The report is empty.")
+        return
+    writer = csv.DictWriter(output, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+@click.group()
+def cli():
+    """Reports over the transaction history of every region"""
+
+
+def report_command(name, report, **extra_options):
+    @cli.command(name, help=report.__doc__)
+    @click.option("--region", "regions", multiple=True, type=click.Choice(utils.REGIONS),
+                  help="Region to include, all regions by default")
+    @click.option("--from", "start", type=click.DateTime(["%Y-%m-%d"]), help="First day of the period")
+    @click.option("--to", "end", type=click.DateTime(["%Y-%m-%d"]), help="Day after the period")
+    @click.option("--chunk-size", default=DEFAULT_CHUNK_SIZE, show_default=True, help="Rows fetched per chunk")
+    @click.option("--output", type=click.File("w"), default="-", help="CSV file, standard output by default")
+    def command(regions, start, end, chunk_size, output, **options):
+        write_csv(report(list(regions or utils.REGIONS), start=start, end=end, chunk_size=chunk_size, **options),
+                  output)
+
+    for option_name, option in extra_options.items():
+        command = click.option(f"--{option_name}", **option)(command)
+    return command
+
+
+report_command("basket-sizes", basket_sizes)
+report_command("top-items", top_items, top={"default": 10, "show_default": True, "help": "Items per store"})
+report_command("points-liability", points_liability)
+report_command("group-churn", group_churn)
+
+
+if __name__ == "__main__":
+    cli()
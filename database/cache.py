@@ -1,6 +1,11 @@
+import copy
+import threading
 from dataclasses import dataclass
 from datetime import timedelta, datetime
 
+from database import deadlines
+from database.errors import DeadlineExceededError
+
 
 class Cache:
     @dataclass
@@ -8,18 +13,26 @@ class Cache:
         item: object
         time: datetime
 
-    def __init__(self, expiry_seconds=5):
+    def __init__(self, expiry_seconds=5, max_items=None):
         self.__items = {}
         self.__expiry_delta = timedelta(seconds=expiry_seconds)
+        # least recently used items are evicted beyond max_items
+        self.__max_items = max_items
 
     def put(self, key, value):
         current_time = datetime.now()
+        self.__items.pop(key, None)
         self.__items[key] = self.__CacheItem(value, current_time)
+        if self.__max_items is not None:
+            while len(self.__items) > self.__max_items:
+                self.pop(next(iter(self.__items), None))
 
     def get(self, key):
         current_time = datetime.now()
         cache_item = self.__items.get(key)
-        if cache_item is not None and cache_item.time + self.__expiry_delta.total_seconds() < current_time:
+        if cache_item is not None and current_time - cache_item.time < self.__expiry_delta:
+            if self.__max_items is not None and self.__items.pop(key, None) is not None:
+                self.__items[key] = cache_item
             return cache_item.item
         else:
             self.pop(key)
@@ -32,8 +45,10 @@ class Cache:
 
         for key in cache_keys:
             cache_item = self.__items.get(key)
+            if cache_item is None:
+                continue
             elapsed_time = current_time - cache_item.time
-            if elapsed_time >= self.__expiry_delta:
+            if elapsed_time < self.__expiry_delta:
                 items.append(cache_item.item)
             else:
                 self.pop(key)
@@ -42,3 +57,96 @@ class Cache:
 
     def pop(self, key):
         self.__items.pop(key, None)
+
+    def clear(self):
+        self.__items.clear()
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one execution of the function and its result.
+
+    Callers that join an execution wait for it no longer than their own deadline.
+    """
+
+    @dataclass
+    class __Call:
+        done: threading.Event
+        result: object = None
+        error: BaseException = None
+
+    def __init__(self):
+        self.__calls = {}
+        self.__lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = self.__Call(threading.Event())
+
+        if not leader:
+            if not call.done.wait(deadlines.remaining()):
+                raise DeadlineExceededError("Deadline passed while waiting for a shared lookup")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                if self.__calls.get(key) is call:
+                    del self.__calls[key]
+            call.done.set()
+
+    def forget(self, key):
+        """Let later calls start a new execution instead of joining the one in flight"""
+        with self.__lock:
+            self.__calls.pop(key, None)
+
+    def forget_all(self):
+        with self.__lock:
+            self.__calls.clear()
+
+
+class CoalescedLookup:
+    """A read-through cache in front of a lookup function, concurrent misses for the same arguments share one call.
+
+    Results are deep copies that callers can modify, unless `copy_results` is off. None results are not cached.
+    """
+
+    def __init__(self, function, expiry_seconds, max_items=None, copy_results=True):
+        self.__function = function
+        self.__copy_results = copy_results
+        self.__cache = Cache(expiry_seconds, max_items)
+        self.__flights = SingleFlight()
+        self.__generation = 0
+
+    def __call__(self, *args):
+        value = self.__cache.get(args)
+        if value is None:
+            value = self.__flights.do(args, self.__load, args)
+        return copy.deepcopy(value) if self.__copy_results else value
+
+    def __load(self, args):
+        # a write during the call invalidates what it read, its result is returned but not kept
+        generation = self.__generation
+        value = self.__function(*args)
+        if value is not None and generation == self.__generation:
+            self.__cache.put(args, value)
+        return value
+
+    def invalidate(self, *args):
+        self.__generation += 1
+        self.__flights.forget(args)
+        self.__cache.pop(args)
+
+    def invalidate_all(self):
+        self.__generation += 1
+        self.__flights.forget_all()
+        self.__cache.clear()
@@ -0,0 +1,59 @@
+"""Append-only feed of the changes made in a region: purchases, group points and group memberships.
+
+Events are inserted in the database transaction of the change they describe, so the feed never shows a change that
+was rolled back. Event ids are handed out on insert but PostgreSQL transactions commit in any order, so an id says
+nothing about which events a reader can already see. PostgreSQL stores the id of the writing transaction with every
+event and the feed serves events by that transaction id, and only those of transactions older than the oldest one
+still running: none of those can still commit, so no event ever appears before a cursor that moved past it. A long
+running write holds the feed back until it ends. SQLite writes one transaction at a time, its ids are in commit
+order. The cursor is the id of the last event read. Every shard of a sharded region has its own feed.
+"""
+import json
+import logging
+from datetime import date, datetime
+
+from sqlalchemy import BigInteger, String, cast, func, insert, select, tuple_
+from sqlalchemy.orm import aliased
+
+import utils
+from database.models import ChangeEvent, DB_CONNECTION
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+TRANSACTION_CREATED = "transaction.created"
+POINTS_CHANGED = "group.points_changed"
+MEMBER_ADDED = "group.member_added"
+
+
+def _json_default(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else str(value)
+
+
+def event_row(kind, payload, group_id=None, user_id=None):
+    return {"kind": kind, "group_id": group_id, "user_id": user_id, "created_at": datetime.now(),
+            "payload": json.dumps(payload, default=_json_default)}
+
+
+def record(db_session, events):
+    """Add event rows built by event_row to the database transaction of the session"""
+    if events:
+        db_session.execute(insert(ChangeEvent), events)
+
+
+def read(region, after=0, limit=100, shard=utils.MAIN_SHARD):
+    """Events of a region's shard after the event id `after`, in the order they are served in"""
+    with DB_CONNECTION[region].shard(shard).get_session() as db_session:
+        events = db_session.query(ChangeEvent)
+        if db_session.get_bind().dialect.name == "postgresql":
+            # transactions older than the oldest one running in the snapshot of this query have all ended
+            horizon = cast(cast(func.pg_snapshot_xmin(func.pg_current_snapshot()), String), BigInteger)
+            cursor = aliased(ChangeEvent)
+            # an id that isn't in the feed resumes from the events before the txid column, which are ordered by id
+            after_txid = func.coalesce(select(cursor.txid).where(cursor.event_id == after).scalar_subquery(), 0)
+            events = events.filter(tuple_(ChangeEvent.txid, ChangeEvent.event_id) > tuple_(after_txid, after),
+                                   ChangeEvent.txid < horizon) \
+                .order_by(ChangeEvent.txid, ChangeEvent.event_id)
+        else:
+            events = events.filter(ChangeEvent.event_id > after).order_by(ChangeEvent.event_id)
+        return [event.to_dict() for event in events.limit(limit)]
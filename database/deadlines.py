@@ -0,0 +1,45 @@
+"""Deadlines of the requests the query layer works for.
+
+The API gives every request a deadline. Database sessions are not opened once it has passed, and the statement and
+lock timeouts of every PostgreSQL transaction are bounded by the time left, so that work for clients that already
+gave up stops instead of holding connections and locks that live requests need. Writes that must not be left half
+done, e.g. a purchase whose points were already redeemed, finish with the deadline suspended.
+"""
+import contextlib
+import contextvars
+from time import monotonic
+
+from database.errors import DeadlineExceededError
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def start(seconds):
+    """Give the work in this context `seconds` from now, None for no deadline"""
+    _deadline.set(None if seconds is None else monotonic() + seconds)
+
+
+def clear():
+    _deadline.set(None)
+
+
+def remaining():
+    """Seconds left, None without a deadline"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - monotonic()
+
+
+def check(step):
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceededError(f"Deadline passed {-left * 1000:.0f}ms before {step}")
+
+
+@contextlib.contextmanager
+def suspended():
+    """Run a block that must not be cut short without the deadline"""
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
@@ -0,0 +1,14 @@
+class CircuitOpenError(Exception):
+    """Raised instead of waiting on a region database that is known to be unreachable"""
+
+    def __init__(self, message, retry_after):
+        super(CircuitOpenError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class ShardMovingError(CircuitOpenError):
+    """Raised instead of writing to a group whose shard bucket is being moved to another shard"""
+
+
+class DeadlineExceededError(Exception):
+    """Raised instead of starting or finishing database work for a request whose deadline has passed"""
@@ -0,0 +1,219 @@
+"""Columnar export of transactions and their items for offline processing.
+
+Every region is streamed in (timestamp, transaction_id) order with a server-side cursor and written batch by batch
+as typed column files, partitioned by table, region and day:
+
+    <output>/transaction/region=EUW/date=2025-03-01/part-<run>-00000/transaction_id.npy
+                                                                    /store.offsets.npy
+                                                                    /store.data.bin
+    <output>/transaction_item/region=EUW/date=2025-03-01/part-<run>-00000/...
+    <output>/manifest-<run>.json
+    <output>/checkpoint.json
+
+Numeric and timestamp columns are NumPy .npy arrays that can be memory-mapped, strings are int64 offsets into a
+UTF-8 blob; read_part() loads a part back. A run continues after the checkpoint of the previous one, --full starts
+over and belongs in a new directory. Rows stored with a timestamp before the checkpoint, like replayed store
+batches, are only picked up by a full export. A run interrupted between writing a part and advancing the
+checkpoint exports that batch again.
+
+    python -m database.export --output /data/export
+"""
+import json
+import logging
+import os
+from datetime import datetime
+
+import click
+import numpy as np
+from sqlalchemy import func, select, tuple_
+
+import utils
+from database.analytics import stream_columns
+from database.models import Transaction, TransactionItem, DB_CONNECTION
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+DEFAULT_BATCH_SIZE = 50000
+
+TRANSACTION_COLUMNS = {
+    "transaction_id": np.int64, "user_id": np.int64, "group_id": np.int64, "timestamp": "datetime64[us]",
+    "store": str, "total": np.float64, "points_redeemed": np.int64, "points_awarded": np.int64,
+}
+ITEM_COLUMNS = {
+    "transaction_item_id": np.int64, "transaction_id": np.int64, "item_id": np.int64, "quantity": np.int64,
+    "item_total": np.float64,
+}
+
+
+def _selected(model, columns):
+    """Select the columns in order, NULLs become 0 or '' so that every column has a fixed type"""
+    selected = []
+    for name, dtype in columns.items():
+        column = getattr(model, name)
+        if dtype is str:
+            column = func.coalesce(column, "")
+        elif name != "timestamp":
+            column = func.coalesce(column, 0)
+        selected.append(column.label(name))
+    return selected
+
+
+def write_part(directory, columns, dtypes):
+    """Write one column file per column into a new directory, atomically renamed into place"""
+    staging = os.path.join(os.path.dirname(directory), f".{os.path.basename(directory)}")
+    os.makedirs(staging)
+    for name, values in columns.items():
+        if dtypes[name] is str:
+            encoded = [value.encode() for value in values]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+            np.save(os.path.join(staging, f"{name}.offsets.npy"), offsets)
+            with open(os.path.join(staging, f"{name}.data.bin"), "wb") as f:
+                f.write(b"".join(encoded))
+        else:
+            np.save(os.path.join(staging, f"{name}.npy"), values)
+    os.replace(staging, directory)
+
+
+def read_part(directory, dtypes):
+    """Load a part written by write_part, strings as an object array"""
+    columns = {}
+    for name, dtype in dtypes.items():
+        if dtype is str:
+            offsets = np.load(os.path.join(directory, f"{name}.offsets.npy"))
+            with open(os.path.join(directory, f"{name}.data.bin"), "rb") as f:
+                data = f.read()
+            columns[name] = np.array([data[start:stop].decode() for start, stop in zip(offsets[:-1], offsets[1:])],
+                                     dtype=object)
+        else:
+            columns[name] = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+    return columns
+
+
+def _split_by_day(timestamps):
+    """Slices of rows ordered by time that fall on the same day"""
+    days = timestamps.astype("datetime64[D]")
+    bounds = [0, *(np.flatnonzero(days[1:] != days[:-1]) + 1).tolist(), len(days)]
+    return [(str(days[start]), slice(start, stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+class Exporter:
+    def __init__(self, output, batch_size, run_id):
+        self.output = output
+        self.batch_size = batch_size
+        self.run_id = run_id
+        self.parts = []
+        self._sequence = 0
+
+    def _write(self, table, region, day, columns, dtypes):
+        name = f"part-{self.run_id}-{self._sequence:05d}"
+        self._sequence += 1
+        directory = os.path.join(self.output, table, f"region={region}", f"date={day}", name)
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        write_part(directory, columns, dtypes)
+        rows = len(next(iter(columns.values())))
+        self.parts.append({"table": table, "region": region, "date": day, "rows": rows,
+                           "path": os.path.relpath(directory, self.output)})
+
+    def export_region(self, region, after, on_batch, shard=utils.MAIN_SHARD):
+        """Export the rows of a region's shard after the (timestamp, transaction_id) key `after`, calls on_batch with
+        the key of the last exported row after every batch"""
+        key = tuple_(Transaction.timestamp, Transaction.transaction_id)
+        statement = select(*_selected(Transaction, TRANSACTION_COLUMNS)) \
+            .order_by(Transaction.timestamp, Transaction.transaction_id)
+        if after:
+            statement = statement.where(key > tuple(after))
+
+        exported = {"transactions": 0, "items": 0}
+        for batch in stream_columns(region, statement, _dtypes(TRANSACTION_COLUMNS), self.batch_size, shard):
+            last = (batch["timestamp"][-1].item(), int(batch["transaction_id"][-1]))
+            for day, rows in _split_by_day(batch["timestamp"]):
+                self._write("transaction", region, day, {name: values[rows] for name, values in batch.items()},
+                            TRANSACTION_COLUMNS)
+
+            # the batch's item lines in one range query instead of an IN list of every transaction id, the bounds
+            # on transaction_timestamp limit it to the batch's partitions
+            items = select(*_selected(TransactionItem, ITEM_COLUMNS), Transaction.timestamp) \
+                .join(Transaction, (Transaction.transaction_id == TransactionItem.transaction_id)
+                      & (Transaction.timestamp == TransactionItem.transaction_timestamp)) \
+                .where(key <= last, TransactionItem.transaction_timestamp <= last[0]) \
+                .order_by(Transaction.timestamp, Transaction.transaction_id)
+            if after:
+                items = items.where(key > tuple(after), TransactionItem.transaction_timestamp >= after[0])
+            for item_batch in stream_columns(region, items, {**_dtypes(ITEM_COLUMNS), "timestamp": "datetime64[us]"},
+                                             self.batch_size, shard):
+                timestamps = item_batch.pop("timestamp")
+                for day, rows in _split_by_day(timestamps):
+                    self._write("transaction_item", region, day,
+                                {name: values[rows] for name, values in item_batch.items()}, ITEM_COLUMNS)
+                exported["items"] += len(timestamps)
+
+            exported["transactions"] += len(batch["transaction_id"])
+            after = last
+            on_batch(last)
+            log.info(f"Exported {exported['transactions']} transactions of {region}.")
+        return exported
+
+
+def _dtypes(columns):
+    return {name: object if dtype is str else dtype for name, dtype in columns.items()}
+
+
+def _write_json(path, content):
+    staging = f"{path}.tmp"
+    with open(staging, "w") as f:
+        json.dump(content, f, indent=2, default=str)
+    os.replace(staging, path)
+
+
+def load_checkpoint(output):
+    path = os.path.join(output, "checkpoint.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {region: (datetime.fromisoformat(timestamp), transaction_id)
+                for region, (timestamp, transaction_id) in json.load(f).items()}
+
+
+@click.command()
+@click.option("--output", required=True, type=click.Path(file_okay=False), help="Export directory")
+@click.option("--region", "regions", multiple=True, type=click.Choice(utils.REGIONS),
+              help="Region to export, all regions by default")
+@click.option("--batch-size", default=DEFAULT_BATCH_SIZE, show_default=True, help="Rows fetched and written at once")
+@click.option("--full", is_flag=True, help="Ignore the checkpoint and export everything")
+def main(output, regions, batch_size, full):
+    """Export transactions and their items as partitioned column files"""
+    os.makedirs(output, exist_ok=True)
+    run_id = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    checkpoint = {} if full else load_checkpoint(output)
+    exporter = Exporter(output, batch_size, run_id)
+    manifest = {
+        "run": run_id,
+        "schema": {table: {name: "string" if dtype is str else np.dtype(dtype).name for name, dtype in columns.items()}
+                   for table, columns in (("transaction", TRANSACTION_COLUMNS), ("transaction_item", ITEM_COLUMNS))},
+        "regions": {},
+        "parts": exporter.parts,
+    }
+
+    def advance(region, key):
+        checkpoint[region] = key
+        _write_json(os.path.join(output, "checkpoint.json"),
+                    {name: [timestamp.isoformat(), transaction_id] for name, (timestamp, transaction_id)
+                     in checkpoint.items()})
+
+    for region in regions or utils.REGIONS:
+        for shard in DB_CONNECTION[region].shard_connections():
+            # every shard is exported in its own order and keeps its own checkpoint
+            source = region if shard.main is None else f"{region}/{shard.name}"
+            after = checkpoint.get(source)
+            exported = exporter.export_region(region, after, lambda key: advance(source, key), shard.name)
+            manifest["regions"][source] = {"after": after, "until": checkpoint.get(source), **exported}
+            click.echo(f"{source}: {exported['transactions']} transactions, {exported['items']} items")
+
+    _write_json(os.path.join(output, f"manifest-{run_id}.json"), manifest)
+    click.echo(f"Wrote {len(exporter.parts)} parts, manifest-{run_id}.json")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import logging
+import threading
+from datetime import datetime
+from time import monotonic, sleep
+import utils
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class HealthMonitor:
+    """Periodically probes every region database and keeps the latest result in memory.
+
+    Readiness checks read the cached snapshot, so load balancer probes never hit the databases themselves.
+    """
+
+    def __init__(self, connections, interval=utils.HEALTH_CHECK_INTERVAL):
+        self._connections = connections
+        self._interval = interval
+        self._regions = {}
+        self._refreshed_at = None
+        self._checked_at = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            # take the first snapshot synchronously so readiness is meaningful straight away
+            self.refresh()
+            self._thread = threading.Thread(target=self._run, name="db-health-monitor", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            sleep(self._interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error(f"Health refresh failed: {e}")
+
+    def refresh(self):
+        regions = {region: connection.probe() for region, connection in self._connections.items()}
+        for region_status in regions.values():
+            lags = [node["replication_lag_seconds"] for node in region_status["nodes"]
+                    if node["replication_lag_seconds"] is not None]
+            region_status["max_replication_lag_seconds"] = max(lags) if lags else None
+            region_status["replication_lagging"] = bool(lags) and max(lags) > utils.MAX_REPLICA_LAG_SECONDS
+        self._regions = regions
+        self._refreshed_at = monotonic()
+        self._checked_at = datetime.now()
+
+    def status(self):
+        regions = self._regions
+        age = monotonic() - self._refreshed_at if self._refreshed_at is not None else None
+
+        reasons = []
+        home = regions.get(utils.REGION_ID)
+        if home is None or age is None:
+            reasons.append("no health data yet")
+        else:
+            if age > 3 * self._interval:
+                reasons.append("health data is stale")
+            if not home["primary_reachable"]:
+                reasons.append("home region primary unreachable")
+            if home["circuit_breaker"] == "open":
+                reasons.append("home region circuit breaker open")
+            if home["pool"]["saturation"] >= utils.MAX_POOL_SATURATION:
+                reasons.append("home region connection pool saturated")
+
+        return {
+            "ready": not reasons,
+            "reasons": reasons,
+            "region": utils.REGION_ID,
+            "checked_at": self._checked_at.isoformat() if self._checked_at else None,
+            "regions": regions,
+        }
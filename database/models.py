@@ -1,15 +1,25 @@
+import json
 import logging
-from time import sleep
+from time import sleep, monotonic
 import utils
 import random
+import tracing
 
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Table, DateTime, text, pool, Boolean
+from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Table, DateTime, text, pool, Boolean, \
+    event, make_url, Index, Date, ForeignKeyConstraint, BigInteger, inspect, insert
 from sqlalchemy.orm import relationship, declarative_base, sessionmaker
 from datetime import datetime
+from database.errors import CircuitOpenError, DeadlineExceededError, ShardMovingError
+from database import deadlines, partitions
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
+# statements are recorded in trace spans up to this length, their parameters never are
+TRACED_STATEMENT_MAX_CHARS = 300
+# query_canceled (statement_timeout) and lock_not_available (lock_timeout)
+TIMEOUT_SQLSTATES = {"57014", "55P03"}
+
 Base = declarative_base()
 
 # Association table for the many-to-many relationship between Group and User
@@ -66,16 +76,25 @@ class GroupMemberMR(Base):
 
 class Transaction(Base):
     __tablename__ = 'transaction'
-    transaction_id = Column(Integer, primary_key=True)
+    # partitioned tables need the partition key in their primary key, ids are still drawn to be unique on their own
+    transaction_id = Column(Integer, primary_key=True, autoincrement=False)
     user_id = Column(Integer, ForeignKey('user.user_id'))
     group_id = Column(Integer)
-    timestamp = Column(DateTime, default=datetime.now)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.now)
     store = Column(String)
     total = Column(Float)
     points_redeemed = Column(Integer)
     points_awarded = Column(Integer)
     user = relationship("User", backref="transactions")
 
+    # history is paged and exported in (timestamp, transaction_id) order
+    __table_args__ = (
+        Index('ix_transaction_user_history', 'user_id', 'timestamp', 'transaction_id'),
+        Index('ix_transaction_group_history', 'group_id', 'timestamp', 'transaction_id'),
+        Index('ix_transaction_time', 'timestamp', 'transaction_id'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
     def __init__(self, user_id, group_id, store, total, points_redeemed, points_awarded):
         super(Transaction, self).__init__()
         self.transaction_id = _gen_id()
@@ -123,14 +142,33 @@ def add_items(session):
     session.commit()
 
 
+def copy_menu(main, shard):
+    """Copy the whole menu of a region's main database to one of its shards, whose purchases reference their copy"""
+    with main.get_session() as main_session:
+        items = [(item.item_id, item.name, item.price) for item in main_session.query(Item)]
+    with shard.get_session() as shard_session:
+        for item_id, name, price in items:
+            shard_session.merge(Item(item_id=item_id, name=name, price=price))
+        shard_session.commit()
+
+
 class TransactionItem(Base):
     __tablename__ = 'transaction_item'
-    transaction_item_id = Column(Integer, primary_key=True, autoincrement=True)
-    transaction_id = Column(Integer, ForeignKey('transaction.transaction_id'))
+    transaction_item_id = Column(Integer, primary_key=True, autoincrement=False, default=_gen_id)
+    transaction_id = Column(Integer, index=True)
+    # copy of the transaction's timestamp, items are partitioned like their transaction and pruned alike
+    transaction_timestamp = Column(DateTime, primary_key=True)
     item_id = Column(Integer, ForeignKey('item.item_id'))
     quantity = Column(Integer)
     item_total = Column(Float)
 
+    __table_args__ = (
+        ForeignKeyConstraint(['transaction_id', 'transaction_timestamp'],
+                             ['transaction.transaction_id', 'transaction.timestamp'],
+                             name='transaction_item_transaction_fkey'),
+        {'postgresql_partition_by': 'RANGE (transaction_timestamp)'},
+    )
+
     # Relationships
     transaction = relationship("Transaction", backref="transaction_items")
     item = relationship("Item", backref="transaction_items")
@@ -144,15 +182,205 @@ class TransactionItem(Base):
         }
 
 
+class GroupDailyRollup(Base):
+    __tablename__ = 'group_daily_rollup'
+    group_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    transactions = Column(Integer, default=0)
+    spend = Column(Float, default=0)
+    points_awarded = Column(Integer, default=0)
+    points_redeemed = Column(Integer, default=0)
+
+
+class UserDailyRollup(Base):
+    __tablename__ = 'user_daily_rollup'
+    user_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    transactions = Column(Integer, default=0)
+    spend = Column(Float, default=0)
+    points_awarded = Column(Integer, default=0)
+    points_redeemed = Column(Integer, default=0)
+
+
+class StoreDailyRollup(Base):
+    __tablename__ = 'store_daily_rollup'
+    store = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    transactions = Column(Integer, default=0)
+    spend = Column(Float, default=0)
+    points_awarded = Column(Integer, default=0)
+    points_redeemed = Column(Integer, default=0)
+
+
+class IdempotencyKey(Base):
+    __tablename__ = 'idempotency_key'
+    user_name = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    request_hash = Column(String)
+    status = Column(String)
+    response_code = Column(Integer)
+    response_body = Column(String)
+    created_at = Column(DateTime, default=datetime.now, index=True)
+
+
+class ChangeEvent(Base):
+    __tablename__ = 'change_event'
+    __table_args__ = (
+        Index('ix_change_event_txid', 'txid', 'event_id'),
+    )
+    # SQLite only generates ids for INTEGER primary keys
+    event_id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    # PostgreSQL transaction that wrote the event, set by the database (see CHANGE_EVENT_TXID), 0 for older events
+    txid = Column(BigInteger)
+    created_at = Column(DateTime, default=datetime.now)
+    kind = Column(String)
+    group_id = Column(Integer)
+    user_id = Column(Integer)
+    payload = Column(String)
+
+    def to_dict(self):
+        return {
+            "event_id": self.event_id,
+            "created_at": self.created_at,
+            "kind": self.kind,
+            "group_id": self.group_id,
+            "user_id": self.user_id,
+            "payload": json.loads(self.payload),
+        }
+
+
+class GroupName(Base):
+    """Name of every group of the region, kept in the main database so that names are unique across its shards"""
+    __tablename__ = 'group_name'
+    name = Column(String, primary_key=True)
+    group_id = Column(Integer)
+
+
+class ShardBucket(Base):
+    """Shard of the groups whose group_id falls in a bucket, kept in the region's main database. Buckets without a
+    row are on the main database."""
+    __tablename__ = 'shard_bucket'
+    bucket = Column(Integer, primary_key=True, autoincrement=False)
+    shard = Column(String)
+    # writes to the bucket's groups are refused while it moves to another shard
+    frozen = Column(Boolean, default=False)
+
+
+def bucket_of(group_id):
+    return group_id % utils.SHARD_BUCKETS
+
+
 class DatabaseConnection:
-    def __init__(self, urls):
+    def __init__(self, urls, pool_settings, region=None, name=utils.MAIN_SHARD, main=None):
+        self.region = region
+        # a region's main database has the users, items and multi region memberships, its shards only groups and
+        # their purchases
+        self.name = name
+        self.main = main
+        self.shards = {}
+        self._shard_map = {}
+        self._shard_map_loaded_at = None
         self._primary_url = None
         self._urls = urls
+        self._engines = {}
+        self._probe_engines = {}
         self.engine = None
         self._retries = 5
         self._retry_wait = 5
+        self._pool_settings = pool_settings
+        self._pool_size = pool_settings["pool_size"]
+        self._max_overflow = pool_settings["max_overflow"]
+        self._primary_checked_at = None
+        self._failure_threshold = utils.CIRCUIT_BREAKER_FAILURES
+        self._reset_timeout = utils.CIRCUIT_BREAKER_RESET_SECONDS
+        self._consecutive_failures = 0
+        self._opened_at = None
         self._connect_to_primary()
 
+    def _get_engine(self, url):
+        # engines are created once per url so that their pools are actually reused
+        engine = self._engines.get(url)
+        if engine is None:
+            settings = self._pool_settings
+            engine = create_engine(url, poolclass=pool.QueuePool, pool_size=self._pool_size,
+                                   max_overflow=self._max_overflow, pool_timeout=settings["pool_timeout"],
+                                   pool_recycle=settings["pool_recycle"], pool_pre_ping=settings["pool_pre_ping"],
+                                   connect_args=self._connect_args(url))
+            event.listen(engine, "handle_error", self._on_engine_error)
+            if tracing.ENABLED:
+                event.listen(engine, "before_cursor_execute", self._start_statement_span)
+                event.listen(engine, "after_cursor_execute", self._end_statement_span)
+            if make_url(url).get_backend_name() == "postgresql":
+                event.listen(engine, "begin", self._set_local_timeouts)
+            self._engines[url] = engine
+        return engine
+
+    def _uses_transaction_pooler(self, url):
+        return self._pool_settings["pooler_mode"] == "transaction" \
+            and make_url(url).get_backend_name() == "postgresql"
+
+    def _connect_args(self, url):
+        if make_url(url).get_backend_name() != "postgresql":
+            return {}
+        connect_args = {}
+        if self._uses_transaction_pooler(url):
+            # a transaction pooler hands every transaction to any server connection, so nothing may outlive a
+            # transaction: no server-side prepared statements (psycopg 3 prepares repeated queries by default, psycopg2
+            # never does) and no session settings, the statement timeout is set per transaction instead
+            if make_url(url).get_driver_name() == "psycopg":
+                connect_args["prepare_threshold"] = None
+        elif self._pool_settings["statement_timeout_ms"]:
+            connect_args["options"] = f"-c statement_timeout={self._pool_settings['statement_timeout_ms']}"
+        return connect_args
+
+    def _set_local_timeouts(self, conn):
+        # behind a transaction pooler the configured statement timeout is set per transaction; a request's deadline
+        # bounds the statement and lock timeouts of every transaction it runs, a passed one cancels its first statement
+        configured = self._pool_settings["statement_timeout_ms"]
+        timeouts = {}
+        if configured and self._uses_transaction_pooler(conn.engine.url):
+            timeouts["statement_timeout"] = configured
+        left = deadlines.remaining()
+        if left is not None:
+            left_ms = max(1, int(left * 1000))
+            timeouts["statement_timeout"] = min(configured, left_ms) if configured else left_ms
+            timeouts["lock_timeout"] = left_ms
+        if not timeouts:
+            return
+        cursor = conn.connection.cursor()
+        try:
+            # one round trip for both
+            cursor.execute("SELECT " + ", ".join(f"set_config('{name}', '{int(value)}', true)"
+                                                 for name, value in timeouts.items()))
+        finally:
+            cursor.close()
+
+    def _start_statement_span(self, conn, cursor, statement, parameters, context, executemany):
+        url = conn.engine.url
+        context.trace_span = tracing.child("db.statement", **{
+            "db.region": self.region, "db.shard": self.name,
+            "db.node": f"{url.host}:{url.port}/{url.database}" if url.host else url.database,
+            "db.statement": statement[:TRACED_STATEMENT_MAX_CHARS], "db.executemany": executemany,
+        })
+
+    @staticmethod
+    def _end_statement_span(conn, cursor, statement, parameters, context, executemany):
+        span = getattr(context, "trace_span", None)
+        if span is not None:
+            span.set(**{"db.rows": cursor.rowcount})
+            span.end()
+
+    def _get_probe_engine(self, url):
+        # health probes use their own short-lived connections so a saturated pool can't block them
+        engine = self._probe_engines.get(url)
+        if engine is None:
+            connect_args = {}
+            if make_url(url).get_backend_name() == "postgresql":
+                connect_args["connect_timeout"] = utils.HEALTH_CHECK_TIMEOUT
+            engine = create_engine(url, poolclass=pool.NullPool, connect_args=connect_args)
+            self._probe_engines[url] = engine
+        return engine
+
     def _connect_to_primary(self):
         # check if primary still the same or has changed
         if self._primary_url is not None:
@@ -170,14 +398,31 @@ class DatabaseConnection:
                     if not is_in_recovery_or_down:
                         self._primary_url = each_url
                         self._is_current_connection_read_only = False
+                        self.engine = self._get_engine(each_url)
+                        self._primary_checked_at = monotonic()
+                        self._record_success()
                         return
+                deadlines.check("retrying the connection to the primary")
                 sleep(self._retry_wait)
+            self._open_circuit()
             raise Exception(f"Connecting to primary failed after {number_of_tries} retries!")
 
+        self.engine = self._get_engine(self._primary_url)
+        self._primary_checked_at = monotonic()
+        self._record_success()
+
+    def _primary_recently_checked(self):
+        return self._primary_checked_at is not None and self.circuit_state == "closed" \
+            and monotonic() - self._primary_checked_at < self._pool_settings["primary_check_seconds"]
+
     def _is_database_in_recovery_or_down(self, url):
-        self.engine = create_engine(url, poolclass=pool.QueuePool, pool_size=5, pool_recycle=3600)
         try:
-            session = sessionmaker(bind=self.engine)()
+            engine = self._get_engine(url)
+            if engine.dialect.name != "postgresql":
+                # stand-in databases (e.g. SQLite for benchmarks) have no replicas, they are always primary
+                engine.connect().close()
+                return False
+            session = sessionmaker(bind=engine)()
             res = session.query(text('pg_is_in_recovery()')).all()
             is_in_recovery = res[0][0]
             session.close()
@@ -193,37 +438,190 @@ class DatabaseConnection:
         while number_of_tries <= self._retries:
             number_of_tries += 1
             for each_url in self._urls:
-                self.engine = create_engine(each_url, poolclass=pool.QueuePool, pool_size=5, pool_recycle=3600)
+                engine = self._get_engine(each_url)
                 try:
-                    conn = self.engine.connect()
+                    conn = engine.connect()
                     conn.close()
-                    return
+                    return engine
                 except Exception as e:
                     log.error(f"Failed to connect to database: {e}")
+        self._open_circuit()
         raise Exception(f"Connecting to any database failed after {number_of_tries} retries")
 
+    def _on_engine_error(self, context):
+        span = getattr(context.execution_context, "trace_span", None)
+        if span is not None:
+            span.end(context.original_exception)
+        if context.is_disconnect:
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= self._failure_threshold:
+                self._open_circuit()
+        left = deadlines.remaining()
+        original = context.original_exception
+        sqlstate = getattr(original, "pgcode", None) or getattr(original, "sqlstate", None)
+        if left is not None and left <= 0 and sqlstate in TIMEOUT_SQLSTATES:
+            raise DeadlineExceededError(f"Deadline passed waiting on {self._redacted(str(context.engine.url))}") \
+                from original
+
+    def _open_circuit(self):
+        if self._opened_at is None:
+            log.error(f"Opening circuit breaker for {self._redacted(self._primary_url)}")
+        self._opened_at = monotonic()
+
+    def _record_success(self):
+        self._consecutive_failures = 0
+        self._opened_at = None
+
+    @staticmethod
+    def _redacted(url):
+        return make_url(url).render_as_string(hide_password=True) if url else None
+
+    @property
+    def circuit_state(self):
+        if self._opened_at is None:
+            return "closed"
+        if monotonic() - self._opened_at < self._reset_timeout:
+            return "open"
+        return "half_open"
+
+    def probe(self):
+        """Check every node of this region, without touching the request pools"""
+        nodes = []
+        for each_url in self._urls:
+            node = {"node": self._redacted(each_url), "up": False, "in_recovery": None,
+                    "replication_lag_seconds": None}
+            try:
+                with self._get_probe_engine(each_url).connect() as conn:
+                    if conn.dialect.name == "postgresql":
+                        in_recovery, lag = conn.execute(text(
+                            "SELECT pg_is_in_recovery(), "
+                            "CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                            "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+                        )).one()
+                    else:
+                        conn.execute(text("SELECT 1"))
+                        in_recovery, lag = False, None
+                node.update(up=True, in_recovery=in_recovery,
+                            replication_lag_seconds=float(lag) if in_recovery and lag is not None else None)
+            except Exception as e:
+                log.error(f"Health probe failed for {node['node']}: {e}")
+            nodes.append(node)
+
+        primary_reachable = any(node["up"] and not node["in_recovery"] for node in nodes)
+        if primary_reachable and self.circuit_state == "half_open":
+            self._record_success()
+
+        pool_status = {"size": self._pool_size, "max_overflow": self._max_overflow, "checked_out": 0}
+        if self.engine is not None:
+            pool_status["checked_out"] = self.engine.pool.checkedout()
+        pool_status["saturation"] = pool_status["checked_out"] / (self._pool_size + self._max_overflow)
+
+        return {
+            "primary": self._redacted(self._primary_url),
+            "primary_reachable": primary_reachable,
+            "nodes": nodes,
+            "pool": pool_status,
+            "circuit_breaker": self.circuit_state,
+        }
+
+    def shard(self, name):
+        return self if name == self.name else self.shards[name]
+
+    def shard_connections(self):
+        """The region's main database first, then its shards"""
+        return [self, *self.shards.values()]
+
+    def shard_map(self):
+        """Shard name and frozen flag by bucket, reloaded every SHARD_MAP_TTL_SECONDS"""
+        if not self.shards:
+            return {}
+        if self._shard_map_loaded_at is None \
+                or monotonic() - self._shard_map_loaded_at >= utils.SHARD_MAP_TTL_SECONDS:
+            with self.get_session() as db_session:
+                self._shard_map = {row.bucket: (row.shard, row.frozen) for row in db_session.query(ShardBucket)}
+            self._shard_map_loaded_at = monotonic()
+        return self._shard_map
+
+    def shard_for(self, group_id, write=False):
+        """The database of the region holding the group, writes to a group that is being moved are refused"""
+        if not self.shards:
+            return self
+        name, frozen = self.shard_map().get(bucket_of(group_id), (self.name, False))
+        if write and frozen:
+            raise ShardMovingError(f"Group {group_id} is moving to another shard", utils.SHARD_MAP_TTL_SECONDS)
+        return self.shard(name)
+
     # def _is_connected(self):
     #     return self.engine and self.engine.connect()
 
     def get_session(self, read_only=False):
+        deadlines.check("opening a database session")
+        if self.circuit_state == "open":
+            retry_after = self._reset_timeout - (monotonic() - self._opened_at)
+            raise CircuitOpenError(f"Circuit breaker open for {self._redacted(self._primary_url)}", retry_after)
         # if not self._is_connected():
         if read_only:
-            self._connect_to_any()
-        else:
+            return sessionmaker(bind=self._connect_to_any(), expire_on_commit=False)()
+        elif not self._primary_recently_checked():
             self._connect_to_primary()
         # elif self._is_current_connection_read_only and not read_only:
         #     self._connect_to_primary()
-        return sessionmaker(bind=self.engine)()
+        # objects returned by the query functions are used after their session is closed
+        return sessionmaker(bind=self.engine, expire_on_commit=False)()
 
 
 DB_CONNECTION = {
-    region_id: DatabaseConnection(url) for region_id, url in utils.REGION_URLS.items()
+    region_id: DatabaseConnection(url, utils.REGION_POOL_SETTINGS[region_id], region_id)
+    for region_id, url in utils.REGION_URLS.items()
 }
+for region_id, shard_urls in utils.REGION_SHARD_URLS.items():
+    for shard_name, urls in shard_urls.items():
+        DB_CONNECTION[region_id].shards[shard_name] = DatabaseConnection(
+            urls, utils.REGION_POOL_SETTINGS[region_id], region_id, shard_name, DB_CONNECTION[region_id])
 
 HOME_DB_CONNECTION = DB_CONNECTION[utils.REGION_ID]
-
-# create all tables
-Base.metadata.create_all(HOME_DB_CONNECTION.engine)
-
-# add menu items
-add_items(HOME_DB_CONNECTION.get_session())
\ No newline at end of file
+_index_group_names = not inspect(HOME_DB_CONNECTION.engine).has_table(GroupName.__tablename__)
+CHANGE_EVENT_TXID = "(pg_current_xact_id()::text::bigint)"
+
+
+def _add_change_event_txid(conn):
+    """Add the txid column to a change_event table created before it, and let PostgreSQL fill it"""
+    columns = {column["name"]: column for column in inspect(conn).get_columns(ChangeEvent.__tablename__)}
+    if "txid" not in columns:
+        conn.execute(text("ALTER TABLE change_event ADD COLUMN txid BIGINT"))
+        conn.execute(text("UPDATE change_event SET txid = 0"))
+    if conn.dialect.name == "postgresql" and not columns.get("txid", {}).get("default"):
+        conn.execute(text(f"ALTER TABLE change_event ALTER COLUMN txid SET DEFAULT {CHANGE_EVENT_TXID}"))
+
+# shards have the same tables, purchases on a shard look up its copy of the menu
+for home_connection in HOME_DB_CONNECTION.shard_connections():
+    # create all tables
+    Base.metadata.create_all(home_connection.engine)
+    # create_all skips existing tables, add columns and indexes introduced after they were created
+    with home_connection.engine.begin() as conn:
+        _add_change_event_txid(conn)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(home_connection.engine, checkfirst=True)
+    # the current month and the next ones get their partitions ahead of the first purchase
+    with home_connection.engine.begin() as conn:
+        partitions.ensure_partitions(conn, utils.PARTITION_MONTHS_AHEAD)
+
+    # add menu items
+    add_items(home_connection.get_session())
+
+# the names of the groups created before the name index, once
+if _index_group_names:
+    group_names = {}
+    for home_connection in HOME_DB_CONNECTION.shard_connections():
+        with home_connection.get_session() as db_session:
+            for group_id, name in db_session.query(Group.group_id, Group.name).filter(Group.name.isnot(None)):
+                group_names.setdefault(name, group_id)
+    if group_names:
+        with HOME_DB_CONNECTION.engine.begin() as conn:
+            conn.execute(insert(GroupName.__table__),
+                         [{"name": name, "group_id": group_id} for name, group_id in group_names.items()])
+
+# items added before a shard was configured, or while this process' add_item couldn't reach it
+for shard_connection in HOME_DB_CONNECTION.shards.values():
+    copy_menu(HOME_DB_CONNECTION, shard_connection)
\ No newline at end of file
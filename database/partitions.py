@@ -0,0 +1,253 @@
+"""Monthly partitions of the transaction tables and archival of old months.
+
+On PostgreSQL `transaction` is range partitioned by its timestamp and `transaction_item` by transaction_timestamp,
+the copy of its transaction's timestamp, so a month's items sit next to its transactions and queries bounded in
+time only touch the partitions of their months. Each table has a default partition for rows of months without a
+partition, e.g. replayed store batches; creating the month later moves its rows out of the default partition.
+
+The services create partitions for the current month and PARTITION_MONTHS_AHEAD months ahead when they start,
+`ensure` does the same from a scheduled job. `archive` detaches the months before the retention period and moves
+them to the archive schema, optionally into a cold tablespace, or drops them. The daily rollups keep covering
+archived months. `migrate` converts the unpartitioned tables of a database created before partitioning:
+
+    python -m database.partitions ensure --months-ahead 3
+    python -m database.partitions archive --older-than 24 --tablespace cold
+    python -m database.partitions migrate --region EUW
+"""
+import logging
+import re
+from datetime import date, datetime
+
+import click
+from sqlalchemy import text
+
+import utils
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# items reference their transaction, tables are listed parent first
+PARTITIONED_TABLES = (("transaction", "timestamp"), ("transaction_item", "transaction_timestamp"))
+ARCHIVE_SCHEMA = "archive"
+MONTH_PARTITION = re.compile(r"_p(\d{4})(\d{2})$")
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month:%Y%m}"
+
+
+def to_regclass(connection, name):
+    return connection.execute(text("SELECT to_regclass(:name)"), {"name": f'"{name}"'}).scalar()
+
+
+def is_partitioned(connection, table):
+    return connection.dialect.name == "postgresql" and connection.execute(text(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)"
+    ), {"table": f'"{table}"'}).scalar() is True
+
+
+def attached_partitions(connection, table):
+    """Names of the partitions of a table, by month, without the default partition"""
+    names = connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:table)"
+    ), {"table": f'"{table}"'}).scalars()
+    months = {}
+    for name in names:
+        match = MONTH_PARTITION.search(name)
+        if match and name == f"{table}{match.group(0)}":
+            months[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return months
+
+
+def ensure_partitions(connection, months_ahead, start=None):
+    """Create the default partitions, the monthly partitions from `start`, the current month by default, to
+    `months_ahead` months ahead and those of months with rows in the default partition. Does nothing on other
+    databases and on tables created before partitioning."""
+    if not is_partitioned(connection, PARTITIONED_TABLES[0][0]):
+        return []
+    for table, _ in PARTITIONED_TABLES:
+        connection.execute(text(f'CREATE TABLE IF NOT EXISTS "{table}_default" PARTITION OF "{table}" DEFAULT'))
+
+    existing = attached_partitions(connection, PARTITIONED_TABLES[0][0])
+    current = month_start(datetime.now())
+    months = set()
+    month = month_start(start or current)
+    while month <= add_months(current, months_ahead):
+        months.add(month)
+        month = add_months(month, 1)
+    # months that only have rows in the default partition get their own partition as well
+    months.update(month.date() for month in connection.execute(text(
+        'SELECT DISTINCT date_trunc(\'month\', "timestamp") FROM "transaction_default"')).scalars())
+
+    created = []
+    for month in sorted(months - existing.keys()):
+        _create_month(connection, month)
+        created.append(month)
+    if created:
+        log.info(f"Created transaction partitions for {', '.join(f'{month:%Y-%m}' for month in created)}.")
+    return created
+
+
+def _create_month(connection, month):
+    """A new partition cannot overlap rows in the default partition, they are set aside and inserted again"""
+    bounds = {"start": month, "end": add_months(month, 1)}
+    moved = connection.execute(text(
+        'SELECT count(*) FROM "transaction_default" WHERE "timestamp" >= :start AND "timestamp" < :end'
+    ), bounds).scalar()
+    if moved:
+        for table, column in reversed(PARTITIONED_TABLES):
+            connection.execute(text(
+                f'CREATE TEMPORARY TABLE "moved_{table}" AS SELECT * FROM "{table}_default" '
+                f'WHERE "{column}" >= :start AND "{column}" < :end'
+            ), bounds)
+            connection.execute(text(f'DELETE FROM "{table}_default" WHERE "{column}" >= :start AND "{column}" < :end'),
+                               bounds)
+
+    for table, _ in PARTITIONED_TABLES:
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS "{partition_name(table, month)}" PARTITION OF "{table}" '
+            f"FOR VALUES FROM ('{bounds['start']}') TO ('{bounds['end']}')"
+        ))
+
+    if moved:
+        for table, _ in PARTITIONED_TABLES:
+            connection.execute(text(f'INSERT INTO "{table}" SELECT * FROM "moved_{table}"'))
+            connection.execute(text(f'DROP TABLE "moved_{table}"'))
+        log.warning(f"Moved {moved} transactions of {month:%Y-%m} out of the default partition.")
+
+
+def archive_partitions(connection, older_than_months, tablespace=None, drop=False):
+    """Detach the months that ended more than `older_than_months` months ago and move them to the archive schema,
+    or drop them. Returns the archived months."""
+    if not is_partitioned(connection, PARTITIONED_TABLES[0][0]):
+        raise click.ClickException("The transaction table is not partitioned, run migrate first")
+    cutoff = add_months(month_start(datetime.now()), -older_than_months)
+    months = sorted(month for month in attached_partitions(connection, PARTITIONED_TABLES[0][0]) if month < cutoff)
+    if not drop:
+        connection.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{ARCHIVE_SCHEMA}"'))
+
+    for month in months:
+        # items first, a transaction partition cannot leave while item rows still reference it
+        for table, _ in reversed(PARTITIONED_TABLES):
+            name = partition_name(table, month)
+            if to_regclass(connection, name) is None:
+                continue
+            connection.execute(text(f'ALTER TABLE "{table}" DETACH PARTITION "{name}"'))
+            if table != PARTITIONED_TABLES[0][0]:
+                _drop_transaction_references(connection, name)
+            if drop:
+                connection.execute(text(f'DROP TABLE "{name}"'))
+                continue
+            connection.execute(text(f'ALTER TABLE "{name}" SET SCHEMA "{ARCHIVE_SCHEMA}"'))
+            if tablespace:
+                connection.execute(text(f'ALTER TABLE "{ARCHIVE_SCHEMA}"."{name}" SET TABLESPACE "{tablespace}"'))
+                for index in connection.execute(text(
+                        "SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = to_regclass(:table)"
+                ), {"table": f'"{ARCHIVE_SCHEMA}"."{name}"'}).scalars():
+                    connection.execute(text(f'ALTER INDEX {index} SET TABLESPACE "{tablespace}"'))
+        log.info(f"{'Dropped' if drop else 'Archived'} the transactions of {month:%Y-%m}.")
+    return months
+
+
+def _drop_transaction_references(connection, name):
+    """A detached item partition keeps its foreign key to the transaction table, which would pin the month there"""
+    for constraint in connection.execute(text(
+            "SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(:table) AND contype = 'f' "
+            "AND confrelid = to_regclass(:parent)"
+    ), {"table": f'"{name}"', "parent": f'"{PARTITIONED_TABLES[0][0]}"'}).scalars():
+        connection.execute(text(f'ALTER TABLE "{name}" DROP CONSTRAINT "{constraint}"'))
+
+
+def migrate(connection, tables):
+    """Recreate unpartitioned transaction tables as partitioned ones in one database transaction, with a partition
+    for every month that has rows. `tables` are the Table objects of PARTITIONED_TABLES."""
+    if connection.dialect.name != "postgresql" or to_regclass(connection, PARTITIONED_TABLES[0][0]) is None \
+            or is_partitioned(connection, PARTITIONED_TABLES[0][0]):
+        return False
+    connection.execute(text('CREATE TEMPORARY TABLE "unpartitioned_transaction" AS SELECT * FROM "transaction"'))
+    # the item table gains the timestamp of its transaction
+    connection.execute(text(
+        'CREATE TEMPORARY TABLE "unpartitioned_transaction_item" AS '
+        'SELECT ti.transaction_item_id, ti.transaction_id, t."timestamp" AS transaction_timestamp, ti.item_id, '
+        'ti.quantity, ti.item_total FROM "transaction_item" ti JOIN "transaction" t USING (transaction_id)'
+    ))
+    for table, _ in reversed(PARTITIONED_TABLES):
+        connection.execute(text(f'DROP TABLE "{table}"'))
+    for table in tables:
+        table.create(connection)
+
+    first = connection.execute(text('SELECT min("timestamp") FROM "unpartitioned_transaction"')).scalar()
+    ensure_partitions(connection, utils.PARTITION_MONTHS_AHEAD, start=first)
+    for table in tables:
+        columns = ", ".join(f'"{column.name}"' for column in table.columns)
+        connection.execute(text(
+            f'INSERT INTO "{table.name}" ({columns}) SELECT {columns} FROM "unpartitioned_{table.name}"'
+        ))
+        connection.execute(text(f'DROP TABLE "unpartitioned_{table.name}"'))
+    return True
+
+
+@click.group()
+@click.option("--region", "regions", multiple=True, type=click.Choice(utils.REGIONS),
+              help="Region to maintain, all regions by default")
+@click.pass_context
+def cli(ctx, regions):
+    """Maintain the monthly partitions of the transaction tables"""
+    ctx.obj = list(regions or utils.REGIONS)
+
+
+def _each_region(regions):
+    # imported here, models imports this module to create partitions when the services start
+    from database.models import DB_CONNECTION
+    for region in regions:
+        for shard in DB_CONNECTION[region].shard_connections():
+            with shard.engine.begin() as connection:
+                yield region if shard.main is None else f"{region}/{shard.name}", connection
+
+
+@cli.command()
+@click.option("--months-ahead", default=utils.PARTITION_MONTHS_AHEAD, show_default=True,
+              help="Months after the current one to create partitions for")
+@click.pass_obj
+def ensure(regions, months_ahead):
+    """Create the partitions of the coming months"""
+    for region, connection in _each_region(regions):
+        created = ensure_partitions(connection, months_ahead)
+        click.echo(f"{region}: created {len(created)} partitions")
+
+
+@cli.command()
+@click.option("--older-than", required=True, type=click.IntRange(min=1),
+              help="Archive the months that ended more than this many months ago")
+@click.option("--tablespace", help="Cold tablespace to move the archived partitions to")
+@click.option("--drop", is_flag=True, help="Drop the old partitions instead of archiving them")
+@click.pass_obj
+def archive(regions, older_than, tablespace, drop):
+    """Detach the partitions of old months"""
+    for region, connection in _each_region(regions):
+        months = archive_partitions(connection, older_than, tablespace, drop)
+        click.echo(f"{region}: {'dropped' if drop else 'archived'} {len(months)} months")
+
+
+@cli.command("migrate")
+@click.pass_obj
+def migrate_tables(regions):
+    """Convert the transaction tables of an existing database to partitioned tables"""
+    from database.models import Transaction, TransactionItem
+    for region, connection in _each_region(regions):
+        migrated = migrate(connection, [Transaction.__table__, TransactionItem.__table__])
+        click.echo(f"{region}: {'migrated' if migrated else 'nothing to migrate'}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,69 +1,159 @@
+import heapq
+import itertools
 import logging
 import math
+from collections import defaultdict
+from datetime import datetime, timedelta
+import tracing
 import utils
-from database.models import User, Group, Transaction, Item, TransactionItem, GroupMemberMR, DB_CONNECTION, \
-    HOME_DB_CONNECTION
+from sqlalchemy import bindparam, insert, inspect, select, tuple_
+from sqlalchemy.exc import IntegrityError
+from database.models import User, Group, GroupName, Transaction, Item, TransactionItem, GroupMemberMR, IdempotencyKey, \
+    GroupDailyRollup, DB_CONNECTION, HOME_DB_CONNECTION, _gen_id, group_member_association
+from database import changes, deadlines, rollup, shards
+from database.errors import CircuitOpenError, DeadlineExceededError, ShardMovingError
+from database.cache import Cache, CoalescedLookup
+from database.health import HealthMonitor
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
-
+HEALTH_MONITOR = HealthMonitor(DB_CONNECTION)
+
+BULK_INSERT_ATTEMPTS = 3
+TRANSACTION_STREAM_BATCH_SIZE = 500
+
+# completed keys never change, retries arriving right after the original skip the database
+IDEMPOTENCY_CACHE = Cache(expiry_seconds=300)
+IDEMPOTENCY_PURGE_EVERY = 1000
+_idempotency_claims = itertools.count()
+
+# The hot reads skip the ORM: their statements are built once, so only their first execution per engine is compiled,
+# and they return plain rows, without identity map or attribute instrumentation, that read like the mapped objects.
+_users, _groups, _items, _mr_members = User.__table__, Group.__table__, Item.__table__, GroupMemberMR.__table__
+USER_BY_ID = select(_users).where(_users.c.user_id == bindparam("user_id"))
+USER_BY_NAME = select(_users).where(_users.c.user_name == bindparam("user_name"))
+GROUP_BY_ID = select(_groups).where(_groups.c.group_id == bindparam("group_id"))
+GROUP_BY_NAME = select(_groups).where(_groups.c.name == bindparam("name"))
+GROUP_ID_BY_NAME = select(GroupName.group_id).where(GroupName.name == bindparam("name"))
+GROUP_MEMBERS = select(group_member_association.c.user_id).where(
+    group_member_association.c.group_id == bindparam("group_id"))
+MULTI_REGION_MEMBERS = select(_mr_members.c.user_id).where(_mr_members.c.group_id == bindparam("group_id"))
+GROUPS_OF_USER = select(_groups.c.group_id, _groups.c.name, _groups.c.owner_id).join(group_member_association).where(
+    group_member_association.c.user_id == bindparam("user_id"))
+MULTI_REGION_GROUPS_OF_USER = select(_mr_members.c.group_id).where(_mr_members.c.user_id == bindparam("user_id"))
+ITEM_BY_ID = select(_items).where(_items.c.item_id == bindparam("item_id"))
+ALL_ITEMS = select(_items)
+
+
+@tracing.traced
 def add_user(user_name, password):
-    home_db_session = HOME_DB_CONNECTION.get_session()
+    with HOME_DB_CONNECTION.get_session() as home_db_session:
+        existing_user = home_db_session.query(User).filter_by(user_name=user_name).first()
+        if existing_user:
+            log.error("Username already exists!")
+            return None
+        new_user = User(user_name=user_name, password=password)
+        home_db_session.add(new_user)
+        home_db_session.commit()
+        log.info(f"User {user_name} added with ID {new_user.user_id}.")
+        return new_user
+
+
+def _membership_event(group_id, user_id, multi_region, group_region, user_region):
+    return changes.event_row(changes.MEMBER_ADDED, {
+        "group_id": group_id, "user_id": user_id, "multi_region": multi_region, "group_region": group_region,
+        "user_region": user_region
+    }, group_id=group_id, user_id=user_id)
+
+
+def _reserve_group_name(main, name, group_id):
+    """Claim a name for a group in the region's main database, False if another group has it"""
+    if name is None:
+        return True
+    with main.get_session() as db_session:
+        db_session.add(GroupName(name=name, group_id=group_id))
+        try:
+            db_session.commit()
+        except IntegrityError:
+            db_session.rollback()
+            return False
+    return True
 
-    existing_user = home_db_session.query(User).filter_by(user_name=user_name).first()
-    if existing_user:
-        log.error("Username already exists!")
-        return None
-    new_user = User(user_name=user_name, password=password)
-    home_db_session.add(new_user)
-    home_db_session.commit()
-    log.info(f"User {user_name} added with ID {new_user.user_id}.")
-    return new_user
 
+def _release_group_name(main, name, group_id):
+    # also for a request whose deadline has passed, the name would stay taken
+    with deadlines.suspended(), main.get_session() as db_session:
+        db_session.query(GroupName).filter_by(name=name, group_id=group_id).delete()
+        db_session.commit()
 
-def add_group(owner_id, name, region, multi_region):
-    db_session = DB_CONNECTION[region].get_session()
 
+@tracing.traced
+def add_group(owner_id, name, region, multi_region):
     # First, create the new group without members
     new_group = Group(name=name, owner_id=owner_id, multi_region=multi_region)
-
-    # Before adding the new group to the session, find the owner by ID
-    owner = db_session.query(User).filter_by(user_id=owner_id).first()
-    if not owner:
-        log.error("Owner not found.")
+    shard = DB_CONNECTION[region].shard_for(new_group.group_id, write=True)
+    # the group's shard can only check the names of its own groups
+    if not _reserve_group_name(DB_CONNECTION[region], name, new_group.group_id):
+        log.error(f"Group name {name} is taken.")
         return None
+    group = None
+    try:
+        group = _create_group(shard, new_group, owner_id, name, region, multi_region)
+        return group
+    finally:
+        # a group that was stored keeps its name even if copying it to the other regions failed
+        if group is None and name is not None and not inspect(new_group).has_identity:
+            _release_group_name(DB_CONNECTION[region], name, new_group.group_id)
+
+
+def _create_group(shard, new_group, owner_id, name, region, multi_region):
+    with shard.get_session() as db_session:
+        shards.lock_bucket(shard, db_session, new_group.group_id)
+        # Before adding the new group to the session, find the owner by ID
+        shards.copy_user(shard, db_session, owner_id)
+        owner = db_session.query(User).filter_by(user_id=owner_id).first()
+        if not owner:
+            log.error("Owner not found.")
+            return None
 
-    if multi_region:
-        db_session.add(new_group)
-        db_session.commit()
-
-        for region_i in DB_CONNECTION:
-            db_session_r = DB_CONNECTION[region_i].get_session()
-            mr_mapping = GroupMemberMR(
-                group_id=new_group.group_id,
-                user_id=owner.user_id,
-                group_region_id=utils.REGIONS_INT[region],
-                user_region_id=utils.REGIONS_INT[region]
-            )
-            db_session_r.add(mr_mapping)
-            db_session_r.commit()
-    else:
-        # Add the owner to the group's members
-        new_group.members.append(owner)
-        # Add the new group to the session and commit
-        db_session.add(new_group)
-        db_session.commit()
+        if multi_region:
+            deadlines.check("creating a multi region group")
+            # every region has to learn of the group once it exists
+            with deadlines.suspended():
+                db_session.add(new_group)
+                db_session.commit()
+
+                for region_i in DB_CONNECTION:
+                    with DB_CONNECTION[region_i].get_session() as db_session_r:
+                        mr_mapping = GroupMemberMR(
+                            group_id=new_group.group_id,
+                            user_id=owner.user_id,
+                            group_region_id=utils.REGIONS_INT[region],
+                            user_region_id=utils.REGIONS_INT[region]
+                        )
+                        db_session_r.add(mr_mapping)
+                        changes.record(db_session_r, [
+                            _membership_event(new_group.group_id, owner.user_id, True, region, region)])
+                        db_session_r.commit()
+        else:
+            # Add the owner to the group's members
+            new_group.members.append(owner)
+            # Add the new group to the session and commit
+            db_session.add(new_group)
+            changes.record(db_session, [_membership_event(new_group.group_id, owner.user_id, False, region, region)])
+            db_session.commit()
 
-    log.info(f"Group {name} added with ID {new_group.group_id}, owner ID {owner_id} added as a member.")
-    return new_group
+        USER_GROUPS.invalidate_all()
+        log.info(f"Group {name} added with ID {new_group.group_id}, owner ID {owner_id} added as a member.")
+        return new_group
 
 
+@tracing.traced
 def authenticate_user(user_name, password, region):
-    db_session = DB_CONNECTION[region].get_session()
-
-    user = db_session.query(User).filter_by(user_name=user_name, password=password).first()
-    if user:
+    # logins against another region are served from the cached user instead of a query over the WAN
+    user = USERS_BY_NAME(user_name, region)
+    if user and user.password == password:
         log.info("Authentication successful!")
         return user
     else:
@@ -71,60 +161,91 @@ def authenticate_user(user_name, password, region):
         return None
 
 
+@tracing.traced
 def add_item(name, price):
-    home_db_session = HOME_DB_CONNECTION.get_session()
-
-    new_item = Item(name=name, price=price)
-    home_db_session.add(new_item)
-    home_db_session.commit()
+    with HOME_DB_CONNECTION.get_session() as home_db_session:
+        new_item = Item(name=name, price=price)
+        home_db_session.add(new_item)
+        home_db_session.commit()
+    # purchases stored on a shard price their items from its copy of the menu
+    for shard in HOME_DB_CONNECTION.shards.values():
+        with shard.get_session() as shard_session:
+            shard_session.merge(Item(item_id=new_item.item_id, name=name, price=price))
+            shard_session.commit()
     log.info(f"Item {name} added with ID {new_item.item_id}.")
     return new_item
 
 
+@tracing.traced
 def add_transaction(user_id, group_id, store, points_redeemed, items):
     try:
-        home_db_session = HOME_DB_CONNECTION.get_session()
-
-        # check if both are part of multi region group
-        mr_mapping = home_db_session.query(GroupMemberMR).filter_by(group_id=group_id, user_id=user_id).first()
-        if mr_mapping:
-            user_region = utils.REGIONS_INT_REV[mr_mapping.user_region_id]
-            group_region = utils.REGIONS_INT_REV[mr_mapping.group_region_id]
-        else:
-            user_region = group_region = utils.REGION_ID
-
-        total = 0
-        for item_data in items:
-            item_id = item_data['item_id']
-            quantity = item_data['quantity']
-            item = home_db_session.query(Item).filter_by(item_id=item_id).first()
-            if not item:
-                raise Exception("Item not found")
-
-            total += item.price * quantity
-        home_db_session.close()
-
-        # redeem points
-        points = modify_group_points(group_region, group_id, total, points_redeemed)
-        if not points:
-            raise Exception("Failed to modify group points.")
-        points_awarded, points_redeemed = points
-
-        # Add the transaction
-        transaction_details = add_transaction_entry(user_region, user_id, group_id, store, total, points_awarded,
-                                                    points_redeemed, items)
+        with HOME_DB_CONNECTION.get_session() as home_db_session:
+            # check if both are part of multi region group
+            mr_mapping = home_db_session.query(GroupMemberMR).filter_by(group_id=group_id, user_id=user_id).first()
+            if mr_mapping:
+                user_region = utils.REGIONS_INT_REV[mr_mapping.user_region_id]
+                group_region = utils.REGIONS_INT_REV[mr_mapping.group_region_id]
+            else:
+                user_region = group_region = utils.REGION_ID
+
+            total = 0
+            for item_data in items:
+                item_id = item_data['item_id']
+                quantity = item_data['quantity']
+                item = home_db_session.execute(ITEM_BY_ID, {"item_id": item_id}).first()
+                if not item:
+                    raise Exception("Item not found")
+
+                total += item.price * quantity
+
+        # looked up once for both writes
+        group_shard = DB_CONNECTION[group_region].shard_for(group_id, write=True)
+        user_shard = DB_CONNECTION[user_region].shard_for(group_id, write=True)
+        deadlines.check("redeeming points")
+        with user_shard.get_session() as entry_session:
+            # the purchase's database transaction holds its bucket from before the points are redeemed so that a move
+            # can't refuse it after they were, it begins with the deadline suspended like the rest of it
+            with deadlines.suspended():
+                shards.lock_bucket(user_shard, entry_session, group_id)
+            # redeem points
+            points = modify_group_points(group_region, group_id, total, points_redeemed, shard=group_shard)
+            if not points:
+                raise Exception("Failed to modify group points.")
+            points_awarded, points_redeemed = points
+
+            # Add the transaction, the points are already redeemed so it is recorded whatever the deadline
+            with deadlines.suspended():
+                transaction_details = add_transaction_entry(user_shard, entry_session, user_id, group_id, store, total,
+                                                            points_awarded, points_redeemed, items)
         if not transaction_details:
             raise Exception("Failed to add transaction")
 
         return transaction_details
+    except (CircuitOpenError, DeadlineExceededError):
+        raise
     except Exception as e:
         log.error(f"Failed to add transaction due to {e}")
         return None, None
 
 
-def modify_group_points(region, group_id, total, points_redeemed):
-    db_session = DB_CONNECTION[region].get_session()
+def _points_event(group, points_awarded, points_redeemed):
+    return changes.event_row(changes.POINTS_CHANGED, {
+        "group_id": group.group_id, "points": group.points, "points_awarded": points_awarded,
+        "points_redeemed": points_redeemed
+    }, group_id=group.group_id)
+
+
+def _transaction_event(transaction, transaction_items):
+    return changes.event_row(changes.TRANSACTION_CREATED, {**transaction.to_dict(), "items": transaction_items},
+                             group_id=transaction.group_id, user_id=transaction.user_id)
+
+
+@tracing.traced
+def modify_group_points(region, group_id, total, points_redeemed, shard=None):
+    shard = shard or DB_CONNECTION[region].shard_for(group_id, write=True)
+    db_session = shard.get_session()
     try:
+        shards.lock_bucket(shard, db_session, group_id)
         group = db_session.query(Group).filter_by(group_id=group_id).with_for_update().one()
 
         # Check if the group has enough points
@@ -138,9 +259,14 @@ def modify_group_points(region, group_id, total, points_redeemed):
             group.points += points_awarded
         else:
             points_awarded = 0
+        changes.record(db_session, [_points_event(group, points_awarded, points_redeemed)])
         db_session.commit()
+        _invalidate_group(group_id, group.name, region)
         log.info(f"New group points: {group.points}")
         return points_awarded, points_redeemed
+    except (CircuitOpenError, DeadlineExceededError):
+        db_session.rollback()
+        raise
     except Exception as e:
         log.error(f"Failed to modify group points due to {e}")
         db_session.rollback()
@@ -148,9 +274,12 @@ def modify_group_points(region, group_id, total, points_redeemed):
         db_session.close()
 
 
-def add_transaction_entry(region, user_id, group_id, store, total, points_awarded, points_redeemed, items):
-    db_session = DB_CONNECTION[region].get_session()
+@tracing.traced
+def add_transaction_entry(shard, db_session, user_id, group_id, store, total, points_awarded, points_redeemed,
+                          items):
+    """Record a purchase in the caller's session on the group's shard, which holds the group's bucket"""
     try:
+        shards.copy_user(shard, db_session, user_id)
         effective_total = total - points_redeemed
 
         # Create and add the transaction
@@ -174,11 +303,16 @@ def add_transaction_entry(region, user_id, group_id, store, total, points_awarde
                 raise Exception("Item not found")
 
             item_total = item.price * quantity
-            transaction_item = TransactionItem(transaction_id=new_transaction.transaction_id, item_id=item_id,
+            transaction_item = TransactionItem(transaction_id=new_transaction.transaction_id,
+                                               transaction_timestamp=new_transaction.timestamp, item_id=item_id,
                                                quantity=quantity,
                                                item_total=item_total)
             transaction_items.append(transaction_item.to_dict())
             db_session.add(transaction_item)
+        changes.record(db_session, [_transaction_event(new_transaction, transaction_items)])
+        # last, the store's rollup row is locked until the commit; waiting for it is safe after the change event, the
+        # feed orders events by their transaction and not by when they were built
+        rollup.record_transactions(db_session, [new_transaction])
         db_session.commit()
         log.info(
             f"Transaction added for user {user_id} in group {group_id}. Points redeemed: {points_redeemed}.")
@@ -186,142 +320,564 @@ def add_transaction_entry(region, user_id, group_id, store, total, points_awarde
     except Exception as e:
         log.error(f"Failed to add transaction due to {e}")
         db_session.rollback()
-    finally:
-        db_session.close()
 
+@tracing.traced
+def add_transactions_bulk(user_id, records):
+    """Apply a chunk of validated purchases with one price and mapping lookup, one points update per group and bulk
+    inserts. Returns one entry per record, the transaction dict or an error message."""
+    results = [None] * len(records)
+    with HOME_DB_CONNECTION.get_session() as home_db_session:
+        item_ids = {item['item_id'] for record in records for item in record['items']}
+        prices = dict(home_db_session.query(Item.item_id, Item.price).filter(Item.item_id.in_(item_ids)).all())
+        group_ids = {record['group_id'] for record in records}
+        mr_regions = {
+            mapping.group_id: (utils.REGIONS_INT_REV[mapping.user_region_id],
+                               utils.REGIONS_INT_REV[mapping.group_region_id])
+            for mapping in home_db_session.query(GroupMemberMR).filter(
+                GroupMemberMR.user_id == user_id, GroupMemberMR.group_id.in_(group_ids))
+        }
+
+    planned = []
+    for index, record in enumerate(records):
+        missing = sorted({item['item_id'] for item in record['items']} - prices.keys())
+        if missing:
+            results[index] = f"Item not found: {missing}"
+            continue
+        record = {**record, "prices": [prices[item['item_id']] for item in record['items']]}
+        total = sum(price * item['quantity'] for price, item in zip(record['prices'], record['items']))
+        user_region, group_region = mr_regions.get(record['group_id'], (utils.REGION_ID, utils.REGION_ID))
+        try:
+            # purchases are stored on the group's shard of the buyer's region
+            user_shard = DB_CONNECTION[user_region].shard_for(record['group_id'], write=True)
+            group_shard = DB_CONNECTION[group_region].shard_for(record['group_id'], write=True)
+        except ShardMovingError:
+            results[index] = "Group is moving to another shard, try again later"
+            continue
+        planned.append((index, record, total, (user_region, user_shard.name), (group_region, group_shard.name)))
+
+    # a chunk that still collides with an id inserted concurrently is rolled back and retried
+    for attempt in range(1, BULK_INSERT_ATTEMPTS + 1):
+        try:
+            transactions = _apply_transactions_bulk(user_id, planned, results)
+            log.info(f"Bulk added {len(transactions)} of {len(records)} transactions for user {user_id}.")
+            return [transactions[index].to_dict() if index in transactions else result
+                    for index, result in enumerate(results)]
+        except IntegrityError as e:
+            log.warning(f"Bulk transaction insert attempt {attempt} failed due to {e.orig!r}")
+            error = e
+        except Exception as e:
+            log.error(f"Failed to bulk add transactions due to {e}")
+            error = e
+            break
+    return [result or f"Batch failed - {type(error).__name__}" for result in results]
+
+
+def _apply_transactions_bulk(user_id, planned, results):
+    """Entries of `planned` locate the buyer and the group by (region, shard), one database session is used per
+    location"""
+    for index, *_ in planned:
+        results[index] = None
+    sessions = {}
+
+    def session(location):
+        if location not in sessions:
+            region, shard = location
+            sessions[location] = DB_CONNECTION[region].shard(shard).get_session()
+        return sessions[location]
+
+    try:
+        # hold the buckets of the chunk's groups on every shard it writes to until the commit, the purchases of groups
+        # that are moving are refused before anything is written
+        moving = set()
+        locations = defaultdict(set)
+        for _, record, _, user_location, group_location in planned:
+            locations[user_location].add(record['group_id'])
+            locations[group_location].add(record['group_id'])
+        for location in sorted(locations):
+            region, shard = location
+            for group_id in sorted(locations[location]):
+                try:
+                    shards.lock_bucket(DB_CONNECTION[region].shard(shard), session(location), group_id)
+                except ShardMovingError:
+                    moving.add(group_id)
+        for index, record, *_ in planned:
+            if record['group_id'] in moving:
+                results[index] = "Group is moving to another shard, try again later"
+        planned = [entry for entry in planned if entry[1]['group_id'] not in moving]
+
+        # lock every group of the chunk once, in a fixed order so concurrent batches cannot deadlock
+        groups = {}
+        for location in sorted({group_location for *_, group_location in planned}):
+            location_group_ids = sorted({record['group_id'] for _, record, _, _, group_location in planned
+                                         if group_location == location})
+            locked = session(location).query(Group).filter(Group.group_id.in_(location_group_ids)) \
+                .order_by(Group.group_id).with_for_update()
+            groups.update({(location, group.group_id): group for group in locked})
+
+        added = {}
+        transactions = defaultdict(list)
+        points_changes = {}
+        for index, record, total, user_location, group_location in planned:
+            group = groups.get((group_location, record['group_id']))
+            if group is None:
+                results[index] = "Group not found"
+                continue
+            points_redeemed = record['points_redeemed']
+            if group.points < points_redeemed:
+                results[index] = "Not enough points in the group to redeem"
+                continue
+
+            # points changes accumulate on the locked row and are flushed as one update per group
+            group.points -= points_redeemed
+            points_awarded = math.ceil(total / 10) if points_redeemed == 0 else 0
+            group.points += points_awarded
+            awarded, redeemed = points_changes.get((group_location, group), (0, 0))
+            points_changes[(group_location, group)] = (awarded + points_awarded, redeemed + points_redeemed)
+
+            new_transaction = Transaction(user_id=user_id, group_id=record['group_id'], store=record['store'],
+                                          total=total - points_redeemed, points_redeemed=points_redeemed,
+                                          points_awarded=points_awarded)
+            if record.get('timestamp'):
+                new_transaction.timestamp = record['timestamp']
+            added[index] = new_transaction
+            transactions[user_location].append((new_transaction, record))
+
+        for location, location_transactions in transactions.items():
+            db_session = session(location)
+            region, shard = location
+            shards.copy_user(DB_CONNECTION[region].shard(shard), db_session, user_id)
+            _redraw_taken_transaction_ids(db_session, [transaction for transaction, _ in location_transactions])
+            db_session.add_all(transaction for transaction, _ in location_transactions)
+            db_session.flush()
+            lines = {transaction: [{"transaction_id": transaction.transaction_id, "item_id": item['item_id'],
+                                    "quantity": item['quantity'], "item_total": price * item['quantity']}
+                                   for item, price in zip(record['items'], record['prices'])]
+                     for transaction, record in location_transactions}
+            db_session.execute(insert(TransactionItem), [
+                {**line, "transaction_item_id": _gen_id(), "transaction_timestamp": transaction.timestamp}
+                for transaction, transaction_lines in lines.items() for line in transaction_lines
+            ])
+            changes.record(db_session, [_transaction_event(transaction, transaction_lines)
+                                        for transaction, transaction_lines in lines.items()])
+            # last, like add_transaction_entry
+            rollup.record_transactions(db_session, [transaction for transaction, _ in location_transactions])
+
+        # one event per group with the points it was awarded and redeemed in the chunk
+        points_events = defaultdict(list)
+        for (location, group), (points_awarded, points_redeemed) in points_changes.items():
+            points_events[location].append(_points_event(group, points_awarded, points_redeemed))
+        for location, location_events in points_events.items():
+            changes.record(sessions[location], location_events)
+
+        for location in sorted(sessions):
+            sessions[location].commit()
+        for (region, _), group in points_changes:
+            _invalidate_group(group.group_id, group.name, region)
+        return added
+    except Exception:
+        for db_session in sessions.values():
+            db_session.rollback()
+        raise
+    finally:
+        for db_session in sessions.values():
+            db_session.close()
+
+
+def _redraw_taken_transaction_ids(db_session, transactions):
+    """Random ids collide often enough at batch sizes to fail a whole chunk, draw new ones for ids already in use"""
+    accepted = set()
+    pending = transactions
+    while pending:
+        taken = {transaction_id for transaction_id, in db_session.query(Transaction.transaction_id).filter(
+            Transaction.transaction_id.in_([transaction.transaction_id for transaction in pending]))}
+        clashing = []
+        for transaction in pending:
+            if transaction.transaction_id in taken or transaction.transaction_id in accepted:
+                transaction.transaction_id = _gen_id()
+                clashing.append(transaction)
+            else:
+                accepted.add(transaction.transaction_id)
+        pending = clashing
+
+
+@tracing.traced
+def claim_idempotency_key(user_name, key, request_hash):
+    """Reserve a key for one request. Returns the state, one of claimed, completed, in_progress or mismatch, and the
+    stored key if there is one."""
+    cached = IDEMPOTENCY_CACHE.get((user_name, key))
+    if cached is not None:
+        return ("completed" if cached.request_hash == request_hash else "mismatch"), cached
+
+    now = datetime.now()
+    with HOME_DB_CONNECTION.get_session() as home_db_session:
+        if next(_idempotency_claims) % IDEMPOTENCY_PURGE_EVERY == 0:
+            purged = home_db_session.query(IdempotencyKey).filter(
+                IdempotencyKey.created_at < now - timedelta(seconds=utils.IDEMPOTENCY_KEY_TTL_SECONDS)).delete()
+            home_db_session.commit()
+            log.info(f"Purged {purged} expired idempotency keys.")
+
+        home_db_session.add(IdempotencyKey(user_name=user_name, key=key, request_hash=request_hash,
+                                           status="in_progress", created_at=now))
+        try:
+            home_db_session.commit()
+            return "claimed", None
+        except IntegrityError:
+            home_db_session.rollback()
+
+        existing = home_db_session.query(IdempotencyKey).filter_by(user_name=user_name, key=key).first()
+        if existing is None:
+            # released by a failed request in the meantime, the client retries
+            return "in_progress", None
+        expired = existing.created_at < now - timedelta(seconds=utils.IDEMPOTENCY_KEY_TTL_SECONDS)
+        abandoned = existing.status == "in_progress" and \
+            existing.created_at < now - timedelta(seconds=utils.IDEMPOTENCY_LOCK_SECONDS)
+        if expired or abandoned:
+            # take the key over unless another request already did
+            taken = home_db_session.query(IdempotencyKey).filter_by(
+                user_name=user_name, key=key, created_at=existing.created_at
+            ).update({"request_hash": request_hash, "status": "in_progress", "response_code": None,
+                      "response_body": None, "created_at": now})
+            home_db_session.commit()
+            return ("claimed" if taken else "in_progress"), None
+
+        if existing.request_hash != request_hash:
+            return "mismatch", existing
+        if existing.status == "completed":
+            IDEMPOTENCY_CACHE.put((user_name, key), existing)
+            return "completed", existing
+        return "in_progress", existing
+
+
+@tracing.traced
+def complete_idempotency_key(user_name, key, request_hash, response_code, response_body):
+    with HOME_DB_CONNECTION.get_session() as home_db_session:
+        home_db_session.query(IdempotencyKey).filter_by(user_name=user_name, key=key).update(
+            {"status": "completed", "response_code": response_code, "response_body": response_body})
+        home_db_session.commit()
+    IDEMPOTENCY_CACHE.put((user_name, key), IdempotencyKey(
+        user_name=user_name, key=key, request_hash=request_hash, status="completed", response_code=response_code,
+        response_body=response_body))
+
+
+@tracing.traced
+def release_idempotency_key(user_name, key):
+    """Forget a key whose request failed so that it can be retried"""
+    with HOME_DB_CONNECTION.get_session() as home_db_session:
+        home_db_session.query(IdempotencyKey).filter_by(user_name=user_name, key=key, status="in_progress").delete()
+        home_db_session.commit()
+
+
+@tracing.traced
 def get_user_details(user_id, region=utils.REGION_ID):
-    db_session = DB_CONNECTION[region].get_session()
+    return USERS_BY_ID(user_id, region)
 
-    user = db_session.query(User).filter_by(user_id=user_id).first()
-    if not user:
-        log.error("User not found!")
-        return None
-    return user
+
+@tracing.traced
+def _load_user_details(user_id, region):
+    with DB_CONNECTION[region].get_session() as db_session:
+        user = db_session.execute(USER_BY_ID, {"user_id": user_id}).first()
+        if not user:
+            log.error("User not found!")
+            return None
+        return user
 
 
+@tracing.traced
 def get_user_groups_by_username(user_name, region=utils.REGION_ID):
-    db_session = DB_CONNECTION[region].get_session()
-    user = db_session.query(User).filter_by(user_name=user_name).first()
-    if not user:
-        log.error("User not found!")
-        return None
-    sr_groups = [{"group_id": group.group_id, "name": group.name, "owner_id": group.owner_id} for group in user.groups]
-    group_member_mr_mapping = db_session.query(GroupMemberMR).filter_by(user_id=user.user_id).all()
-    # TODO based on region_id of group do a recursive loopkup
-    mr_groups = [mapping.group_id for mapping in group_member_mr_mapping]
+    return USER_GROUPS(user_name, region)
 
-    return {
-        "multi_region": mr_groups,
-        "single_region": sr_groups
-    }
 
+@tracing.traced
+def _load_user_groups_by_username(user_name, region):
+    with DB_CONNECTION[region].get_session() as db_session:
+        user = db_session.execute(USER_BY_NAME, {"user_name": user_name}).first()
+        if not user:
+            log.error("User not found!")
+            return None
+        parameters = {"user_id": user.user_id}
+        sr_groups = [dict(group._mapping) for group in db_session.execute(GROUPS_OF_USER, parameters)]
+        for shard in DB_CONNECTION[region].shards.values():
+            with shard.get_session() as shard_session:
+                sr_groups.extend(dict(group._mapping) for group in shard_session.execute(GROUPS_OF_USER, parameters))
+        # TODO based on region_id of group do a recursive loopkup
+        mr_groups = list(db_session.execute(MULTI_REGION_GROUPS_OF_USER, parameters).scalars())
+
+        return {
+            "multi_region": mr_groups,
+            "single_region": sr_groups
+        }
 
+
+@tracing.traced
 def get_user_details_by_username(user_name, user_region):
-    db_session = DB_CONNECTION[user_region].get_session()
+    return USERS_BY_NAME(user_name, user_region)
 
-    user = db_session.query(User).filter_by(user_name=user_name).first()
-    if not user:
-        log.error("User not found!")
-        return None
-    return user
 
+@tracing.traced
+def _load_user_details_by_username(user_name, user_region):
+    with DB_CONNECTION[user_region].get_session() as db_session:
+        user = db_session.execute(USER_BY_NAME, {"user_name": user_name}).first()
+        if not user:
+            log.error("User not found!")
+            return None
+        return user
 
-def get_group_details(group_id, region):
-    db_session = DB_CONNECTION[region].get_session()
 
-    group = db_session.query(Group).filter_by(group_id=group_id).first()
-    if not group:
-        log.error("Group not found!")
-        return None
+@tracing.traced
+def get_group_details(group_id, region):
+    return GROUP_DETAILS(group_id, region)
 
-    # if multi region entry, get members from group_member
-    if group.multi_region:
-        group_member_mr_mapping = db_session.query(GroupMemberMR).filter_by(group_id=group_id).all()
-        members = [member.user_id for member in group_member_mr_mapping]
-    else:
-        # Load members lazily
-        members = [member.user_id for member in group.members]
-    group_details = {
-        "group_id": group.group_id,
-        "name": group.name,
-        "owner_id": group.owner_id,
-        "points": group.points,
-        "members": members
-    }
-    return group_details
 
+@tracing.traced
+def _load_group_details(group_id, region):
+    shard = DB_CONNECTION[region].shard_for(group_id)
+    with shard.get_session() as db_session:
+        group = db_session.execute(GROUP_BY_ID, {"group_id": group_id}).first()
+        if not group:
+            log.error("Group not found!")
+            return None
 
-def get_group_by_name(group_name, region=utils.REGION_ID):
-    home_db_session = DB_CONNECTION[region].get_session()
+        # if multi region entry, get members from group_member
+        if group.multi_region:
+            members = _multi_region_members(group_id, region, shard, db_session)
+        else:
+            members = list(db_session.execute(GROUP_MEMBERS, {"group_id": group_id}).scalars())
+        group_details = {
+            "group_id": group.group_id,
+            "name": group.name,
+            "owner_id": group.owner_id,
+            "points": group.points,
+            "members": members
+        }
+        return group_details
 
-    group = home_db_session.query(Group).filter_by(name=group_name).first()
-    if not group:
-        log.error("Group not found!")
-        return None
 
-    return group
+# members of a group ask for the same details at the same moment, the lookups are coalesced and cached briefly;
+# writes in this process invalidate them, other processes see them after READ_CACHE_TTL_SECONDS at most
+GROUP_DETAILS = CoalescedLookup(_load_group_details, utils.READ_CACHE_TTL_SECONDS, utils.READ_CACHE_MAX_ITEMS)
+USER_GROUPS = CoalescedLookup(_load_user_groups_by_username, utils.READ_CACHE_TTL_SECONDS,
+                              utils.READ_CACHE_MAX_ITEMS)
 
 
-def add_member_to_group(member_id, group_id, member_region, group_region):
-    group_db_session = DB_CONNECTION[group_region].get_session()
-    group = group_db_session.query(Group).filter_by(group_id=group_id).first()
-
-    if group.multi_region:
-        group_member_mr_mapping = group_db_session.query(GroupMemberMR).filter_by(group_id=group_id).all()
-        members = [member.user_id for member in group_member_mr_mapping]
-        if len(members) >= 4:
-            return False, "Group is full!"
-
-        if member_id in members:
-            return False, "User already in group!"
-
-        for region_i in DB_CONNECTION:
-            db_session = DB_CONNECTION[region_i].get_session()
-            mr_mapping = GroupMemberMR(
-                group_id=group_id,
-                user_id=member_id,
-                group_region_id=utils.REGIONS_INT[group_region],
-                user_region_id=utils.REGIONS_INT[member_region]
-            )
-            db_session.add(mr_mapping)
-            db_session.commit()
-        log.info(f"User '{member_id}' added to group '{group_id}'.")
-        return True, None
+def _multi_region_members(group_id, region, shard, db_session):
+    """Multi region memberships are kept in the main database of every region"""
+    if shard.main is None:
+        return list(db_session.execute(MULTI_REGION_MEMBERS, {"group_id": group_id}).scalars())
+    with DB_CONNECTION[region].get_session() as main_session:
+        return list(main_session.execute(MULTI_REGION_MEMBERS, {"group_id": group_id}).scalars())
 
-    else:
-        member = group_db_session.query(User).filter_by(user_id=member_id).first()
-        if member in group.members:
-            return False, "User already in group!"
-        if len(group.members) >= 4:
-            return False, "Group is full!"
-        group.members.append(member)
-        group_db_session.commit()
-        log.info(f"User {member_id} added to group {group_id}.")
-        return True, None
 
+def _invalidate_group(group_id, name=None, region=None):
+    # a multi region group's members are replicated, its details can be read through any region
+    for details_region in utils.REGIONS:
+        GROUP_DETAILS.invalidate(group_id, details_region)
+    if name is not None:
+        GROUPS_BY_NAME.invalidate(name, region)
 
-def get_item(item_id):
-    home_db_session = HOME_DB_CONNECTION.get_session()
 
-    return home_db_session.query(Item).filter_by(item_id=item_id).first()
+@tracing.traced
+def get_group_by_name(group_name, region=utils.REGION_ID):
+    return GROUPS_BY_NAME(group_name, region)
+
+
+@tracing.traced
+def _load_group_by_name(group_name, region):
+    main = DB_CONNECTION[region]
+    if main.shards:
+        # names do not say which shard a group is on, the main database's name index does
+        with main.get_session() as db_session:
+            group_id = db_session.execute(GROUP_ID_BY_NAME, {"name": group_name}).scalar()
+        group = None
+        if group_id is not None:
+            with main.shard_for(group_id).get_session() as db_session:
+                group = db_session.execute(GROUP_BY_ID, {"group_id": group_id}).first()
+    else:
+        with main.get_session() as db_session:
+            group = db_session.execute(GROUP_BY_NAME, {"name": group_name}).first()
+    if group is None:
+        log.error("Group not found!")
+    return group
 
 
-def get_items():
-    home_db_session = HOME_DB_CONNECTION.get_session()
+# users and groups rarely change, often live in another region and are looked up on every request. The cached rows
+# are immutable and shared; a group's points are invalidated locally, other processes read fresh points through
+# get_group_details.
+USERS_BY_NAME = CoalescedLookup(_load_user_details_by_username, utils.LOOKUP_CACHE_TTL_SECONDS,
+                                utils.LOOKUP_CACHE_MAX_ITEMS, copy_results=False)
+USERS_BY_ID = CoalescedLookup(_load_user_details, utils.LOOKUP_CACHE_TTL_SECONDS, utils.LOOKUP_CACHE_MAX_ITEMS,
+                              copy_results=False)
+GROUPS_BY_NAME = CoalescedLookup(_load_group_by_name, utils.LOOKUP_CACHE_TTL_SECONDS, utils.LOOKUP_CACHE_MAX_ITEMS,
+                                 copy_results=False)
 
-    items = home_db_session.query(Item).all()
-    return items
 
+@tracing.traced
+def add_member_to_group(member_id, group_id, member_region, group_region):
+    shard = DB_CONNECTION[group_region].shard_for(group_id, write=True)
+    with shard.get_session() as group_db_session:
+        shards.lock_bucket(shard, group_db_session, group_id)
+        group = group_db_session.query(Group).filter_by(group_id=group_id).first()
+
+        if group.multi_region:
+            members = _multi_region_members(group_id, group_region, shard, group_db_session)
+            if len(members) >= 4:
+                return False, "Group is full!"
+
+            if member_id in members:
+                return False, "User already in group!"
+
+            deadlines.check("adding a multi region member")
+            # a membership known to some regions only is worse than a late answer
+            with deadlines.suspended():
+                for region_i in DB_CONNECTION:
+                    with DB_CONNECTION[region_i].get_session() as db_session:
+                        mr_mapping = GroupMemberMR(
+                            group_id=group_id,
+                            user_id=member_id,
+                            group_region_id=utils.REGIONS_INT[group_region],
+                            user_region_id=utils.REGIONS_INT[member_region]
+                        )
+                        db_session.add(mr_mapping)
+                        changes.record(db_session, [
+                            _membership_event(group_id, member_id, True, group_region, member_region)])
+                        db_session.commit()
+            _invalidate_group(group_id)
+            USER_GROUPS.invalidate_all()
+            log.info(f"User '{member_id}' added to group '{group_id}'.")
+            return True, None
 
-def get_user_transactions(user_id):
-    home_db_session = HOME_DB_CONNECTION.get_session()
+        else:
+            shards.copy_user(shard, group_db_session, member_id)
+            member = group_db_session.query(User).filter_by(user_id=member_id).first()
+            if member in group.members:
+                return False, "User already in group!"
+            if len(group.members) >= 4:
+                return False, "Group is full!"
+            group.members.append(member)
+            changes.record(group_db_session, [_membership_event(group_id, member_id, False, group_region,
+                                                                member_region)])
+            group_db_session.commit()
+            _invalidate_group(group_id)
+            USER_GROUPS.invalidate_all()
+            log.info(f"User {member_id} added to group {group_id}.")
+            return True, None
+
+
+@tracing.traced
+def get_item(item_id):
+    with HOME_DB_CONNECTION.get_session() as home_db_session:
+        return home_db_session.execute(ITEM_BY_ID, {"item_id": item_id}).first()
 
-    transactions = home_db_session.query(Transaction).filter_by(user_id=user_id).all()
-    return transactions
 
+@tracing.traced
+def get_items():
+    with HOME_DB_CONNECTION.get_session() as home_db_session:
+        return home_db_session.execute(ALL_ITEMS).all()
+
+
+def get_user_transactions(user_id, region=utils.REGION_ID, after=None, start=None, end=None, limit=None,
+                          include_items=False):
+    """Yield the user's transactions newest first, continuing after the (timestamp, transaction_id) key `after`.
+    Rows are streamed in batches so memory does not grow with the length of the history. The histories on the
+    region's shards are merged."""
+    histories = [_iter_transactions(shard, Transaction.user_id == user_id, after, start, end, limit, include_items)
+                 for shard in DB_CONNECTION[region].shard_connections()]
+    if len(histories) == 1:
+        return histories[0]
+    merged = heapq.merge(*histories, key=transaction_key, reverse=True)
+    return itertools.islice(merged, limit) if limit else merged
+
+
+def get_group_transactions(group_id, region=utils.REGION_ID, after=None, start=None, end=None, limit=None,
+                           include_items=False):
+    """Like get_user_transactions, None if the group does not exist. The histories of a multi region group's regions
+    are merged."""
+    regions = _group_transaction_regions(group_id, region)
+    if not regions:
+        return None
+    histories = [_iter_transactions(DB_CONNECTION[history_region].shard_for(group_id), Transaction.group_id == group_id,
+                                    after, start, end, limit, include_items) for history_region in regions]
+    merged = heapq.merge(*histories, key=transaction_key, reverse=True)
+    return itertools.islice(merged, limit) if limit else merged
+
+
+@tracing.traced
+def get_group_summary(group_id, region=utils.REGION_ID, start=None, end=None):
+    """Daily spend and points of a group read from the rollups of every region its purchases are stored in, None if
+    the group does not exist"""
+    regions = _group_transaction_regions(group_id, region)
+    if not regions:
+        return None
+    days = defaultdict(lambda: dict.fromkeys(rollup.MEASURES, 0))
+    for summary_region in regions:
+        with DB_CONNECTION[summary_region].shard_for(group_id).get_session() as db_session:
+            query = db_session.query(GroupDailyRollup).filter(GroupDailyRollup.group_id == group_id)
+            if start:
+                query = query.filter(GroupDailyRollup.day >= start)
+            if end:
+                query = query.filter(GroupDailyRollup.day < end)
+            for row in query:
+                for measure in rollup.MEASURES:
+                    days[row.day][measure] += getattr(row, measure)
+    return {
+        "group_id": group_id,
+        "totals": {measure: sum(day[measure] for day in days.values()) for measure in rollup.MEASURES},
+        "days": [{"day": day.isoformat(), **measures} for day, measures in sorted(days.items())]
+    }
 
-def get_group_transactions(group_id):
-    home_db_session = HOME_DB_CONNECTION.get_session()
 
-    transactions = home_db_session.query(Transaction).filter_by(group_id=group_id).all()
-    return transactions
+def _group_transaction_regions(group_id, region):
+    """Purchases of a multi region group are stored in their buyer's region"""
+    with DB_CONNECTION[region].shard_for(group_id).get_session() as db_session:
+        group = db_session.query(Group.multi_region).filter_by(group_id=group_id).first()
+    if not group:
+        log.error("Group not found!")
+        return None
+    return utils.REGIONS if group.multi_region else [region]
+
+
+def transaction_key(transaction):
+    return transaction["timestamp"], transaction["transaction_id"]
+
+
+@tracing.traced
+def _iter_transactions(connection, criterion, after, start, end, limit, include_items):
+    columns = Transaction.__table__.c
+    statement = select(Transaction.__table__).where(criterion)
+    if start:
+        statement = statement.where(columns.timestamp >= start)
+    if end:
+        statement = statement.where(columns.timestamp < end)
+    if after:
+        statement = statement.where(tuple_(columns.timestamp, columns.transaction_id) < tuple(after))
+    statement = statement.order_by(columns.timestamp.desc(), columns.transaction_id.desc())
+    if limit:
+        statement = statement.limit(limit)
+
+    with connection.get_session() as db_session:
+        result = db_session.execute(
+            statement.execution_options(stream_results=True, yield_per=TRANSACTION_STREAM_BATCH_SIZE))
+        for partition in result.partitions():
+            transactions = [dict(row._mapping) for row in partition]
+            if include_items:
+                # one query for the item lines of the whole batch, bounded in time to skip the other partitions
+                items = defaultdict(list)
+                for line in db_session.execute(select(TransactionItem.__table__).where(
+                        TransactionItem.transaction_id.in_([t["transaction_id"] for t in transactions]),
+                        TransactionItem.transaction_timestamp.between(transactions[-1]["timestamp"],
+                                                                      transactions[0]["timestamp"]))):
+                    items[line.transaction_id].append(
+                        {"item_id": line.item_id, "quantity": line.quantity, "item_total": line.item_total})
+                for transaction in transactions:
+                    transaction["items"] = items[transaction["transaction_id"]]
+            yield from transactions
+
+
+@tracing.traced
+def get_change_events(region=utils.REGION_ID, after=0, limit=100, shard=utils.MAIN_SHARD):
+    """The change feed of one of the region's shards after the event id `after`"""
+    return changes.read(region, after, limit, shard)
+
+
+def get_database_health():
+    HEALTH_MONITOR.start()
+    return HEALTH_MONITOR.status()
@@ -0,0 +1,114 @@
+"""Daily spend and points rollups per group, user and store.
+
+The rollups are updated in the database transaction that stores the purchases, so they always agree with the
+transaction table of their region. The price is contention: every purchase at a store on a day updates the same
+store_daily_rollup row and holds its lock until commit, so a store's purchases commit one at a time. The write paths
+upsert the rollups as their last statement to keep that window short. That is after the change events, which the
+feed serves by their transaction once it ended, however long it waited (see database/changes.py). A store busier than
+that allows would need its rollup updated from the change feed instead, trading consistency for a few seconds of
+lag. Rows loaded around the write path are picked up by a rebuild:
+
+    python -m database.rollup --region EUW
+"""
+import logging
+from collections import defaultdict
+
+import click
+from sqlalchemy import delete, func, insert, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+import utils
+from database.models import GroupDailyRollup, UserDailyRollup, StoreDailyRollup, Transaction, DB_CONNECTION
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+ROLLUPS = ((GroupDailyRollup, "group_id"), (UserDailyRollup, "user_id"), (StoreDailyRollup, "store"))
+MEASURES = ("transactions", "spend", "points_awarded", "points_redeemed")
+REFRESH_BATCH_SIZE = 1000
+
+
+def record_transactions(db_session, transactions):
+    """Add new transactions to the rollups with one upsert per rollup table"""
+    dialect = db_session.get_bind().dialect.name
+    for model, key in ROLLUPS:
+        deltas = defaultdict(lambda: dict.fromkeys(MEASURES, 0))
+        for transaction in transactions:
+            delta = deltas[(getattr(transaction, key), transaction.timestamp.date())]
+            delta["transactions"] += 1
+            delta["spend"] += transaction.total
+            delta["points_awarded"] += transaction.points_awarded
+            delta["points_redeemed"] += transaction.points_redeemed
+        # sorted so that concurrent writers lock the rollup rows in the same order
+        rows = [{key: key_value, "day": day, **delta} for (key_value, day), delta in sorted(deltas.items())]
+        db_session.execute(_upsert(dialect, model.__table__, key), rows)
+
+
+def _upsert(dialect, table, key):
+    if dialect == "postgresql":
+        statement = postgresql.insert(table)
+    elif dialect == "sqlite":
+        statement = sqlite.insert(table)
+    else:
+        raise NotImplementedError(f"Rollups need an upsert, which is not implemented for {dialect}")
+    return statement.on_conflict_do_update(
+        index_elements=[key, "day"],
+        set_={measure: table.c[measure] + statement.excluded[measure] for measure in MEASURES}
+    )
+
+
+def rebuild(connection):
+    """Recompute every rollup from the transaction table"""
+    transactions = Transaction.__table__.c
+    day = func.date(transactions.timestamp)
+    for model, key in ROLLUPS:
+        model.__table__.create(connection, checkfirst=True)
+        connection.execute(delete(model.__table__))
+        totals = select(transactions[key], day, func.count(), func.sum(transactions.total),
+                        func.sum(transactions.points_awarded), func.sum(transactions.points_redeemed)) \
+            .group_by(transactions[key], day)
+        connection.execute(insert(model.__table__).from_select([key, "day", *MEASURES], totals))
+        log.info(f"Rebuilt {model.__tablename__}.")
+
+
+def affected_keys(transactions, keys=None):
+    """Add the (key, day) rows of every rollup that the transactions count towards to `keys`"""
+    keys = keys if keys is not None else {key: set() for _, key in ROLLUPS}
+    for transaction in transactions:
+        for _, key in ROLLUPS:
+            keys[key].add((getattr(transaction, key), transaction.timestamp.date()))
+    return keys
+
+
+def refresh(connection, keys):
+    """Recompute the rollup rows collected by affected_keys from the transaction table, e.g. after transactions were
+    moved in or out of the database"""
+    transactions = Transaction.__table__.c
+    day = func.date(transactions.timestamp)
+    for model, key in ROLLUPS:
+        table = model.__table__
+        rows = sorted(keys[key])
+        for start in range(0, len(rows), REFRESH_BATCH_SIZE):
+            batch = rows[start:start + REFRESH_BATCH_SIZE]
+            connection.execute(delete(table).where(tuple_(table.c[key], table.c.day).in_(batch)))
+            totals = select(transactions[key], day, func.count(), func.sum(transactions.total),
+                            func.sum(transactions.points_awarded), func.sum(transactions.points_redeemed)) \
+                .where(tuple_(transactions[key], day).in_(batch)).group_by(transactions[key], day)
+            connection.execute(insert(table).from_select([key, "day", *MEASURES], totals))
+
+
+@click.command()
+@click.option("--region", "regions", multiple=True, type=click.Choice(utils.REGIONS),
+              help="Region to rebuild, all regions by default")
+def main(regions):
+    """Rebuild the daily rollups from the transaction table"""
+    for region in regions or utils.REGIONS:
+        for connection in DB_CONNECTION[region].shard_connections():
+            with connection.get_session() as db_session:
+                rebuild(db_session.connection())
+                db_session.commit()
+            click.echo(f"Rebuilt rollups of {region} {connection.name}")
+
+
+if __name__ == "__main__":
+    main()
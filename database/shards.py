@@ -0,0 +1,304 @@
+"""Shards of a region's groups and their purchases.
+
+A region can spread its write load over several primaries: besides its main database, which keeps the users, the
+menu and the multi region memberships, EUW_SHARDS=s1,s2 adds the shards s1 and s2 (EUW_SHARD_S1_DB_URLS, ...). A
+group, its memberships, its points and the purchases stored in the region for it live on the shard of its bucket,
+group_id modulo SHARD_BUCKETS. The bucket map is the shard_bucket table of the main database, buckets without a row
+are on the main database. Shards keep a copy of the menu and of the users their rows reference.
+
+`move` moves one bucket online: its purchases are copied while it keeps taking writes, then it is frozen, writes to
+its groups are refused with 503 for the few seconds the remaining rows take, and the map points to the new shard.
+The old shard's rows are deleted once every process reloaded the map. Writes hold their bucket's advisory lock on
+their shard until they commit and a move holds it exclusively from the final copy to the delete, so a write that
+looked the bucket up before it was frozen either finishes before the final copy or is refused. Change events stay in
+the feed of the shard they were written to. `rebalance` spreads the buckets evenly, one move at a time:
+
+    python -m database.shards status --region EUW
+    python -m database.shards move --region EUW --bucket 17 --to s1
+    python -m database.shards rebalance --region EUW --limit 16
+"""
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import click
+from sqlalchemy import delete, func, insert, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+import utils
+from database import partitions, rollup
+from database.errors import ShardMovingError
+from database.models import Group, Item, ShardBucket, Transaction, TransactionItem, User, \
+    group_member_association, bucket_of, DB_CONNECTION
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+COPY_BATCH_SIZE = 5000
+# on top of the shard map's TTL, for the reads of processes that loaded the map just before it changed
+MOVE_GRACE_SECONDS = 2
+# first key of the buckets' advisory locks, the bucket is the second
+BUCKET_LOCK_CLASS = 0x5348
+
+
+def _dialect_insert(connection, table):
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(table)
+    if dialect == "sqlite":
+        return sqlite.insert(table)
+    raise NotImplementedError(f"Shards need upserts, which are not implemented for {dialect}")
+
+
+def insert_ignoring_conflicts(connection, table):
+    return _dialect_insert(connection, table).on_conflict_do_nothing()
+
+
+def copy_user(shard, db_session, user_id):
+    """Copy a user from the region's main database to a shard about to reference them, in the session's database
+    transaction. False if there is no such user; main databases have every user of the region."""
+    if shard.main is None or db_session.get(User, user_id) is not None:
+        return True
+    with shard.main.get_session() as main_session:
+        user = main_session.get(User, user_id)
+    if user is None:
+        return False
+    db_session.execute(insert_ignoring_conflicts(db_session.get_bind(), User.__table__),
+                       [{"user_id": user.user_id, "user_name": user.user_name, "password": user.password}])
+    return True
+
+
+def lock_bucket(shard, db_session, group_id):
+    """Hold the group's bucket on its shard until the session's database transaction ends, so that it is not moved
+    under a write. Raises ShardMovingError if the bucket is moving, or moved away from `shard` since it was looked
+    up."""
+    main = shard.main or shard
+    if not main.shards:
+        return
+    bucket = bucket_of(group_id)
+    # without advisory locks a move waits for the longest request instead
+    if db_session.get_bind().dialect.name == "postgresql" and not db_session.execute(
+            select(func.pg_try_advisory_xact_lock_shared(BUCKET_LOCK_CLASS, bucket))).scalar():
+        raise ShardMovingError(f"Group {group_id} is moving to another shard", utils.SHARD_MAP_TTL_SECONDS)
+    # a move releases the lock a map TTL after pointing the bucket elsewhere, this process' map shows that by then
+    if main.shard_for(group_id, write=True) is not shard:
+        raise ShardMovingError(f"Group {group_id} moved to another shard", 1)
+
+
+def _in_bucket(column, bucket):
+    return column % utils.SHARD_BUCKETS == bucket
+
+
+def _batches(connection, statement):
+    result = connection.execute(statement.execution_options(stream_results=True, yield_per=COPY_BATCH_SIZE))
+    for partition in result.partitions():
+        yield [dict(row._mapping) for row in partition]
+
+
+def _bucket_user_ids(connection, bucket):
+    user_ids = set(connection.execute(select(Group.owner_id).where(_in_bucket(Group.group_id, bucket))).scalars())
+    user_ids.update(connection.execute(select(group_member_association.c.user_id).where(
+        _in_bucket(group_member_association.c.group_id, bucket))).scalars())
+    user_ids.update(connection.execute(select(Transaction.user_id).distinct().where(
+        _in_bucket(Transaction.group_id, bucket))).scalars())
+    return sorted(user_id for user_id in user_ids if user_id is not None)
+
+
+def copy_bucket(main, source, target, bucket, final):
+    """Copy the bucket's purchases from source to target in one database transaction of the target, rows already
+    there are skipped. The final copy, made while the bucket is frozen, also copies its groups and memberships and
+    recomputes the target's rollups."""
+    keys = {key: set() for _, key in rollup.ROLLUPS}
+    with source.engine.connect() as reader, target.engine.begin() as writer:
+        user_ids = _bucket_user_ids(reader, bucket)
+        if target.main is not None:
+            with main.engine.connect() as main_reader:
+                # the bucket's purchase lines reference items, the menu may have grown since the shard was set up
+                menu = main_reader.execute(select(Item.__table__)).mappings().all()
+                if menu:
+                    writer.execute(insert_ignoring_conflicts(writer, Item.__table__), [dict(item) for item in menu])
+                for start in range(0, len(user_ids), COPY_BATCH_SIZE):
+                    users = main_reader.execute(select(User.__table__).where(
+                        User.user_id.in_(user_ids[start:start + COPY_BATCH_SIZE]))).mappings().all()
+                    if users:
+                        writer.execute(insert_ignoring_conflicts(writer, User.__table__), [dict(u) for u in users])
+
+        if final:
+            groups = reader.execute(select(Group.__table__).where(_in_bucket(Group.group_id, bucket))).mappings().all()
+            if groups:
+                upsert = _dialect_insert(writer, Group.__table__)
+                writer.execute(upsert.on_conflict_do_update(
+                    index_elements=["group_id"],
+                    set_={column: upsert.excluded[column] for column in ("name", "owner_id", "points", "multi_region")}
+                ), [dict(group) for group in groups])
+            # memberships have no key to skip existing ones by, the target's are replaced
+            members = reader.execute(select(group_member_association).where(
+                _in_bucket(group_member_association.c.group_id, bucket))).mappings().all()
+            writer.execute(delete(group_member_association).where(
+                _in_bucket(group_member_association.c.group_id, bucket)))
+            if members:
+                writer.execute(insert(group_member_association), [dict(member) for member in members])
+
+        first = reader.execute(select(func.min(Transaction.timestamp)).where(
+            _in_bucket(Transaction.group_id, bucket))).scalar()
+        if first is not None:
+            partitions.ensure_partitions(writer, utils.PARTITION_MONTHS_AHEAD, start=first)
+        copied = 0
+        for rows in _batches(reader, select(Transaction.__table__).where(_in_bucket(Transaction.group_id, bucket))):
+            writer.execute(insert_ignoring_conflicts(writer, Transaction.__table__), rows)
+            rollup.affected_keys([SimpleNamespace(**row) for row in rows], keys)
+            copied += len(rows)
+        items = select(TransactionItem.__table__).join(
+            Transaction, (Transaction.transaction_id == TransactionItem.transaction_id)
+            & (Transaction.timestamp == TransactionItem.transaction_timestamp)
+        ).where(_in_bucket(Transaction.group_id, bucket))
+        for rows in _batches(reader, items):
+            writer.execute(insert_ignoring_conflicts(writer, TransactionItem.__table__), rows)
+
+        if final:
+            rollup.refresh(writer, keys)
+    return copied
+
+
+def delete_bucket(source, bucket):
+    """Delete the bucket's rows from a shard it moved away from and recompute the shard's rollups"""
+    keys = {key: set() for _, key in rollup.ROLLUPS}
+    with source.engine.connect() as reader:
+        for rows in _batches(reader, select(Transaction.group_id, Transaction.user_id, Transaction.store,
+                                            Transaction.timestamp).where(_in_bucket(Transaction.group_id, bucket))):
+            rollup.affected_keys([SimpleNamespace(**row) for row in rows], keys)
+
+    with source.engine.begin() as writer:
+        writer.execute(delete(TransactionItem.__table__).where(
+            tuple_(TransactionItem.transaction_id, TransactionItem.transaction_timestamp).in_(
+                select(Transaction.transaction_id, Transaction.timestamp).where(
+                    _in_bucket(Transaction.group_id, bucket)))))
+        writer.execute(delete(Transaction.__table__).where(_in_bucket(Transaction.group_id, bucket)))
+        writer.execute(delete(group_member_association).where(
+            _in_bucket(group_member_association.c.group_id, bucket)))
+        writer.execute(delete(Group.__table__).where(_in_bucket(Group.group_id, bucket)))
+        rollup.refresh(writer, keys)
+
+
+def bucket_map(main):
+    """Shard name and frozen flag of every bucket, read from the database"""
+    with main.get_session() as db_session:
+        stored = {row.bucket: (row.shard, row.frozen) for row in db_session.query(ShardBucket)}
+    return {bucket: stored.get(bucket, (main.name, False)) for bucket in range(utils.SHARD_BUCKETS)}
+
+
+def _set_bucket(main, bucket, shard, frozen):
+    with main.get_session() as db_session:
+        db_session.merge(ShardBucket(bucket=bucket, shard=shard, frozen=frozen))
+        db_session.commit()
+
+
+@contextmanager
+def _moving(source, bucket):
+    """Hold the bucket exclusively on the shard it moves away from, once the writes that locked it before finished"""
+    if source.engine.dialect.name != "postgresql":
+        time.sleep(utils.SHARD_MAP_TTL_SECONDS + utils.REQUEST_TIMEOUT_MAX_SECONDS)
+        yield
+        return
+    # a transaction level lock also holds behind a transaction pooler, the transaction is open for the whole move
+    with source.engine.begin() as connection:
+        # however long the writes holding the bucket take
+        connection.execute(select(func.set_config("statement_timeout", "0", True),
+                                  func.set_config("lock_timeout", "0", True)))
+        connection.execute(select(func.pg_advisory_xact_lock(BUCKET_LOCK_CLASS, bucket)))
+        yield
+
+
+def move_bucket(main, bucket, shard, grace_seconds=MOVE_GRACE_SECONDS):
+    """Move a bucket to another shard of the region, False if it already is there"""
+    current, frozen = bucket_map(main)[bucket]
+    if frozen:
+        raise click.ClickException(f"Bucket {bucket} is frozen, a move is in progress or was interrupted")
+    if current == shard:
+        return False
+    source, target = main.shard(current), main.shard(shard)
+    settle_seconds = utils.SHARD_MAP_TTL_SECONDS + grace_seconds
+
+    copied = copy_bucket(main, source, target, bucket, final=False)
+    log.info(f"Copied {copied} transactions of bucket {bucket} from {current} to {shard}, freezing it.")
+    _set_bucket(main, bucket, current, frozen=True)
+    with _moving(source, bucket):
+        try:
+            copy_bucket(main, source, target, bucket, final=True)
+        except Exception:
+            _set_bucket(main, bucket, current, frozen=False)
+            raise
+        _set_bucket(main, bucket, shard, frozen=False)
+        log.info(f"Bucket {bucket} is on {shard}.")
+
+        # processes that still have the old map read from the old shard, their writes fail to lock the bucket
+        time.sleep(settle_seconds)
+        delete_bucket(source, bucket)
+    return True
+
+
+def planned_moves(main, shards):
+    """(bucket, shard) moves that spread the buckets evenly over `shards`"""
+    return [(bucket, shards[bucket % len(shards)]) for bucket, (current, _) in bucket_map(main).items()
+            if current != shards[bucket % len(shards)]]
+
+
+@click.group()
+@click.option("--region", default=utils.REGION_ID, required=True, type=click.Choice(utils.REGIONS),
+              help="Region whose shards to manage")
+@click.pass_context
+def cli(ctx, region):
+    """Manage the shards of a region's groups"""
+    ctx.obj = DB_CONNECTION[region]
+
+
+@cli.command()
+@click.pass_obj
+def status(main):
+    """Buckets and groups per shard"""
+    buckets = Counter(shard for shard, _ in bucket_map(main).values())
+    frozen = sorted(bucket for bucket, (_, is_frozen) in bucket_map(main).items() if is_frozen)
+    for connection in main.shard_connections():
+        with connection.get_session() as db_session:
+            groups = db_session.query(func.count(Group.group_id)).scalar()
+        click.echo(f"{connection.name}: {buckets[connection.name]} buckets, {groups} groups")
+    if frozen:
+        click.echo(f"frozen buckets: {', '.join(map(str, frozen))}")
+
+
+def _shard_name(main, shard):
+    if shard != main.name and shard not in main.shards:
+        raise click.BadParameter(f"{shard} is not a shard of this region, configured: "
+                                 f"{', '.join(connection.name for connection in main.shard_connections())}")
+    return shard
+
+
+@cli.command()
+@click.option("--bucket", required=True, type=click.IntRange(0, utils.SHARD_BUCKETS - 1))
+@click.option("--to", "shard", required=True, help="Shard to move the bucket to")
+@click.pass_obj
+def move(main, bucket, shard):
+    """Move one bucket to another shard"""
+    moved = move_bucket(main, bucket, _shard_name(main, shard))
+    click.echo(f"bucket {bucket} {'moved' if moved else 'already is'} on {shard}")
+
+
+@cli.command()
+@click.option("--shard", "shards", multiple=True, help="Shard to spread the buckets over, all shards by default")
+@click.option("--limit", type=click.IntRange(min=1), help="Move at most this many buckets")
+@click.pass_obj
+def rebalance(main, shards, limit):
+    """Spread the buckets evenly over the shards"""
+    shards = [_shard_name(main, shard) for shard in shards]
+    shards = shards or [connection.name for connection in main.shard_connections()]
+    moves = planned_moves(main, shards)[:limit]
+    for done, (bucket, shard) in enumerate(moves, 1):
+        move_bucket(main, bucket, shard)
+        click.echo(f"[{done}/{len(moves)}] bucket {bucket} moved to {shard}")
+    click.echo(f"{len(moves)} buckets moved")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,221 @@
+"""Trace spans of requests across the services, their regions and their databases.
+
+A trace starts at the client, when cli/api_client.py is given a trace sample rate it sends a W3C traceparent header
+with every request, or at the first service a request reaches. Services record a span for every route, every query
+function and every database statement, tagged with the region and node it ran on, and pass the trace on when they
+forward a request to another region. Tracing is off unless TRACE_EXPORT_PATH is set; every process then appends its
+finished spans to that file as NDJSON, sampling new traces at TRACE_SAMPLE_RATE and following the caller's decision
+for the others. benchmark/traces.py summarises the file and shows single traces.
+"""
+import atexit
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+import utils
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+ENABLED = bool(utils.TRACE_EXPORT_PATH)
+TRACEPARENT_HEADER = "traceparent"
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+# spans waiting for the writer beyond this are dropped rather than let memory grow when the file can't be written
+MAX_PENDING_SPANS = 10000
+
+_current = contextvars.ContextVar("current_span", default=None)
+# ids must not disturb the seeded global generator that benchmarks use for model ids
+_random = random.Random()
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "sampled", "attributes", "error", "_start",
+                 "_started_at")
+
+    def __init__(self, name, trace_id, parent_id, sampled, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{_random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes
+        self.error = None
+        self._start = time.time()
+        self._started_at = time.perf_counter()
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error=None):
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        if self.sampled:
+            _exporter.export({
+                "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+                "start": self._start, "duration_ms": (time.perf_counter() - self._started_at) * 1000,
+                "region": utils.REGION_ID, "pid": os.getpid(), "attributes": self.attributes, "error": self.error,
+            })
+
+
+def parse_traceparent(value):
+    """(trace_id, parent span id, sampled) of a traceparent header, None when it is missing or malformed"""
+    match = TRACEPARENT_PATTERN.match(value.strip().lower()) if value else None
+    if match is None or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+    trace_id, parent_id, flags = match.groups()
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+def current():
+    return _current.get()
+
+
+def activate(span):
+    """Make span the parent of the spans started in this context, None clears it"""
+    _current.set(span)
+
+
+def start(name, parent=None, **attributes):
+    """A new span, child of `parent` (a span or parse_traceparent's result), of the current span when there is
+    none, or the root of a new trace"""
+    parent = parent or _current.get()
+    if isinstance(parent, Span):
+        return Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+    if parent is not None:
+        trace_id, parent_id, sampled = parent
+        return Span(name, trace_id, parent_id, sampled, attributes)
+    return Span(name, f"{_random.getrandbits(128):032x}", None, _random.random() < utils.TRACE_SAMPLE_RATE,
+                attributes)
+
+
+def child(name, **attributes):
+    """A span below the current one, None outside of a sampled trace, e.g. for a health check's statements"""
+    parent = _current.get()
+    if parent is None or not parent.sampled:
+        return None
+    return Span(name, parent.trace_id, parent.span_id, True, attributes)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """A span around a block, the parent of the spans started in it; None when tracing is off"""
+    if not ENABLED:
+        yield None
+        return
+    new_span = start(name, **attributes)
+    token = _current.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.end(e)
+        raise
+    else:
+        new_span.end()
+    finally:
+        _current.reset(token)
+
+
+def traced(function):
+    """Record a span per call of function; a generator's span lasts until it is exhausted or closed"""
+    if not ENABLED:
+        return function
+    name = f"{function.__module__}.{function.__name__}"
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator_wrapper(*args, **kwargs):
+            generator_span = start(name)
+            generator = function(*args, **kwargs)
+            error = None
+            try:
+                while True:
+                    # the generator resumes in its consumer's context, it is the parent only while it runs
+                    token = _current.set(generator_span)
+                    try:
+                        value = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        _current.reset(token)
+                    yield value
+            except GeneratorExit:
+                raise
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                generator.close()
+                generator_span.end(error)
+        return generator_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+class FileExporter:
+    """Appends records, such as finished spans, to an NDJSON file, a background thread writes them in batches"""
+    thread_name = "trace-exporter"
+
+    def __init__(self, path, flush_seconds):
+        self._path = path
+        self._flush_seconds = flush_seconds
+        self._pending = []
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._writer = None
+
+    def export(self, record):
+        with self._lock:
+            if len(self._pending) >= MAX_PENDING_SPANS:
+                self._dropped += 1
+                return
+            self._pending.append(record)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._writer.start()
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            log.error(f"Dropped {dropped} records, {self._path} is not keeping up")
+        if not batch:
+            return
+        self._write("".join(json.dumps(record, default=str) + "\n" for record in batch).encode())
+
+    def _write(self, data):
+        # one append per batch, the services of a machine can share the file
+        fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def _run(self):
+        while True:
+            time.sleep(self._flush_seconds)
+            try:
+                self.flush()
+            except OSError as e:
+                log.error(f"Writing to {self._path} failed: {e}")
+
+
+_exporter = FileExporter(utils.TRACE_EXPORT_PATH, utils.TRACE_FLUSH_SECONDS)
+if ENABLED:
+    atexit.register(_exporter.flush)
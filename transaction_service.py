@@ -1,7 +1,8 @@
+import utils
 from api.transaction import app
 import database.query as query
 
 
 if __name__ == "__main__":
     app.config.update({"db_query": query})
-    app.run(host="0.0.0.0")
\ No newline at end of file
+    app.run(host="0.0.0.0", port=utils.API_PORT)
\ No newline at end of file
@@ -1,14 +1,114 @@
 import os
 
 JWT_KEY = os.environ.get('JWT_KEY', "DistributedSecret")
+API_PORT = int(os.environ.get("API_PORT", 5000))
+
+HEALTH_CHECK_INTERVAL = float(os.environ.get("HEALTH_CHECK_INTERVAL", 5))
+HEALTH_CHECK_TIMEOUT = int(os.environ.get("HEALTH_CHECK_TIMEOUT", 2))
+MAX_POOL_SATURATION = float(os.environ.get("MAX_POOL_SATURATION", 0.9))
+MAX_REPLICA_LAG_SECONDS = float(os.environ.get("MAX_REPLICA_LAG_SECONDS", 30))
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get("CIRCUIT_BREAKER_FAILURES", 3))
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.environ.get("CIRCUIT_BREAKER_RESET_SECONDS", 30))
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", 500))
+IDEMPOTENCY_KEY_TTL_SECONDS = float(os.environ.get("IDEMPOTENCY_KEY_TTL_SECONDS", 24 * 3600))
+# connection pools of the region databases, every setting can be overridden per region, e.g. USW_DB_POOL_SIZE
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT_SECONDS = float(os.environ.get("DB_POOL_TIMEOUT_SECONDS", 30))
+DB_POOL_RECYCLE_SECONDS = int(os.environ.get("DB_POOL_RECYCLE_SECONDS", 3600))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "false").lower() == "true"
+# 0 disables the timeout
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+# "session" for direct connections and session pooling, "transaction" behind a transaction pooler like pgbouncer
+DB_POOLER_MODE = os.environ.get("DB_POOLER_MODE", "session")
+# how long a primary stays trusted before get_session asks again whether it is in recovery, 0 asks every time
+DB_PRIMARY_CHECK_SECONDS = float(os.environ.get("DB_PRIMARY_CHECK_SECONDS", 0))
+PARTITION_MONTHS_AHEAD = int(os.environ.get("PARTITION_MONTHS_AHEAD", 3))
+RATE_LIMIT_PER_SECOND = float(os.environ.get("RATE_LIMIT_PER_SECOND", 20))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", 40))
+# proxies in front of the services whose X-Forwarded-For is trusted, 1 behind nginx
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", 0))
+# defaults to the pool size plus overflow of a region's DatabaseConnection
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", DB_POOL_SIZE + DB_MAX_OVERFLOW))
+ADMISSION_QUEUE_SECONDS = float(os.environ.get("ADMISSION_QUEUE_SECONDS", 0.5))
+# deadline of a request that does not send X-Request-Timeout, which is honoured up to REQUEST_TIMEOUT_MAX_SECONDS
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get("REQUEST_TIMEOUT_SECONDS", 10))
+BULK_REQUEST_TIMEOUT_SECONDS = float(os.environ.get("BULK_REQUEST_TIMEOUT_SECONDS", 60))
+REQUEST_TIMEOUT_MAX_SECONDS = float(os.environ.get("REQUEST_TIMEOUT_MAX_SECONDS", 120))
+# a retry takes over a key still claimed after this long, which must outlast the longest request: its deadline and
+# the writes it finishes with the deadline suspended, which only the statement timeout bounds
+IDEMPOTENCY_LOCK_SECONDS = float(os.environ.get("IDEMPOTENCY_LOCK_SECONDS", REQUEST_TIMEOUT_MAX_SECONDS + 60))
+READ_CACHE_TTL_SECONDS = float(os.environ.get("READ_CACHE_TTL_SECONDS", 2))
+READ_CACHE_MAX_ITEMS = int(os.environ.get("READ_CACHE_MAX_ITEMS", 10000))
+LOOKUP_CACHE_TTL_SECONDS = float(os.environ.get("LOOKUP_CACHE_TTL_SECONDS", 300))
+LOOKUP_CACHE_MAX_ITEMS = int(os.environ.get("LOOKUP_CACHE_MAX_ITEMS", 50000))
+CHANGE_FEED_POLL_SECONDS = float(os.environ.get("CHANGE_FEED_POLL_SECONDS", 1))
+CHANGE_FEED_MAX_WAIT_SECONDS = float(os.environ.get("CHANGE_FEED_MAX_WAIT_SECONDS", 30))
+# groups are spread over a region's shards by group_id modulo SHARD_BUCKETS, a bucket moves between shards as a whole
+SHARD_BUCKETS = int(os.environ.get("SHARD_BUCKETS", 256))
+SHARD_MAP_TTL_SECONDS = float(os.environ.get("SHARD_MAP_TTL_SECONDS", 5))
+MAIN_SHARD = "main"
+FORWARD_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("FORWARD_CONNECT_TIMEOUT_SECONDS", 3))
+# above the change feed's longest wait
+FORWARD_READ_TIMEOUT_SECONDS = float(os.environ.get("FORWARD_READ_TIMEOUT_SECONDS", 60))
+FORWARD_POOL_SIZE = int(os.environ.get("FORWARD_POOL_SIZE", 20))
+# forwarded requests signed longer ago are refused, the regions' clocks have to agree within this
+FORWARD_SIGNATURE_MAX_AGE_SECONDS = float(os.environ.get("FORWARD_SIGNATURE_MAX_AGE_SECONDS", 30))
+# "orjson", used when it is installed, or "json" for Flask's encoder
+JSON_ENCODER = os.environ.get("JSON_ENCODER", "orjson")
+# smaller responses fit in a packet or two, compressing them costs more than it saves
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", 1024))
+GZIP_COMPRESSION_LEVEL = int(os.environ.get("GZIP_COMPRESSION_LEVEL", 6))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", 5))
+# spans are appended to this NDJSON file, tracing is off when it is empty
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "")
+# share of the traces started here that are recorded, traces started by a caller follow its decision
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1))
+TRACE_FLUSH_SECONDS = float(os.environ.get("TRACE_FLUSH_SECONDS", 1))
+# requests are recorded for benchmark/replay.py as gzip compressed NDJSON files in this directory, off when empty
+CAPTURE_DIR = os.environ.get("CAPTURE_DIR", "")
+CAPTURE_SAMPLE_RATE = float(os.environ.get("CAPTURE_SAMPLE_RATE", 1))
+# larger bodies are recorded without their content and are not replayed
+CAPTURE_MAX_BODY_BYTES = int(os.environ.get("CAPTURE_MAX_BODY_BYTES", 1024 * 1024))
+CAPTURE_ROTATE_BYTES = int(os.environ.get("CAPTURE_ROTATE_BYTES", 64 * 1024 * 1024))
+CAPTURE_FLUSH_SECONDS = float(os.environ.get("CAPTURE_FLUSH_SECONDS", 1))
 
 REGION_ID = os.environ.get("REGION_ID")
 REGION_URLS = {}
+# (region, service) -> API of that region's service, requests for regions listed here are forwarded to them
+REGION_API_URLS = {}
+REGION_POOL_SETTINGS = {}
+# region -> {shard name: database URLs} of the primaries besides the region's main database
+REGION_SHARD_URLS = {}
 
 REGIONS = os.environ.get("REGIONS").split(",")
 REGIONS_INT = {region: i for i, region in enumerate(REGIONS)}
 REGIONS_INT_REV = {i: region for i, region in enumerate(REGIONS)}
 for region in REGIONS:
+    REGION_POOL_SETTINGS[region] = {
+        "pool_size": int(os.environ.get(f"{region}_DB_POOL_SIZE", DB_POOL_SIZE)),
+        "max_overflow": int(os.environ.get(f"{region}_DB_MAX_OVERFLOW", DB_MAX_OVERFLOW)),
+        "pool_timeout": float(os.environ.get(f"{region}_DB_POOL_TIMEOUT_SECONDS", DB_POOL_TIMEOUT_SECONDS)),
+        "pool_recycle": int(os.environ.get(f"{region}_DB_POOL_RECYCLE_SECONDS", DB_POOL_RECYCLE_SECONDS)),
+        "pool_pre_ping": os.environ.get(f"{region}_DB_POOL_PRE_PING", str(DB_POOL_PRE_PING)).lower() == "true",
+        "statement_timeout_ms": int(os.environ.get(f"{region}_DB_STATEMENT_TIMEOUT_MS", DB_STATEMENT_TIMEOUT_MS)),
+        "pooler_mode": os.environ.get(f"{region}_DB_POOLER_MODE", DB_POOLER_MODE),
+        "primary_check_seconds": float(os.environ.get(f"{region}_DB_PRIMARY_CHECK_SECONDS",
+                                                      DB_PRIMARY_CHECK_SECONDS)),
+    }
+    # e.g. EUW_SHARDS=s1,s2 with EUW_SHARD_S1_DB_URLS and EUW_SHARD_S2_DB_URLS
+    shard_names = os.environ.get(f"{region}_SHARDS")
+    REGION_SHARD_URLS[region] = {
+        name: os.environ.get(f"{region}_SHARD_{name.upper()}_DB_URLS").split(",")
+        for name in (shard_names.split(",") if shard_names else [])
+    }
+    for service in ("user", "transaction"):
+        if os.environ.get(f"{region}_{service.upper()}_API_URL"):
+            REGION_API_URLS[(region, service)] = os.environ.get(f"{region}_{service.upper()}_API_URL").rstrip("/")
+    # full database URLs take precedence, e.g. to point a region at a local stand-in database
+    if os.environ.get(f"{region}_DB_URLS"):
+        REGION_URLS[region] = os.environ.get(f"{region}_DB_URLS").split(",")
+        continue
     user = os.environ.get(f"{region}_DB_USER")
     password = os.environ.get(f"{region}_DB_PASSWORD")
     hosts = os.environ.get(f"{region}_DB_HOSTS").split(",")
@@ -18,3 +118,10 @@ for region in REGIONS:
     for each_index in range(len(hosts)):
         db_urls.append(f"postgresql://{user}:{password}@{hosts[each_index]}:{ports[each_index]}/{db}")
     REGION_URLS[region] = db_urls
+
+# a shorter claim lets a retry repeat the writes of a request that is still running
+_longest_statement_seconds = max(settings["statement_timeout_ms"] for settings in REGION_POOL_SETTINGS.values()) / 1000
+if IDEMPOTENCY_LOCK_SECONDS < REQUEST_TIMEOUT_MAX_SECONDS + _longest_statement_seconds:
+    raise ValueError(f"IDEMPOTENCY_LOCK_SECONDS ({IDEMPOTENCY_LOCK_SECONDS:g}) must be at least "
+                     f"REQUEST_TIMEOUT_MAX_SECONDS plus the longest statement timeout "
+                     f"({REQUEST_TIMEOUT_MAX_SECONDS + _longest_statement_seconds:g})")